@@ -0,0 +1,685 @@
+"""
+Replays push deliveries against a CI server and reports how it keeps up.
+
+The server is started in a scratch directory with its own database, caches
+and logs. Its commit statuses go to a local stand-in for the github API and
+the pushed commits are served from a local git daemon, so nothing leaves the
+machine. Deliveries are either synthetic pushes of commits in a small fixture
+repository, or recorded payloads read from a file.
+
+The report holds the webhook acknowledgement latency, how long deliveries
+and jobs waited, the duration of every pipeline stage, the time until the
+final commit status and the latency of the database writes. It is written
+as json and printed as a table, optionally next to an earlier report:
+
+    python benchmarks/webhook_load.py --deliveries 40 --rate 4 --output before.json
+    python benchmarks/webhook_load.py --deliveries 40 --rate 4 --compare before.json
+"""
+
+import argparse
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+SERVER = os.path.abspath(os.path.join(os.path.dirname(__file__), "../src/ci_server.py"))
+# Bumped when the meaning of a metric changes, reports of other versions are not compared
+REPORT_VERSION = 1
+# Commit states that end a build
+FINAL_STATES = ("success", "failure", "error")
+# Secret the deliveries are signed with
+WEBHOOK_SECRET = "benchmark"
+# Seconds to wait for the server to answer after it was started
+STARTUP_TIMEOUT = 30
+
+
+class StubGithub(ThreadingHTTPServer):
+    """
+    Local stand-in for the github statuses API. Records the state and arrival
+    time of every status update per commit.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubGithubHandler)
+        self.statuses = {}
+        self.condition = threading.Condition()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def final_status(self, sha: str):
+        """
+        Returns the first final state received for a commit and when it
+        arrived, None while the commit has none.
+
+        :rtype: (str, float)
+        """
+        with self.condition:
+            for state, received in self.statuses.get(sha, []):
+                if state in FINAL_STATES:
+                    return state, received
+        return None
+
+    def wait_for(self, shas, timeout: float) -> bool:
+        """
+        Waits until every commit has a final status.
+
+        :param shas: The commits to wait for
+        :param timeout: Maximum number of seconds to wait
+        :type timeout: float
+
+        :return: True if every commit finished in time
+        :rtype: bool
+        """
+
+        def finished():
+            return all(
+                any(state in FINAL_STATES for state, _ in self.statuses.get(sha, []))
+                for sha in shas
+            )
+
+        with self.condition:
+            return self.condition.wait_for(finished, timeout)
+
+
+class StubGithubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        received = time.time()
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        sha = self.path.rstrip("/").rsplit("/", 1)[-1]
+        with self.server.condition:
+            self.server.statuses.setdefault(sha, []).append((body["state"], received))
+            self.server.condition.notify_all()
+        self.send_response(201)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+def _free_port() -> int:
+    with closing(socket.socket()) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _git(cwd: str, *args) -> str:
+    result = subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    )
+    return result.stdout.strip()
+
+
+def create_fixture_repo(root: str, commits: int) -> (str, list):
+    """
+    Creates a bare repository holding a small python project with a test
+    suite. Every commit changes the project, so each one is a distinct build.
+
+    :param root: Directory the repository is created in
+    :type root: str
+    :param commits: The number of commits
+    :type commits: int
+
+    :return: The path of the bare repository and the commit hashes, oldest first
+    :rtype: (str, list)
+    """
+    work = os.path.join(root, "work")
+    bare = os.path.join(root, "ci-bench.git")
+    os.makedirs(os.path.join(work, "tests"))
+    _git(work, "init", "-q", "-b", "main")
+    _git(work, "config", "user.name", "CI benchmark")
+    _git(work, "config", "user.email", "ci-bench@localhost")
+    with open(os.path.join(work, "tests", "test_calc.py"), "w") as f:
+        f.write(
+            "from calc import add, VERSION\n\n\n"
+            "def test_add():\n    assert add(2, 3) == 5\n\n\n"
+            "def test_version():\n    assert VERSION >= 0\n"
+        )
+    # The conftest puts the project root on sys.path for the tests
+    with open(os.path.join(work, "conftest.py"), "w") as f:
+        f.write("")
+    shas = []
+    for i in range(commits):
+        with open(os.path.join(work, "calc.py"), "w") as f:
+            f.write(f"VERSION = {i}\n\n\ndef add(a, b):\n    return a + b\n")
+        _git(work, "add", "-A")
+        _git(work, "commit", "-q", "-m", f"Benchmark commit {i}")
+        shas.append(_git(work, "rev-parse", "HEAD"))
+    _git(root, "clone", "-q", "--bare", work, bare)
+    return bare, shas
+
+
+def start_git_daemon(base_path: str) -> (subprocess.Popen, str):
+    """
+    Serves the repositories in base_path with git daemon.
+
+    :param base_path: Directory holding the bare repositories
+    :type base_path: str
+
+    :return: The daemon process and the URL repositories are served under
+    :rtype: (subprocess.Popen, str)
+    """
+    port = _free_port()
+    daemon = subprocess.Popen(
+        [
+            "git",
+            "daemon",
+            "--reuseaddr",
+            "--export-all",
+            "--listen=127.0.0.1",
+            f"--port={port}",
+            f"--base-path={base_path}",
+            base_path,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return daemon, f"git://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    daemon.kill()
+    raise RuntimeError("git daemon did not start")
+
+
+def synthetic_payloads(clone_url: str, shas: list, branches: int) -> list:
+    """
+    Creates push payloads for the commits, spread round robin over branches.
+    Pushes to the same branch may be coalesced by the scheduler.
+
+    :param clone_url: The URL the server clones from
+    :type clone_url: str
+    :param shas: The pushed commits, one delivery each
+    :type shas: list
+    :param branches: The number of branches pushed to
+    :type branches: int
+    :rtype: list
+    """
+    payloads = []
+    for i, sha in enumerate(shas):
+        payloads.append(
+            {
+                "ref": f"refs/heads/bench-{i % max(branches, 1)}",
+                "before": shas[i - 1] if i else "0" * 40,
+                "after": sha,
+                "repository": {
+                    "name": "ci-bench",
+                    "full_name": "bench/ci-bench",
+                    "owner": {"login": "bench"},
+                    "clone_url": clone_url,
+                },
+            }
+        )
+    return payloads
+
+
+def load_payloads(path: str) -> list:
+    """
+    Reads recorded push payloads, either a json list or one payload per line.
+
+    :param path: The file with the payloads
+    :type path: str
+    :rtype: list
+    """
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        payloads = json.loads(text)
+    else:
+        payloads = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return payloads
+
+
+def retarget(payloads: list, clone_url: str, shas: list):
+    """
+    Points recorded payloads at the fixture repository, the nth payload
+    pushes the nth commit. Everything else in the payloads is kept.
+
+    :param payloads: The recorded payloads, changed in place
+    :type payloads: list
+    :param clone_url: The URL of the fixture repository
+    :type clone_url: str
+    :param shas: The commits of the fixture, at least one per payload
+    :type shas: list
+    """
+    for payload, sha in zip(payloads, shas):
+        payload["repository"]["clone_url"] = clone_url
+        payload["after"] = sha
+
+
+def sign(body: bytes, secret: str) -> str:
+    """
+    Returns the X-Hub-Signature-256 header github sends with a body.
+
+    :rtype: str
+    """
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def start_server(workdir: str, port: int, env: dict) -> subprocess.Popen:
+    """
+    Starts the CI server in workdir, which holds its database, and waits
+    until it answers.
+
+    :param workdir: Working directory of the server
+    :type workdir: str
+    :param port: The port the server listens on
+    :type port: int
+    :param env: Environment variables of the server
+    :type env: dict
+    :rtype: subprocess.Popen
+    """
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    server = subprocess.Popen(
+        [sys.executable, SERVER],
+        cwd=workdir,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    log.close()
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited, see {workdir}/server.log")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/queue", timeout=1)
+            return server
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"The server did not start, see {workdir}/server.log")
+
+
+def replay(url: str, payloads: list, rate: float, concurrency: int) -> list:
+    """
+    Posts the payloads to the webhook at a fixed rate. Deliveries are sent on
+    schedule whether or not earlier ones were acknowledged, up to concurrency
+    at a time.
+
+    :param url: The webhook URL
+    :type url: str
+    :param payloads: The push payloads
+    :type payloads: list
+    :param rate: Deliveries per second, 0 sends them as fast as possible
+    :type rate: float
+    :param concurrency: Deliveries in flight at once
+    :type concurrency: int
+
+    :return: One dictionary per delivery with the sha, status_code, sent_at
+             and the ack latency in seconds
+    :rtype: list
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=concurrency, pool_maxsize=concurrency
+    )
+    session.mount("http://", adapter)
+
+    def send(payload):
+        body = json.dumps(payload).encode()
+        headers = {
+            "Content-Type": "application/json",
+            "X-GitHub-Event": "push",
+            "X-GitHub-Delivery": str(uuid.uuid4()),
+            "X-Hub-Signature-256": sign(body, WEBHOOK_SECRET),
+        }
+        sent_at = time.time()
+        start = time.perf_counter()
+        try:
+            status_code = session.post(url, data=body, headers=headers).status_code
+        except requests.RequestException:
+            status_code = None
+        return {
+            "sha": payload["after"],
+            "status_code": status_code,
+            "sent_at": sent_at,
+            "latency": time.perf_counter() - start,
+        }
+
+    futures = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for i, payload in enumerate(payloads):
+            if rate > 0:
+                time.sleep(max(0.0, start + i / rate - time.perf_counter()))
+            futures.append(pool.submit(send, payload))
+    return [future.result() for future in futures]
+
+
+def summarise(values) -> dict:
+    """
+    Summarises a list of measurements.
+
+    :return: Dictionary with count, mean, p50, p95, p99 and max, the
+             statistics are None without measurements
+    :rtype: dict
+    """
+    values = sorted(values)
+    if not values:
+        return {
+            "count": 0,
+            "mean": None,
+            "p50": None,
+            "p95": None,
+            "p99": None,
+            "max": None,
+        }
+
+    def percentile(p):
+        return values[round(p / 100 * (len(values) - 1))]
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": values[-1],
+    }
+
+
+def collect_metrics(database: str, acks: list, github: StubGithub) -> dict:
+    """
+    Gathers the measurements of a run from the acknowledgements, the server's
+    database and the statuses github received.
+
+    :param database: Path of the server's database
+    :type database: str
+    :param acks: The result of :py:func:`replay`
+    :type acks: list
+    :param github: The stub that received the statuses
+    :type github: StubGithub
+
+    :return: Dictionary of metric name to :py:func:`summarise` result, all in seconds
+    :rtype: dict
+    """
+    conn = sqlite3.connect(database)
+    with closing(conn):
+        delivery_wait = [
+            row[0]
+            for row in conn.execute(
+                """
+                SELECT jobs.enqueued_at - deliveries.received_at
+                FROM deliveries JOIN jobs ON jobs.id = deliveries.job_id
+            """
+            )
+        ]
+        jobs = conn.execute(
+            """
+            SELECT started_at - enqueued_at, finished_at - started_at
+            FROM jobs WHERE started_at IS NOT NULL
+        """
+        ).fetchall()
+        stages = {}
+        for stage, duration in conn.execute(
+            "SELECT stage, duration FROM build_stages ORDER BY id"
+        ):
+            stages.setdefault(stage, []).append(duration)
+
+    end_to_end = []
+    first_sent = {}
+    for ack in acks:
+        first_sent.setdefault(ack["sha"], ack["sent_at"])
+    for sha, sent_at in first_sent.items():
+        final = github.final_status(sha)
+        if final is not None:
+            end_to_end.append(final[1] - sent_at)
+
+    metrics = {
+        "ack_latency": summarise(ack["latency"] for ack in acks),
+        "delivery_wait": summarise(delivery_wait),
+        "queue_wait": summarise(wait for wait, _ in jobs),
+        "build_duration": summarise(
+            duration for _, duration in jobs if duration is not None
+        ),
+    }
+    for stage, durations in stages.items():
+        metrics[f"stage_{stage}"] = summarise(durations)
+    metrics["time_to_status"] = summarise(end_to_end)
+    return metrics
+
+
+def run(args) -> dict:
+    """
+    Runs one benchmark and returns its report.
+
+    :param args: The parsed command line
+    :rtype: dict
+    """
+    workdir = tempfile.mkdtemp(prefix="ci-bench-")
+    cache_dir = args.cache_dir or os.path.join(workdir, "cache")
+    git_root = os.path.join(workdir, "git")
+    os.makedirs(git_root)
+
+    github = StubGithub()
+    threading.Thread(target=github.serve_forever, daemon=True).start()
+    daemon = server = None
+    try:
+        payloads = load_payloads(args.payloads) if args.payloads else None
+        bare, shas = create_fixture_repo(
+            git_root, len(payloads) if payloads else args.deliveries
+        )
+        daemon, git_url = start_git_daemon(git_root)
+        clone_url = f"{git_url}/{os.path.basename(bare)}"
+        if payloads is None:
+            payloads = synthetic_payloads(clone_url, shas, args.branches)
+        elif not args.keep_clone_urls:
+            retarget(payloads, clone_url, shas)
+
+        port = _free_port()
+        env = dict(os.environ)
+        env.update(
+            {
+                "CI_HOST": "127.0.0.1",
+                "CI_PORT": str(port),
+                "CI_GITHUB_API_URL": github.url,
+                "GITHUB_TOKEN": "benchmark",
+                "GITHUB_WEBHOOK_SECRET": WEBHOOK_SECRET,
+                "CI_LOG_DIR": os.path.join(workdir, "logs"),
+                "CI_LOG_STORE_DIR": os.path.join(workdir, "log-store"),
+                "CI_WORKSPACE_DIR": os.path.join(workdir, "workspaces"),
+                "CI_GIT_CACHE_DIR": os.path.join(cache_dir, "git"),
+                "CI_ENV_CACHE_DIR": os.path.join(cache_dir, "env"),
+            }
+        )
+        server = start_server(workdir, port, env)
+        base_url = f"http://127.0.0.1:{port}"
+
+        print(f"Sending {len(payloads)} deliveries to {base_url}")
+        started = time.time()
+        acks = replay(f"{base_url}/webhook", payloads, args.rate, args.concurrency)
+        accepted = [ack for ack in acks if ack["status_code"] == 202]
+        finished = github.wait_for({ack["sha"] for ack in accepted}, args.timeout)
+        elapsed = time.time() - started
+        if not finished:
+            print(f"Not every build finished within {args.timeout} seconds")
+        queue = requests.get(f"{base_url}/queue", timeout=10).json()
+
+        metrics = collect_metrics(os.path.join(workdir, "ci_server.db"), acks, github)
+        states = {}
+        for sha in {ack["sha"] for ack in accepted}:
+            final = github.final_status(sha)
+            state = final[0] if final is not None else "unfinished"
+            states[state] = states.get(state, 0) + 1
+        return {
+            "version": REPORT_VERSION,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": _server_commit(),
+            "config": {
+                "deliveries": len(payloads),
+                "rate": args.rate,
+                "concurrency": args.concurrency,
+                "branches": args.branches,
+                "payloads": args.payloads,
+                "warm_cache": args.cache_dir is not None,
+            },
+            "elapsed": elapsed,
+            "throughput": len(accepted) / elapsed if elapsed else 0.0,
+            "acks": {
+                str(code): sum(ack["status_code"] == code for ack in acks)
+                for code in sorted({ack["status_code"] for ack in acks}, key=str)
+            },
+            "builds": states,
+            "db_writes": queue.get("db_writes", {}),
+            "metrics": metrics,
+        }
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait(10)
+        github.shutdown()
+        github.server_close()
+        if args.keep_workdir:
+            print(f"Kept the server's files in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _server_commit() -> str:
+    try:
+        return _git(os.path.dirname(SERVER), "rev-parse", "--short", "HEAD")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _ms(value) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+
+def format_report(report: dict, baseline: dict = None) -> str:
+    """
+    Formats the metrics of a report as a table in milliseconds. With a
+    baseline the p95 of the baseline and the relative change are added.
+
+    :param report: The report of a run
+    :type report: dict
+    :param baseline: An earlier report to compare with
+    :type baseline: dict
+    :rtype: str
+    """
+    if baseline is not None and baseline.get("version") != report["version"]:
+        print("The baseline was written by another report version, not comparing")
+        baseline = None
+    header = ["metric (ms)", "count", "mean", "p50", "p95", "p99", "max"]
+    if baseline is not None:
+        header += [f"p95 {baseline.get('commit') or 'baseline'}", "change"]
+    rows = [header]
+    for name, stats in report["metrics"].items():
+        row = [name, str(stats["count"])]
+        row += [_ms(stats[key]) for key in ("mean", "p50", "p95", "p99", "max")]
+        if baseline is not None:
+            old = baseline["metrics"].get(name, {}).get("p95")
+            row.append(_ms(old))
+            if old and stats["p95"] is not None:
+                row.append(f"{(stats['p95'] - old) / old * 100:+.0f}%")
+            else:
+                row.append("-")
+        rows.append(row)
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = [
+        "  ".join(
+            cell.ljust(width) if i == 0 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        )
+        for row in rows
+    ]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+
+    writes = report.get("db_writes") or {}
+    if writes:
+        lines.append(
+            f"db writes: {writes.get('writes', 0)}, "
+            f"avg {_ms(writes.get('avg_latency'))} ms, "
+            f"p95 {_ms(writes.get('p95_latency'))} ms, "
+            f"max {_ms(writes.get('max_latency'))} ms"
+        )
+    lines.append(
+        f"acks: {report['acks']}, builds: {report['builds']}, "
+        f"throughput: {report['throughput']:.2f} builds/s over {report['elapsed']:.1f} s"
+    )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay webhook deliveries against the CI server"
+    )
+    parser.add_argument(
+        "--deliveries", type=int, default=20, help="Synthetic pushes to send"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=2.0, help="Deliveries per second, 0 for no limit"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Deliveries in flight at once"
+    )
+    parser.add_argument(
+        "--branches",
+        type=int,
+        default=4,
+        help="Branches the synthetic pushes are spread over",
+    )
+    parser.add_argument(
+        "--payloads", help="Replay recorded payloads (json list or json lines)"
+    )
+    parser.add_argument(
+        "--keep-clone-urls",
+        action="store_true",
+        help="Build the recorded commits from their own clone_url instead of the fixture",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Git and environment cache to reuse between runs, a fresh one by default",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=600, help="Seconds to wait for the builds"
+    )
+    parser.add_argument("--output", help="Write the json report to this file")
+    parser.add_argument("--compare", help="An earlier json report to compare with")
+    parser.add_argument(
+        "--keep-workdir",
+        action="store_true",
+        help="Keep the server's database, logs and output",
+    )
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(format_report(report, baseline))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from build_log import BuildLog
+from db import initialise_db
+from scheduler import BUILD_WORKERS
+from ci_server import AGENT_TOKEN, new_build_state, execute_build
+
+# Name the agent reports to the coordinator, shown in the build log
+AGENT_NAME = os.getenv("CI_AGENT_NAME", socket.gethostname())
+# Seconds an idle agent waits before asking the coordinator for a job again
+AGENT_POLL_INTERVAL = float(os.getenv("CI_AGENT_POLL_INTERVAL", "2"))
+# Seconds to wait for the coordinator to answer
+AGENT_REQUEST_TIMEOUT = 30.0
+# Attempts to deliver the result of a build before it is given up
+AGENT_RESULT_ATTEMPTS = 5
+
+
+class AgentLog(BuildLog):
+    """
+    Log of a build run by an agent. Only the tail is kept by the agent, the
+    output is sent to the coordinator with the next heartbeat, see
+    :py:meth:`take`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+
+    def write(self, text: str):
+        super().write(text)
+        with self._pending_lock:
+            self._pending.append(text)
+
+    def take(self) -> str:
+        """
+        Returns the output written since the last call.
+
+        :rtype: str
+        """
+        with self._pending_lock:
+            text, self._pending = "".join(self._pending), []
+        return text
+
+    def give_back(self, text: str):
+        """
+        Puts output returned by :py:meth:`take` back in front of the pending
+        output, e.g. after a heartbeat failed.
+
+        :param text: The output
+        :type text: str
+        """
+        with self._pending_lock:
+            self._pending.insert(0, text)
+
+
+class BuildAgent:
+    """
+    Runs builds for a coordinator, a ci_server that only queues jobs, see
+    :py:meth:`scheduler.BuildScheduler.lease`. The agent leases a job over
+    HTTP, runs the build pipeline on this host and sends the output and the
+    outcome back. While it builds it renews the lease with heartbeats, which
+    also tell it when a newer push superseded the build.
+
+    When the coordinator cannot be reached for longer than the lease the
+    build is aborted, the coordinator has queued the job again by then.
+
+    :param server: Base URL of the coordinator
+    :type server: str
+    :param name: Name of the agent
+    :type name: str
+    :param token: The CI_AGENT_TOKEN of the coordinator
+    :type token: str
+    :param poll_interval: Seconds to wait when the queue is empty
+    :type poll_interval: float
+    """
+
+    def __init__(
+        self,
+        server: str,
+        name: str = AGENT_NAME,
+        token: str = AGENT_TOKEN,
+        poll_interval: float = AGENT_POLL_INTERVAL,
+    ):
+        self.server = server.rstrip("/")
+        self.name = name
+        self.poll_interval = poll_interval
+        self.session = requests.Session()
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+        self._stopping = threading.Event()
+
+    def _post(self, path: str, data: dict) -> requests.Response:
+        return self.session.post(
+            self.server + path, json=data, timeout=AGENT_REQUEST_TIMEOUT
+        )
+
+    def run(self):
+        """
+        Builds leased jobs until :py:meth:`stop` is called.
+        """
+        while not self._stopping.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except requests.RequestException as e:
+                print(f"Agent {self.name} could not reach {self.server}: {e}")
+            self._stopping.wait(self.poll_interval)
+
+    def stop(self):
+        """
+        Stops :py:meth:`run` once the current build is done.
+        """
+        self._stopping.set()
+
+    def run_once(self) -> bool:
+        """
+        Leases and builds one job.
+
+        :raises requests.RequestException: If the coordinator cannot be reached
+
+        :return: False if the queue was empty
+        :rtype: bool
+        """
+        response = self._post("/agent/lease", {"agent": self.name})
+        if response.status_code == 204:
+            return False
+        response.raise_for_status()
+        self.build(response.json())
+        return True
+
+    def build(self, job: dict) -> str:
+        """
+        Runs the build pipeline for a leased job and reports the outcome.
+
+        :param job: The job returned by the coordinator
+        :type job: dict
+
+        :return: The outcome of the build
+        :rtype: str
+        """
+        state = new_build_state(job["payload"])
+        state["log"] = AgentLog()
+        state["durations"] = job.get("durations")
+        state["flaky_tests"] = job.get("flaky_tests")
+        state["find_result"] = self.find_result
+        cancelled = threading.Event()
+        done = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(job, state["log"], cancelled, done)
+        )
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            status = execute_build(state, cancelled)
+        finally:
+            done.set()
+            heartbeat.join()
+        state["log"].close()
+        print(f"Agent {self.name} finished job {job['job_id']}: {status}")
+        self._report(job, state, status)
+        return status
+
+    def find_result(self, repo: str, result_key: tuple) -> tuple:
+        """
+        Looks up the result cache of the coordinator, see
+        :py:func:`ci_server.find_build_result`.
+
+        :return: The (build id, status) of the earlier build, None on a miss
+                 or when the coordinator cannot be reached
+        :rtype: tuple
+        """
+        try:
+            response = self.session.get(
+                self.server + "/agent/results",
+                params={"repo": repo, "tree": result_key[0], "env": result_key[1]},
+                timeout=AGENT_REQUEST_TIMEOUT,
+            )
+        except requests.RequestException as e:
+            print(f"Result cache unavailable: {e}")
+            return None
+        if response.status_code != 200:
+            return None
+        result = response.json()
+        return result["build_id"], result["status"]
+
+    def _heartbeat(self, job, log, cancelled, done):
+        interval = job["lease_seconds"] / 3
+        renewed = time.monotonic()
+        while not done.wait(interval):
+            text = log.take()
+            try:
+                response = self._post(
+                    f"/agent/jobs/{job['job_id']}/heartbeat",
+                    {"lease_token": job["lease_token"], "log": text},
+                )
+            except requests.RequestException as e:
+                print(f"Heartbeat of job {job['job_id']} failed: {e}")
+                log.give_back(text)
+                if time.monotonic() - renewed > job["lease_seconds"]:
+                    cancelled.set()
+                continue
+            if response.status_code == 409:
+                print(f"Lease of job {job['job_id']} lost, aborting the build")
+                cancelled.set()
+                return
+            if response.status_code != 200:
+                log.give_back(text)
+                continue
+            renewed = time.monotonic()
+            if response.json().get("cancelled"):
+                cancelled.set()
+
+    def _report(self, job, state, status):
+        data = {
+            "lease_token": job["lease_token"],
+            "status": status,
+            "log": state["log"].take(),
+            "stages": state["stages"],
+            "cache_events": state["cache_events"],
+            "test_results": state["test_results"],
+            "scope": state["scope"],
+            "cached_from": state["cached_from"],
+            "result_key": state["result_key"],
+            "matrix": state["matrix"],
+        }
+        for attempt in range(AGENT_RESULT_ATTEMPTS):
+            try:
+                response = self._post(f"/agent/jobs/{job['job_id']}/result", data)
+            except requests.RequestException as e:
+                print(f"Could not report job {job['job_id']}: {e}")
+            else:
+                if response.status_code == 409:
+                    print(f"Lease of job {job['job_id']} lost, result dropped")
+                    return
+                if response.status_code == 200:
+                    return
+                print(f"Could not report job {job['job_id']}: {response.status_code}")
+            self._stopping.wait(min(2**attempt, job["lease_seconds"] / 2))
+        print(f"Giving up reporting job {job['job_id']}, it will be built again")
+
+
+def run_agents(server: str, workers: int = BUILD_WORKERS):
+    """
+    Runs build agents for a coordinator until interrupted, one thread per
+    build that may run at the same time. The agents keep the compile cache
+    and test impact index in a database of their own. Exits if CI_AGENT_TOKEN
+    is not set.
+
+    :param server: Base URL of the coordinator
+    :type server: str
+    :param workers: Number of builds run at the same time
+    :type workers: int
+    """
+    if not AGENT_TOKEN:
+        sys.exit(
+            "CI_AGENT_TOKEN must be set, the coordinator refuses agents without it"
+        )
+    initialise_db()
+    agents = [
+        BuildAgent(server, name=f"{AGENT_NAME}-{i}") for i in range(max(workers, 1))
+    ]
+    threads = [threading.Thread(target=agent.run, daemon=True) for agent in agents]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        for agent in agents:
+            agent.stop()
+
+
+if __name__ == "__main__":
+    run_agents(sys.argv[1])
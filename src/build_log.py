@@ -0,0 +1,257 @@
+import gzip
+import os
+import shutil
+import subprocess
+import threading
+
+import sandbox
+
+# Build logs are kept here, one directory of chunk files per build
+LOG_DIR = os.getenv("CI_LOG_DIR", "/tmp/ci-logs")
+# A chunk is sealed and a new one started once it grows past this size
+LOG_CHUNK_BYTES = int(os.getenv("CI_LOG_CHUNK_BYTES", str(1024**2)))
+# Sealed chunks are gzip compressed
+LOG_COMPRESS = os.getenv("CI_LOG_COMPRESS", "1") == "1"
+# Size of the end of the log that is kept in memory and stored with the build
+LOG_TAIL_BYTES = int(os.getenv("CI_LOG_TAIL_BYTES", str(64 * 1024)))
+
+# Marker file written once the log is closed
+_COMPLETE_MARKER = "complete"
+
+
+def log_path(build_id: int) -> str:
+    """
+    Returns the directory holding the log chunks of a build.
+
+    :param build_id: The id of the build
+    :type build_id: int
+    :rtype: str
+    """
+    return os.path.join(LOG_DIR, str(build_id))
+
+
+class BuildLog:
+    """
+    Append-only log of a build, written to disk in chunks while the build runs
+    so the output never has to be held in memory. Chunk files are named after
+    the offset of their first byte in the log. Only the last LOG_TAIL_BYTES are
+    kept in memory, see :py:meth:`tail`.
+
+    A log without a build id is not written to disk, only its tail is kept.
+
+    :param build_id: The id of the build, or None
+    :type build_id: int
+    """
+
+    def __init__(self, build_id: int = None):
+        self.build_id = build_id
+        self.size = 0
+        self._tail = bytearray()
+        self._lock = threading.Lock()
+        self._file = None
+        self._chunk_start = 0
+        self._directory = None
+        if build_id is not None:
+            self._directory = log_path(build_id)
+            shutil.rmtree(self._directory, ignore_errors=True)
+            os.makedirs(self._directory)
+
+    def write(self, text: str):
+        """
+        Appends text to the log, it is visible to readers immediately.
+        Safe to call from several threads.
+
+        :param text: The text to append
+        :type text: str
+        """
+        data = text.encode("utf-8", errors="replace")
+        if not data:
+            return
+        with self._lock:
+            self._tail += data
+            del self._tail[:-LOG_TAIL_BYTES]
+            self.size += len(data)
+            if self._directory is None:
+                return
+            if self._file is None:
+                self._file = open(self._chunk_file(self._chunk_start), "ab")
+            self._file.write(data)
+            self._file.flush()
+            if self.size - self._chunk_start >= LOG_CHUNK_BYTES:
+                self._seal()
+
+    def tail(self) -> str:
+        """
+        Returns the end of the log, marked as truncated if earlier output was dropped.
+
+        :rtype: str
+        """
+        with self._lock:
+            text = self._tail.decode("utf-8", errors="replace")
+            dropped = self.size - len(self._tail)
+        if dropped:
+            return f"[{dropped} bytes truncated]\n{text}"
+        return text
+
+    def close(self):
+        """
+        Seals the last chunk and marks the log as complete.
+        """
+        with self._lock:
+            if self._directory is None:
+                return
+            if self._file is not None:
+                self._seal()
+            open(os.path.join(self._directory, _COMPLETE_MARKER), "w").close()
+
+    def _chunk_file(self, start: int) -> str:
+        return os.path.join(self._directory, f"{start:012d}.log")
+
+    def _seal(self):
+        # Close the current chunk and compress it, readers switch to the .gz file
+        # once it is complete
+        self._file.close()
+        self._file = None
+        plain = self._chunk_file(self._chunk_start)
+        if LOG_COMPRESS:
+            with open(plain, "rb") as source, gzip.open(plain + ".gz.tmp", "wb") as f:
+                shutil.copyfileobj(source, f)
+            os.replace(plain + ".gz.tmp", plain + ".gz")
+            os.remove(plain)
+        self._chunk_start = self.size
+
+
+def _chunks(directory: str) -> list:
+    # (start offset, path) of the chunk files, preferring compressed ones
+    chunks = {}
+    for name in os.listdir(directory):
+        if name.endswith(".log") or name.endswith(".log.gz"):
+            start = int(name.split(".")[0])
+            if start not in chunks or name.endswith(".gz"):
+                chunks[start] = os.path.join(directory, name)
+    return sorted(chunks.items())
+
+
+def _read_chunk(path: str) -> bytes:
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return f.read()
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def log_exists(build_id: int) -> bool:
+    """
+    Checks whether a log was written for a build.
+
+    :param build_id: The id of the build
+    :type build_id: int
+    :rtype: bool
+    """
+    return os.path.isdir(log_path(build_id))
+
+
+def is_complete(build_id: int) -> bool:
+    """
+    Checks whether the log of a build is closed.
+
+    :param build_id: The id of the build
+    :type build_id: int
+    :rtype: bool
+    """
+    return os.path.exists(os.path.join(log_path(build_id), _COMPLETE_MARKER))
+
+
+def iter_log(build_id: int, offset: int = 0):
+    """
+    Reads the log of a build chunk by chunk, so a log can be served without
+    loading it into memory at once.
+
+    :param build_id: The id of the build
+    :type build_id: int
+    :param offset: Byte offset in the log to start from
+    :type offset: int
+
+    :return: Yields the contents of the chunks as bytes
+    """
+    directory = log_path(build_id)
+    position = offset
+    retry = True
+    while retry:
+        retry = False
+        chunks = _chunks(directory) if os.path.isdir(directory) else []
+        for i, (start, path) in enumerate(chunks):
+            end = chunks[i + 1][0] if i + 1 < len(chunks) else None
+            if end is not None and end <= position:
+                continue
+            try:
+                data = _read_chunk(path)
+            except FileNotFoundError:
+                # The chunk was sealed while reading, list the chunks again
+                retry = True
+                break
+            data = data[position - start :]
+            if data:
+                position += len(data)
+                yield data
+
+
+def read_log(build_id: int, offset: int = 0) -> (bytes, int, bool):
+    """
+    Reads the complete lines written to the log of a build after offset.
+
+    :param build_id: The id of the build
+    :type build_id: int
+    :param offset: Byte offset in the log to start from
+    :type offset: int
+
+    :return: The new data, ending at a line break unless the log is complete
+    :return: The offset to continue reading from
+    :return: True if the log is complete and all of it was read
+    :rtype: (bytes, int, bool)
+    """
+    complete = is_complete(build_id)
+    data = b"".join(iter_log(build_id, offset))
+    if not complete:
+        data = data[: data.rfind(b"\n") + 1]
+    return data, offset + len(data), complete
+
+
+def stream_process(
+    command: list, cwd: str, log: BuildLog, prefix: str = "", env: dict = None
+) -> int:
+    """
+    Runs a command and writes its combined stdout and stderr line by line to
+    a build log while it runs.
+
+    :param command: The command to run
+    :type command: list
+    :param cwd: Working directory of the command
+    :type cwd: str
+    :param log: The log to write the output to
+    :type log: BuildLog
+    :param prefix: Text put in front of every line
+    :type prefix: str
+    :param env: Environment of the command, the server's if None
+    :type env: dict
+
+    :raises sandbox.LimitExceeded: If the command exceeded a build limit
+
+    :return: The exit code of the command
+    :rtype: int
+    """
+    process = sandbox.Popen(
+        command,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+    with process.stdout:
+        for line in process.stdout:
+            log.write(prefix + line)
+    returncode = process.wait()
+    process.check_limits()
+    return returncode
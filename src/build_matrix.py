@@ -0,0 +1,215 @@
+import hashlib
+import itertools
+import os
+import re
+import shutil
+import sys
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# Run the cells of the build matrix a repository configures in MATRIX_CONFIG
+BUILD_MATRIX = os.getenv("CI_BUILD_MATRIX", "1") == "1"
+# Configuration file of the build matrix, relative to the repository
+MATRIX_CONFIG = ".ci.toml"
+# Cells a single push may fan out into
+MATRIX_MAX_CELLS = int(os.getenv("CI_MATRIX_MAX_CELLS", "16"))
+# Interpreters of the Python versions not found on the PATH as python<version>,
+# comma separated version=path pairs, e.g. "3.13=/opt/python3.13/bin/python3"
+PYTHON_INTERPRETERS = dict(
+    pair.strip().split("=", 1)
+    for pair in os.getenv("CI_PYTHON_INTERPRETERS", "").split(",")
+    if "=" in pair
+)
+# Commit status context of builds, matrix cells report as "CI/Test (<cell>)"
+STATUS_CONTEXT = "CI/Test"
+
+_VERSION = re.compile(r"\d+(\.\d+)*")
+_VARIABLE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+class MatrixConfigError(ValueError):
+    """Raised when the build matrix configuration of a repository is invalid."""
+
+
+def cell_name(python: str, env: dict) -> str:
+    """
+    Returns the name a matrix cell is shown and reported under.
+
+    :param python: The Python version, None for the server's interpreter
+    :type python: str
+    :param env: The environment variables of the cell
+    :type env: dict
+
+    :return: e.g. "py3.12, DJANGO=5.0"
+    :rtype: str
+    """
+    parts = [f"py{python}"] if python else []
+    parts += [f"{name}={value}" for name, value in sorted(env.items())]
+    return ", ".join(parts) or "default"
+
+
+def parse_matrix(text: str) -> list:
+    """
+    Reads the build matrix from the contents of a MATRIX_CONFIG file::
+
+        [matrix]
+        python = ["3.11", "3.12"]
+        env = [{}, {DJANGO = "5.0"}]
+
+    Every Python version is combined with every set of environment
+    variables. Both lists are optional.
+
+    :param text: The TOML configuration
+    :type text: str
+
+    :raises MatrixConfigError: If the configuration is invalid or has more
+                               than MATRIX_MAX_CELLS cells
+
+    :return: Cells as dictionaries with the name, python (None for the
+             server's interpreter) and env, empty without a matrix
+    :rtype: list
+    """
+    if tomllib is None:
+        raise MatrixConfigError(f"Reading {MATRIX_CONFIG} needs Python 3.11 or tomli")
+    try:
+        config = tomllib.loads(text)
+    except tomllib.TOMLDecodeError as e:
+        raise MatrixConfigError(f"{MATRIX_CONFIG} is not valid TOML: {e}")
+    matrix = config.get("matrix")
+    if matrix is None:
+        return []
+    if not isinstance(matrix, dict):
+        raise MatrixConfigError("matrix must be a table")
+
+    versions = matrix.get("python", [None])
+    if not isinstance(versions, list) or not versions:
+        raise MatrixConfigError("matrix.python must be a list of versions")
+    for version in versions:
+        if version is not None and not (
+            isinstance(version, str) and _VERSION.fullmatch(version)
+        ):
+            raise MatrixConfigError(f"Invalid Python version {version!r}")
+
+    environments = matrix.get("env", [{}])
+    if not isinstance(environments, list) or not environments:
+        raise MatrixConfigError("matrix.env must be a list of tables")
+    for env in environments:
+        if not isinstance(env, dict):
+            raise MatrixConfigError("matrix.env must be a list of tables")
+        for name, value in env.items():
+            if not _VARIABLE.fullmatch(name) or isinstance(value, (dict, list)):
+                raise MatrixConfigError(f"Invalid environment variable {name!r}")
+
+    cells = []
+    for python, env in itertools.product(versions, environments):
+        env = {name: str(value) for name, value in env.items()}
+        cells.append({"name": cell_name(python, env), "python": python, "env": env})
+    if len(cells) > MATRIX_MAX_CELLS:
+        raise MatrixConfigError(
+            f"The matrix has {len(cells)} cells, at most {MATRIX_MAX_CELLS} are allowed"
+        )
+    return cells
+
+
+def read_matrix(repo_path: str) -> list:
+    """
+    Reads the build matrix of a checkout, see :py:func:`parse_matrix`.
+
+    :param repo_path: Path to the repository
+    :type repo_path: str
+
+    :raises MatrixConfigError: If the configuration is invalid
+
+    :return: The cells, empty if the repository has no matrix
+    :rtype: list
+    """
+    path = os.path.join(repo_path, MATRIX_CONFIG)
+    if not os.path.isfile(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return parse_matrix(f.read())
+
+
+def find_interpreter(version: str) -> str:
+    """
+    Finds the interpreter of a Python version on this host: the one of the
+    server if it has that version, one listed in PYTHON_INTERPRETERS, or
+    python<version> on the PATH.
+
+    :param version: e.g. "3.12", None for the server's interpreter
+    :type version: str
+
+    :return: Path of the python executable, None if the version is not installed
+    :rtype: str
+    """
+    if version is None:
+        return sys.executable
+    running = ".".join(str(part) for part in sys.version_info[:3])
+    if running == version or running.startswith(version + "."):
+        return sys.executable
+    if version in PYTHON_INTERPRETERS:
+        return PYTHON_INTERPRETERS[version]
+    return shutil.which(f"python{version}")
+
+
+def env_digest(env: dict) -> str:
+    """
+    Hashes the environment variables of a cell, builds of the same tree with
+    different variables do not share results.
+
+    :param env: The environment variables
+    :type env: dict
+
+    :return: Hex digest, empty for no variables
+    :rtype: str
+    """
+    if not env:
+        return ""
+    digest = hashlib.sha256()
+    for name, value in sorted(env.items()):
+        digest.update(f"{name}={value}\0".encode())
+    return digest.hexdigest()[:12]
+
+
+def status_context(payload: dict) -> str:
+    """
+    Returns the commit status context of a build.
+
+    :param payload: The json payload of the push, with the matrix cell for
+                    builds of a matrix cell
+    :type payload: dict
+    :rtype: str
+    """
+    cell = payload.get("matrix")
+    if cell is None:
+        return STATUS_CONTEXT
+    return f"{STATUS_CONTEXT} ({cell['name']})"
+
+
+def combined_status(statuses: list) -> str:
+    """
+    Combines the outcomes of the cells of a matrix into the outcome of the
+    matrix build.
+
+    :param statuses: The outcome of every cell, "running" for unfinished ones
+    :type statuses: list
+
+    :return: "running" until every cell finished, then "superseded" if a
+             newer push superseded a cell, "error" if a cell could not be
+             built, "failure" if one failed and "success" otherwise
+    :rtype: str
+    """
+    if "running" in statuses:
+        return "running"
+    for outcome in ("superseded", "error", "timed_out", "oom"):
+        if outcome in statuses:
+            return "superseded" if outcome == "superseded" else "error"
+    if "failure" in statuses:
+        return "failure"
+    return "success"
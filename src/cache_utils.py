@@ -0,0 +1,118 @@
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, only threads of this process are locked out
+    fcntl = None
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+@contextmanager
+def cache_lock(path: str, blocking: bool = True):
+    """
+    Locks a cache entry against other threads and other processes.
+
+    The process-wide part is a lock file next to the entry, so every cache
+    root must exist before its entries are locked.
+
+    :param path: Path of the cache entry
+    :type path: str
+    :param blocking: Wait for the lock if True, give up immediately otherwise
+
+    :return: Yields True if the lock was acquired, False otherwise
+    :rtype: bool
+    """
+    with _locks_guard:
+        lock = _locks.setdefault(path, threading.Lock())
+    if not lock.acquire(blocking):
+        yield False
+        return
+    try:
+        with open(path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                try:
+                    fcntl.flock(lock_file, flags)
+                except BlockingIOError:
+                    yield False
+                    return
+            yield True
+    finally:
+        lock.release()
+
+
+def touch(path: str):
+    """
+    Marks a cache entry as recently used.
+
+    :param path: Path of the cache entry
+    :type path: str
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def directory_size(path: str) -> int:
+    """
+    Returns the total size in bytes of all files under path, symlinks are not followed.
+
+    :param path: The directory to measure
+    :type path: str
+    :rtype: int
+    """
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for file in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, file)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def evict_lru(root: str, max_bytes: int, in_use=None) -> int:
+    """
+    Deletes the least recently used entries of a cache directory until the
+    entries take up at most max_bytes. Entries that are locked or for which
+    in_use returns True are skipped.
+
+    :param root: The cache directory, every subdirectory is an entry
+    :type root: str
+    :param max_bytes: Size cap of the cache
+    :type max_bytes: int
+    :param in_use: Optional callable taking an entry path
+    :type in_use: callable
+
+    :return: The number of bytes freed
+    :rtype: int
+    """
+    if not os.path.isdir(root):
+        return 0
+
+    entries = []
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            entries.append(
+                (entry.stat().st_mtime, entry.path, directory_size(entry.path))
+            )
+    total = sum(size for _, _, size in entries)
+
+    freed = 0
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        with cache_lock(path, blocking=False) as locked:
+            if not locked or (in_use is not None and in_use(path)):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+        print(f"Evicted {path} from cache ({size} bytes)")
+        total -= size
+        freed += size
+    return freed
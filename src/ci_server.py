@@ -1,25 +1,192 @@
-from flask import Flask, request, jsonify, render_template
-import venv
-import requests
+from flask import (
+    Flask,
+    Response,
+    request,
+    jsonify,
+    render_template,
+    stream_with_context,
+)
 import subprocess
 from dotenv import load_dotenv
 import os
-import shutil
-from threading import Thread
 import sys
 
 import sqlite3
+from contextlib import closing
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 from db import *
+from scheduler import BuildScheduler, QueueFullError
+from status_client import StatusReporter
+from deliveries import DeliveryProcessor, verify_signature
+from git_cache import checkout_commit, tree_hash
+from workspace import WorkspaceManager, KEEP_FAILED_WORKSPACES
+from env_cache import prepare_environment, environment_key
+from compile_check import check_syntax, format_errors
+from pytest_runner import TEST_SHARDS, JUNIT_REPORT, run_pytest, read_junit
+from build_matrix import (
+    BUILD_MATRIX,
+    STATUS_CONTEXT,
+    MatrixConfigError,
+    read_matrix,
+    find_interpreter,
+    env_digest,
+    status_context,
+    combined_status,
+)
+from build_log import BuildLog, log_exists, iter_log, read_log
+from log_store import (
+    archive_log,
+    append_log,
+    log_size,
+    read_range,
+    prune_logs_if_due,
+)
+import resource_usage
+import sandbox
+import metrics
+from metrics import Counter, Gauge, Histogram, BUILD_BUCKETS
+from impact_analysis import (
+    TEST_IMPACT,
+    changed_files,
+    index_is_current,
+    select_tests,
+    config_hash,
+    write_coverage_config,
+    collect_coverage,
+)
 import datetime
+import hmac
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
 
 load_dotenv()
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+# Secret of the webhook, deliveries without a matching signature are rejected when set
+WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
+# Token build agents authenticate with, without it only agents on this host are accepted
+AGENT_TOKEN = os.getenv("CI_AGENT_TOKEN")
+# Address the server listens on and the number of threads serving requests
+HOST = os.getenv("CI_HOST", "127.0.0.1")
+PORT = int(os.getenv("CI_PORT", "5000"))
+HTTP_THREADS = int(os.getenv("CI_HTTP_THREADS", "16"))
+# Base URL of the github API the commit statuses are sent to
+GITHUB_API_URL = os.getenv("CI_GITHUB_API_URL", "https://api.github.com").rstrip("/")
 
 app = Flask(__name__)
 
-CLONE_DIR = "/tmp/"  # Temporary directory to clone the repo into
+# Number of builds shown per page of the build history
+BUILDS_PAGE_SIZE = 50
+# Bytes of the log shown per page on the build page
+LOG_PAGE_BYTES = 64 * 1024
+# Seconds between checks for new output when tailing a running build
+LOG_POLL_INTERVAL = 0.5
+# Seconds after which an idle log stream sends a comment to keep the connection open
+LOG_KEEPALIVE = 15
+# Recent builds of a repository the stage percentiles on the build page are taken over
+STAGE_STATS_BUILDS = 100
+# Wall-clock seconds a build and each of its stages may take before the
+# running commands are killed, 0 for no limit
+BUILD_TIMEOUT = int(os.getenv("CI_BUILD_TIMEOUT", "7200"))
+STAGE_TIMEOUTS = {
+    "checkout": int(os.getenv("CI_CHECKOUT_TIMEOUT", "600")),
+    "env": int(os.getenv("CI_ENV_TIMEOUT", "1800")),
+    "compile": int(os.getenv("CI_COMPILE_TIMEOUT", "600")),
+    "test": int(os.getenv("CI_TEST_TIMEOUT", "3600")),
+}
+# Reuse the outcome of an earlier full build of the same tree and environment
+RESULT_CACHE = os.getenv("CI_RESULT_CACHE", "1") == "1"
+# Stages whose failures are stored in the result cache, other stages, e.g.
+# the environment setup, often fail for reasons outside of the tree. Test
+# failures run again, a flaky test has to pass and fail on the same tree to be
+# detected, see get_flaky_tests
+CACHED_FAILURE_STAGES = ("compile",)
+# Recent builds of a repository a test has to flip between passing and failing on the
+# same tree in to be known as flaky
+FLAKY_WINDOW = int(os.getenv("CI_FLAKY_WINDOW", "100"))
+# Runs of failed tests that are known to be flaky before the build fails, 0 to not retry
+FLAKY_RETRIES = int(os.getenv("CI_FLAKY_RETRIES", "0"))
+# Outcomes of builds killed by a limit, github only knows them as errors
+LIMIT_DESCRIPTIONS = {
+    "timed_out": "Build timed out",
+    "oom": "Build ran out of memory",
+}
+
+# Sends the commit statuses in the background
+status_reporter = StatusReporter()
+
+# Provides the build directories and deletes them in the background
+workspaces = WorkspaceManager()
+
+# Handles the stored webhook deliveries, started in __main__
+delivery_processor = DeliveryProcessor(lambda event, body: handle_delivery(event, body))
+
+# Worker pool draining the build queue, started in __main__.
+# The callbacks are looked up on each call so they can be patched in tests.
+scheduler = BuildScheduler(
+    lambda payload, cancelled: process_request(payload, cancelled),
+    on_superseded=lambda payload, replacement: report_superseded(payload, replacement),
+    on_lease_expired=lambda job_id, build_id: abandon_remote_build(job_id, build_id),
+)
+
+# job id -> log of the builds leased to build agents
+remote_builds = {}
+remote_builds_lock = threading.Lock()
+
+WEBHOOK_DELIVERIES = Counter(
+    "ci_webhook_deliveries",
+    "Webhook requests by event type and response: accepted, duplicate, ping, "
+    "rejected (invalid signature or request) or error",
+    ("event", "result"),
+)
+BUILD_SECONDS = Histogram(
+    "ci_build_duration_seconds",
+    "Duration of the builds by outcome",
+    ("outcome",),
+    BUILD_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "ci_build_stage_duration_seconds",
+    "Duration of the build stages by stage and outcome",
+    ("stage", "outcome"),
+    BUILD_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    "ci_cache_lookups",
+    "Cache lookups of the builds by cache and result, hit or miss",
+    ("cache", "result"),
+)
+FLAKY_RETRIES_RUN = Counter(
+    "ci_flaky_test_retries",
+    "Builds whose failed tests were all known to be flaky and ran again, by result: "
+    "passed or failed",
+    ("result",),
+)
+Gauge(
+    "ci_queue_depth",
+    "Jobs in the build queue by state",
+    lambda: {(state,): scheduler.stats()[state] for state in ("queued", "running")},
+    ("state",),
+)
+Gauge(
+    "ci_active_workers",
+    "Build workers running a build",
+    lambda: scheduler.active_workers,
+)
+Gauge(
+    "ci_workspaces_active",
+    "Workspaces in use by running builds",
+    lambda: workspaces.active(),
+)
+Gauge(
+    "ci_statuses_pending",
+    "Commit statuses waiting to be sent to github",
+    lambda: status_reporter.pending(),
+)
 
 
 @app.route("/documentation")
@@ -29,136 +196,1600 @@ def documentation_view():
 
 @app.route("/builds")
 def builds_view():
+    """
+    Lists the build history newest first, one page at a time. The query
+    parameters status, commit (a prefix of the commit hash), from and to
+    (dates as YYYY-MM-DD) filter the builds, and before continues the listing
+    after the build with that id.
+
+    :return: The builds page, or 400 if a filter is malformed
+    """
+    status = request.args.get("status") or None
+    commit = request.args.get("commit", "").strip().lower() or None
+    before = request.args.get("before", type=int)
+    limit = max(1, min(request.args.get("limit", BUILDS_PAGE_SIZE, type=int), 200))
+    if before is not None and before < 1:
+        return {"error": "before must be a build id"}, 400
+    if commit is not None and not re.fullmatch("[0-9a-f]{1,40}", commit):
+        return {"error": "commit must be a prefix of a commit hash"}, 400
+    dates = {}
+    for name in ("from", "to"):
+        value = request.args.get(name) or None
+        if value is not None:
+            try:
+                datetime.date.fromisoformat(value)
+            except ValueError:
+                return {"error": f"{name} must be a date as YYYY-MM-DD"}, 400
+        dates[name] = value
+
     db = get_db()
-    builds = get_builds(db)
+    # One extra row tells whether there is another page
+    builds = list_builds(
+        db,
+        limit + 1,
+        before,
+        status,
+        commit,
+        dates["from"],
+        dates["to"],
+    )
     close_db()
-    return render_template("builds.html", builds=builds)
+    next_before = builds[limit - 1][0] if len(builds) > limit else None
+    filters = {
+        "status": status or "",
+        "commit": commit or "",
+        "from": dates["from"] or "",
+        "to": dates["to"] or "",
+    }
+    return render_template(
+        "builds.html",
+        builds=builds[:limit],
+        filters=filters,
+        next_before=next_before,
+        first_page=before is None,
+    )
 
 
 @app.route("/build/<int:build_id>", methods=["GET"])
 def build_view(build_id):
+    """
+    Shows a build with one page of its log. The log is paged with the offset
+    query parameter, by default the last page is shown. The resource usage of
+    each stage is shown next to its median and 95th percentile over the last
+    STAGE_STATS_BUILDS builds of the repository. The failed tests are listed
+    with their message, see :py:func:`summarize_failures`, and a build that
+    found a build matrix lists its cells.
+
+    :return: The build page, or 404 if the build does not exist
+    """
+    db = get_db()
+    build = get_build(db, build_id)
+    cache_events = get_cache_events(db, build_id)
+    stages = get_build_stages(db, build_id)
+    stage_stats = {}
+    failures = []
+    cells = []
+    if build is not None:
+        cells = get_matrix_cells(db, build_id)
+        stage_stats = resource_usage.stage_percentiles(
+            get_stage_usage(db, build[5], STAGE_STATS_BUILDS)
+        )
+        test_results = get_test_results(db, build_id)
+        if any(result[1] in ("failed", "error") for result in test_results):
+            flaky = {row[0] for row in get_flaky_tests(db, build[5], FLAKY_WINDOW)}
+            failures = summarize_failures(test_results, flaky)
+    size = log_size(db, build_id)
+    log_page = None
+    if size is not None:
+        offset = request.args.get("offset", max(0, size - LOG_PAGE_BYTES), type=int)
+        offset = min(max(0, offset), size)
+        text = read_range(db, build_id, offset, LOG_PAGE_BYTES)
+        log_page = {
+            "text": text.decode("utf-8", errors="replace"),
+            "start": offset,
+            "end": offset + len(text),
+            "size": size,
+            "previous": max(0, offset - LOG_PAGE_BYTES) if offset > 0 else None,
+            "next": offset + len(text) if offset + len(text) < size else None,
+        }
+    close_db()
+    if build is None:
+        return {"error": "Build not found"}, 404
+    return render_template(
+        "build.html",
+        build=build,
+        cache_events=cache_events,
+        stages=stages,
+        stage_stats=stage_stats,
+        failures=failures,
+        cells=cells,
+        log_page=log_page,
+    )
+
+
+def summarize_failures(test_results: list, flaky: set) -> list:
+    """
+    Lists the tests of a build that failed or errored in any of their runs.
+
+    :param test_results: (test id, outcome, duration, message) rows of the
+                         build in the order the tests ran
+    :type test_results: list
+    :param flaky: The tests known to be flaky in the repository
+    :type flaky: set
+
+    :return: Dictionaries with the test_id, the outcome and message of the
+             first failed run, passed_on_retry and known_flaky
+    :rtype: list
+    """
+    failures = {}
+    for test_id, outcome, _, message in test_results:
+        if test_id in failures:
+            if outcome == "passed":
+                failures[test_id]["passed_on_retry"] = True
+        elif outcome in ("failed", "error"):
+            failures[test_id] = {
+                "test_id": test_id,
+                "outcome": outcome,
+                "message": message,
+                "passed_on_retry": False,
+                "known_flaky": test_id in flaky,
+            }
+    return list(failures.values())
+
+
+@app.route("/tests/flaky", methods=["GET"])
+def flaky_tests_view():
+    """
+    Lists the tests of a repository that passed and failed on the same tree
+    within its last builds, see :py:func:`db.get_flaky_tests`. Takes the repo
+    ("owner/name") and optionally window, the number of builds, as query
+    parameters.
+
+    :return: Dictionary with the tests, each with the test_id, the number of
+             trees it flipped on and the last_build_id that ran it, or 400
+             without a repo
+    :rtype: (dict, int)
+    """
+    repo = request.args.get("repo")
+    if not repo:
+        return {"error": "repo is required"}, 400
+    window = min(request.args.get("window", FLAKY_WINDOW, type=int), 1000)
+    db = get_db()
+    rows = get_flaky_tests(db, repo, window)
+    close_db()
+    tests = [
+        {"test_id": test_id, "trees": trees, "last_build_id": last_build_id}
+        for test_id, trees, last_build_id in rows
+    ]
+    return {"repo": repo, "window": window, "tests": tests}, 200
+
+
+@app.route("/tests/history", methods=["GET"])
+def history_view():
+    """
+    Lists the runs of a test in the latest builds of a repository that ran
+    it, newest first. Takes the repo, test (the pytest node id) and
+    optionally limit as query parameters.
+
+    :return: Dictionary with the runs, each with the build_id, commit,
+             build_date, outcome, duration and message, or 400 without a repo
+             or test
+    :rtype: (dict, int)
+    """
+    repo = request.args.get("repo")
+    test_id = request.args.get("test")
+    if not repo or not test_id:
+        return {"error": "repo and test are required"}, 400
+    limit = min(request.args.get("limit", 20, type=int), 200)
+    db = get_db()
+    rows = get_test_history(db, repo, test_id, limit)
+    close_db()
+    keys = ("build_id", "commit", "build_date", "outcome", "duration", "message")
+    return {
+        "repo": repo,
+        "test": test_id,
+        "runs": [dict(zip(keys, row)) for row in rows],
+    }, 200
+
+
+def _archived_log(build_id: int, offset: int = 0):
+    # Reads an archived log in pages, yields None if the build has no archived log
+    with closing(connect()) as conn:
+        size = log_size(conn, build_id)
+        if size is None:
+            yield None
+            return
+        while offset < size:
+            data = read_range(conn, build_id, offset, LOG_PAGE_BYTES)
+            offset += len(data)
+            yield data
+
+
+@app.route("/build/<int:build_id>/log", methods=["GET"])
+def build_log_view(build_id):
+    """
+    Sends the full log of a build as plain text, streamed chunk by chunk from
+    the log directory while the build runs and from the log store afterwards.
+    Builds from before logs were kept send their stored output instead.
+
+    :return: The log, or 404 if the build does not exist
+    """
+    if log_exists(build_id):
+        return Response(iter_log(build_id), mimetype="text/plain")
+    pages = _archived_log(build_id)
+    first = next(pages)
+    if first is not None:
+        return Response(
+            stream_with_context(itertools.chain([first], pages)),
+            mimetype="text/plain",
+        )
     db = get_db()
     build = get_build(db, build_id)
     close_db()
     if build is None:
         return {"error": "Build not found"}, 404
-    return render_template("build.html", build=build)
+    return Response(build[4], mimetype="text/plain")
+
+
+def _event(offset: int, data: bytes) -> str:
+    # A Server-Sent Event with the lines of data, its id is the offset after them
+    lines = data.decode("utf-8", errors="replace").splitlines()
+    return f"id: {offset}\n" + "".join(f"data: {line}\n" for line in lines) + "\n"
+
+
+@app.route("/build/<int:build_id>/log/stream", methods=["GET"])
+def build_log_stream(build_id):
+    """
+    Tails the log of a build as Server-Sent Events. Every event holds new
+    lines of the log and its id is the offset to resume from, which browsers
+    send back as Last-Event-ID when they reconnect, an id that is not an
+    offset starts the stream over. An "end" event is sent
+    once the build has finished. Finished builds send their archived log.
+
+    :return: The event stream, or 404 if the build has no log
+    """
+    try:
+        offset = int(
+            request.headers.get("Last-Event-ID") or request.args.get("offset", 0)
+        )
+    except ValueError:
+        # Not an id this server sent, start from the beginning
+        offset = 0
+    offset = max(0, offset)
+    if not log_exists(build_id):
+        with closing(connect()) as conn:
+            if log_size(conn, build_id) is None:
+                return {"error": "Build log not found"}, 404
+
+    def archived_events(offset):
+        pending = b""
+        for data in _archived_log(build_id, offset):
+            # Events end at line breaks, the rest is sent with the next page
+            data = pending + data
+            cut = data.rfind(b"\n") + 1
+            pending = data[cut:]
+            offset += cut
+            if cut:
+                yield _event(offset, data[:cut])
+        if pending:
+            yield _event(offset + len(pending), pending)
+        yield "event: end\ndata: \n\n"
+
+    def events(offset):
+        idle = 0.0
+        while True:
+            if not log_exists(build_id):
+                # The log was archived when the build finished
+                yield from archived_events(offset)
+                return
+            data, offset, complete = read_log(build_id, offset)
+            if data:
+                idle = 0.0
+                yield _event(offset, data)
+            elif complete:
+                yield "event: end\ndata: \n\n"
+                return
+            else:
+                idle += LOG_POLL_INTERVAL
+                if idle >= LOG_KEEPALIVE:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+                time.sleep(LOG_POLL_INTERVAL)
+
+    return Response(
+        stream_with_context(events(offset)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/queue", methods=["GET"])
+def queue_view():
+    """
+    Reports the depth of the build queue and how long jobs wait for a worker,
+    also by priority class, the number of commit statuses waiting to be sent to github and the
+    latency of the database writes.
+
+    :return: Dictionary with the queue statistics
+    :rtype: dict
+    """
+    stats = scheduler.stats()
+    stats["statuses_pending"] = status_reporter.pending()
+    stats["db_writes"] = get_writer().stats()
+    return stats
 
 
 @app.route("/webhook", methods=["POST"])
 def handle_webhook():
     """
     Recieves webhook requests and handles pings and invalid requests.
-    Valid requests are proceessed in a separate thread.
+    Valid push deliveries are checked against the X-Hub-Signature-256 header
+    when GITHUB_WEBHOOK_SECRET is set, stored with their X-GitHub-Delivery id
+    and processed in the background, see :py:func:`handle_delivery`.
+    Redeliveries of a stored delivery are acknowledged without processing.
 
     :return: Dictionary with a message responding to the request
     :return: Status code of the request
     :rtype: (dict, int)
     """
-
+    body = request.get_data()
     event = request.headers.get("X-GitHub-Event", "")
+    # Other events are counted together, the header is not trusted
+    event_label = event if event in ("push", "ping") else "other"
+    if WEBHOOK_SECRET and not verify_signature(
+        body, request.headers.get("X-Hub-Signature-256"), WEBHOOK_SECRET
+    ):
+        WEBHOOK_DELIVERIES.inc(event=event_label, result="rejected")
+        return {"error": "Invalid signature"}, 401
+
     content_type = request.headers.get("Content-Type", "")
 
     # Respond to pings
     if event == "ping":
+        WEBHOOK_DELIVERIES.inc(event=event_label, result="ping")
         return {"message": "Server running"}, 200
 
     # Handle push events
     if event != "push":
+        WEBHOOK_DELIVERIES.inc(event=event_label, result="rejected")
         return {"error": "Invalid event type"}, 400
     if content_type != "application/json":
+        WEBHOOK_DELIVERIES.inc(event=event_label, result="rejected")
         return {"error": "Invalid content type"}, 400
-    payload = request.get_json()
 
-    # Format the response url
-    repo_owner = payload["repository"]["owner"]["login"]
-    repo_name = payload["repository"]["name"]
-    commit_sha = payload["after"]
+    delivery_id = request.headers.get("X-GitHub-Delivery") or str(uuid.uuid4())
+    try:
+        stored = get_writer().write(
+            insert_delivery, delivery_id, event, body, time.time()
+        )
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        WEBHOOK_DELIVERIES.inc(event=event_label, result="error")
+        return {"error": "Delivery could not be stored"}, 503, {"Retry-After": "60"}
+    if not stored:
+        WEBHOOK_DELIVERIES.inc(event=event_label, result="duplicate")
+        return {"message": "Duplicate delivery", "delivery_id": delivery_id}, 200
+    delivery_processor.notify()
+    WEBHOOK_DELIVERIES.inc(event=event_label, result="accepted")
+    return {"message": "Processing started", "delivery_id": delivery_id}, 202
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_view():
+    """
+    Exposes the counters, gauges and histograms of the server in the
+    Prometheus text format: webhook deliveries, queue depth, active workers,
+    build and stage durations, cache lookups, github requests and database
+    latency.
+
+    :return: The metrics as text/plain
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def _agent_authorized() -> bool:
+    # Without a token no agent is accepted, behind a tunnel every request
+    # comes from the loopback address
+    if not AGENT_TOKEN:
+        return False
+    return hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {AGENT_TOKEN}"
+    )
+
+
+@app.route("/agent/lease", methods=["POST"])
+def agent_lease_view():
+    """
+    Leases the next queued build to a build agent, see :py:mod:`agent`. The
+    build is added to the build history as running and its log is written by
+    the heartbeats of the agent.
+
+    :return: Dictionary with the job_id, build_id, payload, lease_token,
+             lease_seconds, the test file durations and the flaky tests of the
+             repository, 204 if the queue is empty, 403 if the agent is not
+             authorized
+    :rtype: (dict, int)
+    """
+    if not _agent_authorized():
+        return {"error": "Not authorized"}, 403
+    agent = (request.get_json(silent=True) or {}).get("agent") or request.remote_addr
+    job = scheduler.lease(agent)
+    if job is None:
+        return "", 204
+    payload = job["payload"]
+    state = new_build_state(payload)
+    build_id = start_build(payload["after"], state["repo"], cell_build(payload))
+    durations = {}
+    flaky_tests = []
+    try:
+        get_writer().write(set_job_build, job["job_id"], build_id)
+        with closing(connect()) as conn:
+            durations = get_test_file_durations(conn, state["repo"])
+            flaky_tests = [
+                row[0] for row in get_flaky_tests(conn, state["repo"], FLAKY_WINDOW)
+            ]
+    except sqlite3.Error as e:
+        print("Database error:", e)
+    log = BuildLog(build_id)
+    log.write(f"Building on agent {agent}\n")
+    with remote_builds_lock:
+        remote_builds[job["job_id"]] = log
+    job.update(build_id=build_id, durations=durations, flaky_tests=flaky_tests)
+    return job, 200
+
+
+@app.route("/agent/jobs/<int:job_id>/heartbeat", methods=["POST"])
+def agent_heartbeat_view(job_id):
+    """
+    Renews the lease of a build agent on a job and appends the output the
+    agent sent to the build log.
+
+    :return: Dictionary with cancelled, True if the agent has to abort the
+             build because a newer push superseded it, 409 if the lease was
+             lost, 403 if the agent is not authorized
+    :rtype: (dict, int)
+    """
+    if not _agent_authorized():
+        return {"error": "Not authorized"}, 403
+    data = request.get_json(silent=True) or {}
+    if not scheduler.renew(job_id, data.get("lease_token")):
+        return {"error": "Lease lost"}, 409
+    with remote_builds_lock:
+        log = remote_builds.get(job_id)
+    if log is not None and data.get("log"):
+        log.write(data["log"])
+    return {"cancelled": scheduler.is_cancelled(job_id)}, 200
+
+
+@app.route("/agent/jobs/<int:job_id>/result", methods=["POST"])
+def agent_result_view(job_id):
+    """
+    Publishes a build a build agent finished, see :py:func:`report_build`.
+    The agent sends the rest of the log and the parts of the build state
+    that are stored in the build history.
+
+    :return: Dictionary with the status of the build, 409 if the lease was
+             lost and the job is built again, 403 if the agent is not
+             authorized
+    :rtype: (dict, int)
+    """
+    if not _agent_authorized():
+        return {"error": "Not authorized"}, 403
+    data = request.get_json(silent=True) or {}
+    token = data.get("lease_token")
+    if not scheduler.renew(job_id, token):
+        return {"error": "Lease lost"}, 409
+    with closing(connect()) as conn:
+        job = get_job(conn, job_id)
+    build_id = job[12]
+    state = new_build_state(json.loads(job[1]))
+    with remote_builds_lock:
+        state["log"] = remote_builds.pop(job_id, None) or BuildLog(build_id)
+    if data.get("log"):
+        state["log"].write(data["log"])
+    for key in (
+        "stages",
+        "cache_events",
+        "test_results",
+        "scope",
+        "cached_from",
+        "matrix",
+    ):
+        if key in data:
+            state[key] = data[key]
+    if data.get("result_key"):
+        state["result_key"] = tuple(data["result_key"])
+    status = data.get("status", "error")
+    code = report_build(state, status, build_id)
+    scheduler.complete(job_id, token, "done" if code != 500 else "failed")
+    return {"status": status}, 200
+
+
+@app.route("/agent/results", methods=["GET"])
+def agent_results_view():
+    """
+    Looks up the result cache for a build agent, see
+    :py:func:`stage_result_cache`. Takes the repo, tree and env query
+    parameters.
+
+    :return: Dictionary with the build_id and status of the earlier build,
+             404 on a miss, 403 if the agent is not authorized
+    :rtype: (dict, int)
+    """
+    if not _agent_authorized():
+        return {"error": "Not authorized"}, 403
+    key = (request.args.get("tree"), request.args.get("env"))
+    try:
+        cached = find_build_result(request.args.get("repo"), key)
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        return {"error": "Database error"}, 503
+    if cached is None:
+        return {"error": "No result"}, 404
+    return {"build_id": cached[0], "status": cached[1]}, 200
+
+
+def abandon_remote_build(job_id: int, build_id: int):
+    """
+    Marks the build of a job as an error when the build agent running it
+    stopped renewing its lease. The job itself is queued again by the
+    scheduler and gets a new build.
+
+    :param job_id: The job whose lease expired
+    :type job_id: int
+    :param build_id: The build row of the job
+    :type build_id: int
+    """
+    with remote_builds_lock:
+        log = remote_builds.pop(job_id, None) or BuildLog()
+    log.write("The build agent stopped responding, the build was queued again\n")
+    log.close()
+    if build_id is None:
+        return
+    output = archive_build_log(build_id, log)
+    try:
+        get_writer().write(update_build, build_id, "error", output)
+    except sqlite3.Error as e:
+        print("Database error:", e)
+
+
+def handle_delivery(event: str, body: bytes) -> (str, int):
+    """
+    Processes a stored push delivery: sets the commit status to pending and
+    adds the build to the build queue. When the queue is full the commit
+    status is set to error instead.
+
+    :param event: The X-GitHub-Event of the delivery
+    :type event: str
+    :param body: The raw json payload
+    :type body: bytes
+
+    :return: "queued", "rejected" if the queue was full or "ignored" if the
+             payload is not a push
+    :return: The id of the queued job, None if no job was queued
+    :rtype: (str, int)
+    """
+    payload = json.loads(body)
+    try:
+        repo_owner = payload["repository"]["owner"]["login"]
+        repo_name = payload["repository"]["name"]
+        commit_sha = payload["after"]
+    except (KeyError, TypeError):
+        return "ignored", None
     status_url = (
-        f"https://api.github.com/repos/{repo_owner}/{repo_name}/statuses/{commit_sha}"
+        f"{GITHUB_API_URL}/repos/{repo_owner}/{repo_name}/statuses/{commit_sha}"
     )
 
     # Set as pending while processing
     update_github_status(status_url, "pending", GITHUB_TOKEN)
-    thread = Thread(target=process_request, args=(payload,))
-    thread.start()
-    return {"message": "Processing started"}, 202
+    try:
+        job_id = scheduler.submit(payload)
+    except QueueFullError as e:
+        print(f"Push {commit_sha} rejected: {e}")
+        update_github_status(status_url, "error", GITHUB_TOKEN)
+        return "rejected", None
+    return "queued", job_id
+
 
+def report_superseded(payload: dict, replacement: dict):
+    """
+    Sets the status of a commit whose build was skipped because a newer push
+    to the same branch superseded it. The status links to the replacing commit.
 
-def process_request(payload: dict) -> int:
+    :param payload: The json payload of the superseded push
+    :type payload: dict
+    :param replacement: The json payload of the push that replaced it
+    :type replacement: dict
+    """
+    update_github_status(
+        commit_status_url(payload),
+        "error",
+        GITHUB_TOKEN,
+        **_superseded_by(replacement),
+        **_cell_context(payload),
+    )
+    cell = payload.get("matrix")
+    if cell is not None:
+        try:
+            get_writer().write(set_build_status, cell["build_id"], "superseded")
+        except sqlite3.Error as e:
+            print("Database error:", e)
+        finish_matrix(payload, replacement)
+
+
+def _superseded_by(replacement: dict) -> dict:
+    # Description and link of the status of a superseded build
+    if replacement is None:
+        return {"description": "Skipped, superseded by a newer push"}
+    repo_owner = replacement["repository"]["owner"]["login"]
+    repo_name = replacement["repository"]["name"]
+    new_sha = replacement["after"]
+    description = f"Skipped, superseded by {new_sha[:7]}"
+    if replacement.get("matrix") is not None:
+        description += f" (build #{replacement['matrix']['parent']})"
+    return {
+        "description": description,
+        "target_url": f"https://github.com/{repo_owner}/{repo_name}/commit/{new_sha}",
+    }
+
+
+def _cell_context(payload: dict) -> dict:
+    # Cells of a build matrix report under a status context of their own
+    if payload.get("matrix") is None:
+        return {}
+    return {"context": status_context(payload)}
+
+
+def process_request(payload: dict, cancelled=None) -> int:
     """
-    Processes webhook push event request.
+    Processes webhook push event request by running the build pipeline.
 
     :param payload: The json payload of the request
     :type payload: dict
+    :param cancelled: Set by the scheduler when a newer push supersedes this build,
+                      the build then stops and kills its running commands
+    :type cancelled: threading.Event
+
+    :return: Status code of the request, 200 on success, 500 on fail,
+             409 if the build was superseded
+    :rtype: int
+    """
+    print("\n\n\n", commit_status_url(payload), "\n\n\n")
+
+    state = new_build_state(payload)
+    build_id = start_build(payload["after"], state["repo"], cell_build(payload))
+    state["log"] = BuildLog(build_id)
+    status = execute_build(state, cancelled)
+    return report_build(state, status, build_id)
+
+
+def cell_build(payload: dict) -> int:
+    """
+    Returns the build row :py:func:`start_matrix` created for a matrix cell.
+
+    :param payload: The json payload of the push event
+    :type payload: dict
 
-    :return: Status code of the request, 200 on success, 500 on fail
+    :return: The id of the build, None if the push is not a matrix cell
     :rtype: int
     """
-    clone_url = payload["repository"]["clone_url"]
+    cell = payload.get("matrix")
+    return cell["build_id"] if cell is not None else None
+
+
+def commit_status_url(payload: dict) -> str:
+    """
+    Returns the github API endpoint for the statuses of the pushed commit.
+
+    :param payload: The json payload of the push event
+    :type payload: dict
+    :rtype: str
+    """
     repo_owner = payload["repository"]["owner"]["login"]
     repo_name = payload["repository"]["name"]
     commit_sha = payload["after"]
-    status_url = (
-        f"https://api.github.com/repos/{repo_owner}/{repo_name}/statuses/{commit_sha}"
+    return f"{GITHUB_API_URL}/repos/{repo_owner}/{repo_name}/statuses/{commit_sha}"
+
+
+def execute_build(state: dict, cancelled=None) -> str:
+    """
+    Runs the build pipeline, see :py:func:`run_pipeline`, and releases the
+    workspace of the build. Used by the build workers and the build agents,
+    see :py:mod:`agent`.
+
+    :param state: The build state, see :py:func:`new_build_state`
+    :type state: dict
+    :param cancelled: When set the pipeline stops and kills the running stage
+    :type cancelled: threading.Event
+
+    :return: The outcome of the build
+    :rtype: str
+    """
+    status = run_pipeline(state, cancelled)
+    if state["repo_path"] is not None:
+        workspaces.release(
+            state["repo_path"],
+            state["payload"]["repository"]["clone_url"],
+            keep=KEEP_FAILED_WORKSPACES and status not in ("success", "superseded"),
+        )
+    return status
+
+
+def report_build(state: dict, status: str, build_id: int) -> int:
+    """
+    Publishes a finished build: archives its log, sets the commit status on
+    github, stores the build in the build history and records its metrics.
+
+    A build that found a build matrix stays in the history with the status
+    "matrix" and queues its cells, see :py:func:`start_matrix`. The last cell
+    to finish sets the combined status, see :py:func:`finish_matrix`.
+
+    :param state: The state of the finished build
+    :type state: dict
+    :param status: The outcome of the build
+    :type status: str
+    :param build_id: The build row created by :py:func:`start_build`
+    :type build_id: int
+
+    :return: Status code of the request, 200 on success, 500 on fail,
+             409 if the build was superseded
+    :rtype: int
+    """
+    payload = state["payload"]
+    status_url = commit_status_url(payload)
+    BUILD_SECONDS.observe(sum(stage[3] for stage in state["stages"]), outcome=status)
+    for stage, outcome, _, duration, *_ in state["stages"]:
+        if outcome != "skipped":
+            STAGE_SECONDS.observe(duration, stage=stage, outcome=outcome)
+    for cache, hit in state["cache_events"]:
+        CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss")
+    state["log"].close()
+    output = archive_build_log(build_id, state["log"], state["cached_from"])
+
+    context = _cell_context(payload)
+    if status in LIMIT_DESCRIPTIONS:
+        update_github_status(
+            status_url,
+            "error",
+            GITHUB_TOKEN,
+            description=LIMIT_DESCRIPTIONS[status],
+            **context,
+        )
+    elif state["cached_from"] is not None:
+        update_github_status(
+            status_url,
+            status,
+            GITHUB_TOKEN,
+            description=f"CI test results of build {state['cached_from']}",
+            **context,
+        )
+    elif status not in ("superseded", "matrix"):
+        update_github_status(status_url, status, GITHUB_TOKEN, **context)
+    if status == "matrix":
+        # The cells need their rows before the matrix build is stored as "matrix"
+        cells = create_matrix_cells(state, build_id)
+    record_build(
+        payload["after"],
+        status,
+        output,
+        state["cache_events"],
+        state["stages"],
+        state["test_results"],
+        state["repo"],
+        state["scope"],
+        build_id,
+        state["cached_from"],
+        state["result_key"] if is_reusable(state, status) else None,
+        state["result_key"][0] if state["result_key"] else None,
+    )
+    if status == "matrix":
+        start_matrix(state, build_id, cells)
+        print("message", f"Build matrix of {len(cells)} cells queued")
+        return 200
+    if payload.get("matrix") is not None:
+        finish_matrix(payload)
+    if status == "superseded":
+        print("message", "Build superseded")
+        return 409
+    if status == "error":
+        print("error", "Build could not be completed")
+        return 500
+    if status == "success":
+        print("message", "Build and tests successful")
+    elif status in LIMIT_DESCRIPTIONS:
+        print("message", LIMIT_DESCRIPTIONS[status])
+    else:
+        print("message", "Build/tests failed")
+    return 200
+
+
+def new_build_state(payload: dict) -> dict:
+    """
+    Creates the state that the pipeline stages share during one build.
+
+    :param payload: The json payload of the push event
+    :type payload: dict
+
+    :return: Dictionary with the payload and repo ("owner/name"), the repo_path,
+             python executable, compile_errors, test_results, scope,
+             result_key, cached_from and the cells of a build matrix filled in
+             by the stages, the interpreter the environment is created with
+             and the test_env variables, set for matrix cells, the log the
+             stages write their output to, and the cache_events and stages
+             collected for the build history. The test file durations and
+             flaky_tests, None to read them from the database, and
+             find_result, which looks up the result cache, are replaced on
+             build agents
+    :rtype: dict
+    """
+    repository = payload.get("repository", {})
+    return {
+        "payload": payload,
+        "repo": f"{repository.get('owner', {}).get('login')}/{repository.get('name')}",
+        "repo_path": None,
+        "python": None,
+        "compile_errors": [],
+        "test_results": [],
+        "scope": "full",
+        "result_key": None,
+        "cached_from": None,
+        "durations": None,
+        "flaky_tests": None,
+        "find_result": find_build_result,
+        "matrix": None,
+        "interpreter": sys.executable,
+        "test_env": {},
+        "log": BuildLog(),
+        "cache_events": [],
+        "stages": [],
+    }
+
+
+def stage_checkout(state: dict) -> str:
+    """
+    Checks out the pushed commit, see :py:func:`clone_repo`.
+
+    :return: "success", or "error" if the commit could not be checked out
+    :rtype: str
+    """
+    payload = state["payload"]
+    cloned, repo_path = clone_repo(
+        payload["repository"]["clone_url"],
+        payload["after"],
+        payload["repository"]["name"],
+    )
+    state["repo_path"] = repo_path
+    if not cloned:
+        state["log"].write("Cloning failed\n")
+        return "error"
+    return "success"
+
+
+def stage_matrix(state: dict) -> str:
+    """
+    Reads the build matrix of the repository, see
+    :py:func:`build_matrix.read_matrix`. A matrix of several cells is stored
+    in state["matrix"] and ends the build, every cell is then built on its
+    own. A matrix of one cell, and every cell, sets the interpreter and the
+    test_env of the build.
+
+    :return: "success", "matrix" if the cells have to be queued, "failure"
+             if the configuration is invalid or "error" if the Python version
+             of the cell is not installed
+    :rtype: str
+    """
+    cell = state["payload"].get("matrix")
+    if cell is None:
+        if not BUILD_MATRIX:
+            return "success"
+        try:
+            cells = read_matrix(state["repo_path"])
+        except MatrixConfigError as e:
+            state["log"].write(f"Invalid build matrix: {e}\n")
+            return "failure"
+        if len(cells) > 1:
+            state["matrix"] = cells
+            state["log"].write(
+                f"Build matrix of {len(cells)} cells, each is built on its own:\n"
+                + "".join(f"  {cell['name']}\n" for cell in cells)
+            )
+            return "matrix"
+        if not cells:
+            return "success"
+        cell = cells[0]
+
+    interpreter = find_interpreter(cell["python"])
+    if interpreter is None:
+        state["log"].write(f"Python {cell['python']} is not installed on this host\n")
+        return "error"
+    state["interpreter"] = interpreter
+    state["test_env"] = cell["env"]
+    state["log"].write(f"Matrix cell {cell['name']} with {interpreter}\n")
+    return "success"
+
+
+def stage_result_cache(state: dict) -> str:
+    """
+    Looks up the outcome of an earlier full build of the same tree with the
+    same environment, e.g. of the commit a revert restores or of the branch
+    a merge brings in unchanged. On a hit the build takes over that outcome
+    and its log, state["cached_from"] is set to the earlier build and the
+    remaining stages are skipped.
+
+    The key of the build, the tree hash and the environment key, is stored in
+    state["result_key"], see :py:func:`env_cache.environment_key`. The
+    environment key includes the test_env of a matrix cell.
+
+    :return: "success" if the build has to run, otherwise the stored outcome
+    :rtype: str
+    """
+    if not RESULT_CACHE:
+        return "success"
+    repo_path = state["repo_path"]
+    try:
+        env_key = environment_key(
+            repo_path, python=state["interpreter"], extra_packages=build_packages()
+        )
+        if state["test_env"]:
+            env_key += "-" + env_digest(state["test_env"])
+        state["result_key"] = (tree_hash(repo_path), env_key)
+        cached = state["find_result"](state["repo"], state["result_key"])
+    except (subprocess.CalledProcessError, OSError, sqlite3.Error) as e:
+        print(f"Result cache unavailable: {e}")
+        return "success"
+    state["cache_events"].append(("result", cached is not None))
+    if cached is None:
+        return "success"
+    state["cached_from"], status = cached
+    state["log"].write(
+        f"Tree {state['result_key'][0]} was built with the same environment "
+        f"by build {state['cached_from']}, reusing its result: {status}\n\n"
     )
-    print("\n\n\n", status_url, "\n\n\n")
+    return status
+
+
+def find_build_result(repo: str, result_key: tuple) -> tuple:
+    """
+    Looks up the result cache in the database, see :py:func:`db.get_build_result`.
+
+    :param repo: The repository, "owner/name"
+    :type repo: str
+    :param result_key: The tree hash and environment key
+    :type result_key: tuple
+
+    :return: The (build id, status) of the earlier build, None on a miss
+    :rtype: tuple
+    """
+    with closing(connect()) as conn:
+        return get_build_result(conn, repo, *result_key)
+
+
+def is_reusable(state: dict, status: str) -> bool:
+    """
+    Returns whether later builds of the same tree may reuse the outcome of a
+    build: successes and failures of the compile stage of full builds that
+    did not reuse a result themselves. Test failures are built again so flaky
+    tests show up, see :py:func:`known_flaky_tests`.
+
+    :param state: The state of the finished build
+    :type state: dict
+    :param status: The outcome of the build
+    :type status: str
+    :rtype: bool
+    """
+    if state["result_key"] is None or state["cached_from"] is not None:
+        return False
+    if state["scope"] != "full":
+        return False
+    if status == "failure":
+        failed = [stage for stage, outcome, *_ in state["stages"] if outcome == status]
+        # Agents may report a failure without the stage that failed
+        return bool(failed) and failed[-1] in CACHED_FAILURE_STAGES
+    return status == "success"
+
+
+def build_packages() -> tuple:
+    """
+    Returns the packages installed into build environments in addition to
+    the requirements. Full runs in test impact mode trace the tests with
+    coverage.
+
+    :rtype: tuple
+    """
+    return ("coverage",) if TEST_IMPACT else ()
+
+
+def stage_env(state: dict) -> str:
+    """
+    Sets up the virtual environment once for the compile and test stages,
+    see :py:func:`env_cache.prepare_environment`.
+
+    :return: "success", or "failure" if the requirements could not be installed
+    :rtype: str
+    """
+    try:
+        state["python"], hit = prepare_environment(
+            state["repo_path"],
+            python=state["interpreter"],
+            extra_packages=build_packages(),
+        )
+    except subprocess.CalledProcessError as e:
+        state["log"].write(f"Failed to set up the environment: {e}\n")
+        return "failure"
+    state["cache_events"].append(("env", hit))
+    return "success"
+
+
+def stage_compile(state: dict) -> str:
+    """
+    Runs the syntax check, see :py:func:`compile_check.check_syntax`.
+    The errors are stored in state["compile_errors"].
+
+    :return: "success", or "failure" if a file does not compile
+    :rtype: str
+    """
+    errors, stats = check_syntax(state["repo_path"], state["python"])
+    state["compile_errors"] = errors
+    state["cache_events"].append(("compile", stats["cached"] == stats["files"]))
+    if errors:
+        state["log"].write(f"Syntax check failed:\n{format_errors(errors)}\n")
+        return "failure"
+    return "success"
+
+
+def stage_test(state: dict) -> str:
+    """
+    Runs the test suite, see :py:func:`run_tests`. The shards are balanced by
+    the runtime of the test files in earlier builds of the repository, and the
+    results of the test cases are stored in state["test_results"].
+
+    In test impact mode only the test files affected by the changes since the
+    last full run run and state["scope"] is set to "partial", see
+    :py:func:`impact_analysis.select_tests`. The full suite runs under
+    coverage when the index is missing or stale, and then rebuilds the index.
+
+    When every failed test is known to be flaky the failed tests run again,
+    see :py:func:`retry_flaky_tests`.
+
+    :return: "success", or "failure" if a test fails
+    :rtype: str
+    """
+    repo_path = state["repo_path"]
+    payload = state["payload"]
+    durations = state["durations"]
+    index = None
     try:
-        # Try cloning the repo
-        cloned, repo_path = clone_repo(clone_url, commit_sha, repo_name)
-        if not cloned:
-            update_github_status(status_url, "error", GITHUB_TOKEN)
-            print("error", "Cloning failed")
-            return 500
-
-        # Try building and testing the repo
-        tests, testsOutput = run_tests(repo_path)
-
-        if build_project(repo_path) and tests:
-            # Success if cloned and successfully built and tested
-            update_github_status(status_url, "success", GITHUB_TOKEN)
+        with closing(connect()) as conn:
+            if durations is None:
+                durations = get_test_file_durations(conn, state["repo"])
+            if TEST_IMPACT:
+                index = get_test_impact_index(conn, state["repo"])
+    except sqlite3.Error as e:
+        print("Database error:", e)
+    durations = durations or {}
+
+    selected = None
+    if TEST_IMPACT and index is not None:
+        if index_is_current(repo_path, index[0], payload["after"]):
+            # Everything since the last full run, the index does not know the
+            # tests added or edited by the partial runs in between
+            changed = changed_files(repo_path, index[0], payload["after"])
+            selected = select_tests(index, changed, config_hash(repo_path))
+        else:
+            state["log"].write(
+                f"The test impact index of {index[0][:7]} is out of date.\n"
+            )
+    if selected is not None:
+        state["scope"] = "partial"
+        selected = [f for f in selected if os.path.exists(os.path.join(repo_path, f))]
+        if not selected:
+            state["log"].write("No tests are affected by the changes.\n")
+            return "success"
+        print(f"Running {len(selected)} affected test file(s)")
+
+    coverage_rc = None
+    if TEST_IMPACT and selected is None:
+        coverage_rc = write_coverage_config(repo_path)
+
+    passed, _ = run_tests(
+        repo_path,
+        state["python"],
+        durations=durations,
+        tests=selected,
+        coverage_rc=coverage_rc,
+        log=state["log"],
+        env=state["test_env"],
+    )
+    state["test_results"] = read_junit(os.path.join(repo_path, JUNIT_REPORT))
+
+    if coverage_rc is not None:
+        test_files = {result[0].split("::")[0] for result in state["test_results"]}
+        mapping = collect_coverage(repo_path, state["python"], coverage_rc, test_files)
+        if mapping:
             try:
-                with app.app_context():
-                    db_conn = get_db()
-                    insert_build(
-                        db_conn,
-                        commit_sha,
-                        datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "success",
-                        testsOutput,
-                    )
+                get_writer().write(
+                    replace_test_impact_index,
+                    state["repo"],
+                    payload["after"],
+                    config_hash(repo_path),
+                    mapping,
+                )
             except sqlite3.Error as e:
                 print("Database error:", e)
-            print("message", "Build and tests successful")
-            return 200
+
+    if not passed and FLAKY_RETRIES > 0:
+        passed = retry_flaky_tests(state)
+    return "success" if passed else "failure"
+
+
+def failed_tests(test_results: list) -> set:
+    """
+    Returns the tests that failed or errored in their last run.
+
+    :param test_results: (test id, outcome, duration, message) tuples in the
+                         order the tests ran
+    :type test_results: list
+    :rtype: set
+    """
+    outcomes = {test_id: outcome for test_id, outcome, *_ in test_results}
+    return {
+        test_id
+        for test_id, outcome in outcomes.items()
+        if outcome in ("failed", "error")
+    }
+
+
+def known_flaky_tests(state: dict) -> set:
+    """
+    Returns the tests of the repository that passed and failed on the same
+    tree in the last FLAKY_WINDOW builds, see :py:func:`db.get_flaky_tests`.
+
+    :param state: The build state, state["flaky_tests"] is used when set
+    :type state: dict
+    :rtype: set
+    """
+    if state["flaky_tests"] is not None:
+        return set(state["flaky_tests"])
+    try:
+        with closing(connect()) as conn:
+            rows = get_flaky_tests(conn, state["repo"], FLAKY_WINDOW)
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        return set()
+    return {row[0] for row in rows}
+
+
+def retry_flaky_tests(state: dict) -> bool:
+    """
+    Runs the failed tests of a build again, up to FLAKY_RETRIES times, if all
+    of them are known to be flaky. A build that also fails other tests is not
+    retried. The results of the retries are added to state["test_results"],
+    so a test that passes on a retry is seen as flaky from then on.
+
+    :param state: The build state after the test run
+    :type state: dict
+
+    :return: True if the failed tests passed on a retry
+    :rtype: bool
+    """
+    failed = failed_tests(state["test_results"])
+    if not failed or not failed <= known_flaky_tests(state):
+        return False
+    for attempt in range(FLAKY_RETRIES):
+        state["log"].write(
+            f"\nRetrying {len(failed)} known flaky test(s) "
+            f"({attempt + 1}/{FLAKY_RETRIES}):\n"
+            + "".join(f"  {t}\n" for t in sorted(failed))
+        )
+        passed, _ = run_tests(
+            state["repo_path"],
+            state["python"],
+            shards=1,
+            tests=sorted(failed),
+            log=state["log"],
+            env=state["test_env"],
+        )
+        results = read_junit(os.path.join(state["repo_path"], JUNIT_REPORT))
+        state["test_results"] = list(state["test_results"]) + results
+        failed = failed_tests(results)
+        if passed and not failed:
+            FLAKY_RETRIES_RUN.inc(result="passed")
+            return True
+    FLAKY_RETRIES_RUN.inc(result="failed")
+    return False
+
+
+# The stages of a build in the order they run, a stage only runs if all earlier ones succeeded
+BUILD_PIPELINE = [
+    ("checkout", stage_checkout),
+    ("matrix", stage_matrix),
+    ("result_cache", stage_result_cache),
+    ("env", stage_env),
+    ("compile", stage_compile),
+    ("test", stage_test),
+]
+
+
+def run_pipeline(state: dict, cancelled=None) -> str:
+    """
+    Runs the build stages in order and records the outcome, timing and
+    resource usage of each in state["stages"], see
+    :py:func:`resource_usage.measure`. Once a stage fails the remaining ones
+    are skipped.
+
+    The commands of a stage run with the build limits, see
+    :py:func:`sandbox.limit`, and are killed after STAGE_TIMEOUTS or once the
+    build has taken BUILD_TIMEOUT. A stage that exceeded a limit ends with
+    "timed_out" or "oom". Once cancelled is set the commands of the running
+    stage are killed as well and the build ends as "superseded", whatever
+    the stage returned.
+
+    When :py:func:`stage_result_cache` reused the outcome of an earlier build
+    the remaining stages are skipped as well.
+
+    :param state: The build state, see :py:func:`new_build_state`
+    :type state: dict
+    :param cancelled: When set the pipeline stops and kills the running stage
+    :type cancelled: threading.Event
+
+    :return: "success", "failure", "error", "timed_out", "oom" or
+             "superseded"
+    :rtype: str
+    """
+    status = "success"
+    deadline = time.monotonic() + BUILD_TIMEOUT if BUILD_TIMEOUT else None
+    for stage, function in BUILD_PIPELINE:
+        if status != "success" or state["cached_from"] is not None:
+            state["stages"].append((stage, "skipped", None, 0.0, None, None, None))
+            continue
+        if cancelled is not None and cancelled.is_set():
+            return "superseded"
+
+        timeout = STAGE_TIMEOUTS.get(stage) or None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        started_at = time.time()
+        start = time.perf_counter()
+        with resource_usage.measure() as usage, sandbox.limit(
+            timeout, cancelled=cancelled
+        ):
+            try:
+                status = function(state)
+            except sandbox.LimitExceeded as e:
+                print(f"Stage {stage} stopped: {e}")
+                state["log"].write(f"{stage} stage stopped: {e}\n")
+                status = e.status
+            except Exception as e:
+                print(f"Stage {stage} raised an exception: {e}")
+                state["log"].write(f"{stage} stage failed: {e}\n")
+                status = "error"
+        duration = time.perf_counter() - start
+        state["stages"].append(
+            (
+                stage,
+                status,
+                started_at,
+                duration,
+                usage["cpu_time"],
+                usage["max_rss"],
+                usage["downloaded"],
+            )
+        )
+        summary = (
+            f"{status} in {duration:.2f}s, cpu {usage['cpu_time']:.2f}s, "
+            f"peak rss {usage['max_rss'] // 1024} MiB, downloaded {usage['downloaded']} bytes"
+        )
+        print(f"Stage {stage}: {summary}")
+        state["log"].write(f"== {stage}: {summary} ==\n")
+    if cancelled is not None and cancelled.is_set():
+        # A newer push superseded the build while its last stage ran
+        return "superseded"
+    return status
+
+
+def archive_build_log(build_id: int, log: BuildLog, cached_from: int = None) -> str:
+    """
+    Moves the log of a finished build into the log store, see
+    :py:func:`log_store.archive_log`, and applies the log retention policy
+    when it is due.
+
+    :param build_id: The id of the build, None if the build was not stored
+    :type build_id: int
+    :param log: The closed log of the build
+    :type log: BuildLog
+    :param cached_from: The build whose result was reused, its log is
+                        appended, see :py:func:`log_store.append_log`
+    :type cached_from: int
+
+    :return: The output to store in the build row, empty once the log is
+             archived and the tail of the log otherwise
+    :rtype: str
+    """
+    if build_id is None:
+        return log.tail()
+    try:
+        with closing(connect()) as conn:
+            archive_log(conn, build_id)
+            if cached_from is not None:
+                append_log(conn, build_id, cached_from)
+            prune_logs_if_due(conn)
+        return ""
+    except (sqlite3.Error, OSError) as e:
+        print(f"Could not archive the log of build {build_id}: {e}")
+        return log.tail()
+
+
+def start_build(commit_sha: str, repo: str = None, build_id: int = None) -> int:
+    """
+    Adds a build to the build history with the status "running", so it can
+    be followed while it runs.
+
+    :param commit_sha: The commit that is built
+    :type commit_sha: str
+    :param repo: The repository, "owner/name"
+    :type repo: str
+    :param build_id: A build row created in advance, e.g. for a matrix cell,
+                     which is marked as running instead
+    :type build_id: int
+
+    :return: The id of the build, None if it could not be stored
+    :rtype: int
+    """
+    try:
+        if build_id is not None:
+            get_writer().write(set_build_status, build_id, "running")
+            return build_id
+        return get_writer().write(
+            insert_build,
+            commit_sha,
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "running",
+            "",
+            repo,
+        )
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        return None
+
+
+def record_build(
+    commit_sha: str,
+    status: str,
+    output: str,
+    cache_events: list = (),
+    stages: list = (),
+    test_results: list = (),
+    repo: str = None,
+    scope: str = "full",
+    build_id: int = None,
+    cached_from: int = None,
+    result_key: tuple = None,
+    tree_hash: str = None,
+) -> int:
+    """
+    Stores the result of a build in the build history. The rows are written
+    by the database writer, which commits them together.
+
+    :param commit_sha: The commit that was built
+    :type commit_sha: str
+    :param status: The outcome of the build, "success", "failure", "error",
+                   "timed_out", "oom" or "superseded"
+    :type status: str
+    :param output: The output of the build, or its tail when the full log is
+                   kept by :py:class:`build_log.BuildLog`
+    :type output: str
+    :param cache_events: (cache name, hit) pairs of the caches used by the build
+    :type cache_events: list
+    :param stages: (stage, status, started_at, duration, cpu_time, max_rss,
+                   downloaded) tuples of the pipeline stages
+    :type stages: list
+    :param test_results: (test id, outcome, duration, message) tuples of the
+                         test cases
+    :type test_results: list
+    :param repo: The repository, "owner/name"
+    :type repo: str
+    :param scope: "full", or "partial" if only the affected tests ran
+    :type scope: str
+    :param build_id: The build row created by :py:func:`start_build`, a new
+                     row is inserted if it is None
+    :type build_id: int
+    :param cached_from: The build whose result was reused
+    :type cached_from: int
+    :param result_key: (tree hash, environment key) the outcome is stored
+                       under in the result cache, None to not store it
+    :type result_key: tuple
+    :param tree_hash: The tree that was built, flaky tests are found by
+                      comparing builds of the same tree
+    :type tree_hash: str
+
+    :return: The id of the build, None if it could not be stored
+    :rtype: int
+    """
+    writer = get_writer()
+    try:
+        writes = []
+        if build_id is None:
+            build_id = writer.write(
+                insert_build,
+                commit_sha,
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                status,
+                output,
+                repo,
+                scope,
+                cached_from,
+                tree_hash,
+            )
         else:
-            # Failure if cloned but unsuccessfully built or tested
-            update_github_status(status_url, "failure", GITHUB_TOKEN)
+            writes.append(
+                writer.submit(
+                    update_build,
+                    build_id,
+                    status,
+                    output,
+                    scope,
+                    cached_from,
+                    tree_hash,
+                )
+            )
+        if test_results:
+            writes.append(writer.submit(insert_test_results, build_id, test_results))
+        for cache, hit in cache_events:
+            writes.append(writer.submit(insert_cache_event, build_id, cache, hit))
+        for stage in stages:
+            writes.append(writer.submit(insert_build_stage, build_id, *stage))
+        if result_key is not None:
+            writes.append(
+                writer.submit(insert_build_result, repo, *result_key, build_id, status)
+            )
+        for write in writes:
+            write.result()
+        return build_id
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        return None
+
+
+def create_matrix_cells(state: dict, build_id: int) -> list:
+    """
+    Adds a build row with the status "queued" for every cell of the build
+    matrix a build found, see :py:func:`stage_matrix`.
+
+    :param state: The state of the matrix build
+    :type state: dict
+    :param build_id: The build row of the matrix build
+    :type build_id: int
+
+    :return: The cells, each with the build_id of its row and the parent
+             matrix build, an empty list if the rows could not be stored
+    :rtype: list
+    """
+    writer = get_writer()
+    date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cells = []
+    try:
+        for cell in state["matrix"]:
+            cell_id = writer.write(
+                insert_build,
+                state["payload"]["after"],
+                date,
+                "queued",
+                "",
+                state["repo"],
+                "full",
+                None,
+                None,
+                build_id,
+                cell["name"],
+            )
+            cells.append(dict(cell, build_id=cell_id, parent=build_id))
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        return []
+    return cells
+
+
+def start_matrix(state: dict, build_id: int, cells: list):
+    """
+    Queues the cells of a build matrix on the build queue, each as a push
+    of its own that reports under its own status context, see
+    :py:func:`build_matrix.status_context`. Cells that cannot be queued end
+    as errors.
+
+    The cells share the git mirror of the repository, so their checkouts
+    are cheap worktrees, and the environment, compile and result caches.
+
+    :param state: The state of the matrix build
+    :type state: dict
+    :param build_id: The build row of the matrix build
+    :type build_id: int
+    :param cells: The cells returned by :py:func:`create_matrix_cells`
+    :type cells: list
+    """
+    payload = state["payload"]
+    status_url = commit_status_url(payload)
+    if not cells:
+        finish_matrix(dict(payload, matrix={"parent": build_id}))
+        return
+    for cell in cells:
+        cell_payload = dict(payload, matrix=cell)
+        context = status_context(cell_payload)
+        update_github_status(status_url, "pending", GITHUB_TOKEN, context=context)
+        try:
+            scheduler.submit(cell_payload)
+        except QueueFullError as e:
+            print(f"Matrix cell {cell['name']} rejected: {e}")
+            update_github_status(status_url, "error", GITHUB_TOKEN, context=context)
             try:
-                with app.app_context():
-                    db_conn = get_db()
-                    insert_build(
-                        db_conn,
-                        commit_sha,
-                        datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "failure",
-                        testsOutput,
-                    )
+                get_writer().write(set_build_status, cell["build_id"], "error")
             except sqlite3.Error as e:
                 print("Database error:", e)
-            print("message", "Build/tests failed")
-            return 200
+            finish_matrix(cell_payload)
 
-    except Exception as e:
-        # Error if exception is raised during processing
-        update_github_status(status_url, "error", GITHUB_TOKEN)
-        print("error", e)
-        return 500
+
+def finish_matrix(payload: dict, replacement: dict = None) -> str:
+    """
+    Sets the combined outcome of a build matrix once all of its cells have
+    finished, see :py:func:`build_matrix.combined_status`. The matrix build
+    takes that outcome and it is sent to github under the usual status
+    context, a superseded matrix as an error like a superseded build, see
+    :py:func:`report_superseded`. Called whenever a cell finishes, only the
+    call that sees the last cell finished does anything.
+
+    :param payload: The json payload of a cell
+    :type payload: dict
+    :param replacement: The json payload of the push that superseded the
+                        cell, if it was superseded
+    :type replacement: dict
+
+    :return: The combined outcome, None while cells are still queued or
+             running, or if the outcome was set by another cell
+    :rtype: str
+    """
+    parent = payload["matrix"]["parent"]
+    try:
+        with closing(connect()) as conn:
+            cells = get_matrix_cells(conn, parent)
+        statuses = [
+            "running" if status in ("queued", "running") else status
+            for _, _, status in cells
+        ]
+        status = combined_status(statuses) if cells else "error"
+        if status == "running":
+            return None
+        if not get_writer().write(set_build_status, parent, status, "matrix"):
+            return None
+    except sqlite3.Error as e:
+        print("Database error:", e)
+        return None
+    if status == "superseded":
+        update_github_status(
+            commit_status_url(payload),
+            "error",
+            GITHUB_TOKEN,
+            **_superseded_by(replacement),
+        )
+        return status
+    failed = sum(1 for outcome in statuses if outcome != "success")
+    update_github_status(
+        commit_status_url(payload),
+        status,
+        GITHUB_TOKEN,
+        description=f"{len(cells) - failed} of {len(cells)} matrix cells passed",
+    )
+    return status
 
 
 def clone_repo(git_url: str, sha: str, repo_name: str) -> (bool, str):
     """
-    Clone the GitHub repository into the CLONE_DIR directory
+    Checks out the commit into a new workspace, see
+    :py:class:`workspace.WorkspaceManager`. The workspace is released by
+    :py:func:`process_request` once the build has finished.
+
+    The repository is kept as a bare mirror in the git cache and only the
+    missing commits are fetched, the checkout is a worktree of that mirror.
 
     :param git_url: The URL of the GitHub repository to clone
     :type git_url: str
@@ -167,45 +1798,47 @@ def clone_repo(git_url: str, sha: str, repo_name: str) -> (bool, str):
     :param repo_name: The name of the repository
     :type repo_name: str
 
+    :raises sandbox.LimitExceeded: If the checkout exceeded a build limit
+
     :return: True if the repository was cloned successfully, False otherwise
     :return: The path to the cloned repository
     :rtype: (bool, str)
     """
-    # Ensure that the clone directory does not exist already
-    repo_path = os.path.join(CLONE_DIR, f"{repo_name}-{sha}")
-
-    # Try removing existing repo
-    if os.path.exists(repo_path):
-        try:
-            shutil.rmtree(repo_path)
-            print(f"Deleted existing repo: {repo_path}")
-        except PermissionError:
-            print(f"Permission denied: Could not delete {repo_path}")
-            return False, repo_path
+    # Every build gets its own directory, builds of the same commit may run at once
+    try:
+        repo_path = workspaces.allocate(f"{repo_name}-{sha[:12]}")
+    except OSError as e:
+        print(f"Could not create a workspace: {e}")
+        return False, None
 
     try:
-        # Run the git clone command
-        subprocess.run(["git", "clone", git_url, repo_path], check=True)
-        subprocess.run(["git", "checkout", sha], cwd=repo_path, check=True)
+        checkout_commit(git_url, sha, repo_path)
         print(f"Repo cloned successfully into {repo_path}")
         return True, repo_path
     except subprocess.CalledProcessError as e:
         print(f"Could not clone repo: {e}")
         return False, repo_path
+    except sandbox.LimitExceeded:
+        # The checkout stage reports the limit, the workspace is not handed out
+        workspaces.release(repo_path, git_url)
+        raise
 
 
-def build_project(path: str) -> bool:
+def build_project(path: str, python_executable: str = None) -> bool:
     """
     Fetches all python files in the directory given by path and runs a compile check on it. Return true if the check succeeds.
+    See :py:func:`compile_check.check_syntax` for the structured errors.
 
     :param path: String representing the path to the directory to be compiled.
                 An empty directory is considered a valid path and program (returns True)
     :type path: str
+    :param python_executable: Interpreter of the build environment, the environment
+                              is set up first if it is not given
+    :type python_executable: str
     :returns: True if all python files within the path compile without errors.
               False if any file compile with an error, path is not directory or the path does not exist.
     """
 
-    files = []
     if not os.path.exists(path):
         return False
 
@@ -216,64 +1849,55 @@ def build_project(path: str) -> bool:
         # Directory is Empty
         return True
 
-    if os.path.isdir(path):
-        for dirpath, _, filenames in os.walk(path):
-            for file in filenames:
-                if file.endswith(".py"):
-                    files.append(dirpath + "/" + file)
-
-    # Create a virtual environment in the directory
-    try:
-        venv_dir = os.path.join(path, ".venv")
-        venv.create(venv_dir)
-    except subprocess.CalledProcessError as e:
-        print(f"Creating venv failed: {e.stdout}")
-        return False
-
-    # Choose the correct python executable based on the OS
-    if os.name == "nt":
-        python_executable = os.path.join(venv_dir, "Scripts", "python.exe")
-    else:
-        python_executable = os.path.join(venv_dir, "bin", "python")
-
-    # Ensure pip is installed in the virtual environment, install pip otherwise
-    subprocess.run(
-        [python_executable, "-m", "ensurepip"],
-        cwd=path,
-        check=True,
-    )
-
-    # Install the requirements.txt file if it exists
-    if os.path.exists("requirements.txt"):
+    # Set up the virtual environment, reused from the environment cache when possible
+    if python_executable is None:
         try:
-            subprocess.run(
-                [python_executable, "-m", "pip", "install", "-r", "requirements.txt"],
-                cwd=path,  # Make sure the command runs in the directory containing requirements.txt
-                check=True,
-            )
-            print("Requirements installed successfully.")
+            python_executable, _ = prepare_environment(path)
         except subprocess.CalledProcessError as e:
-            print(f"Failed to install requirements: {e}")
+            print(f"Creating venv failed: {e}")
+            return False
 
     # Run the compile check on all python files
-    command = [python_executable, "-m", "py_compile"]
-    command.extend(files)
-    try:
-        subprocess.run(command, check=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Syntax Check Failed: {e.stderr}")
+    errors, _ = check_syntax(path, python_executable)
+    if errors:
+        print(f"Syntax Check Failed:\n{format_errors(errors)}")
         return False
-
-
-def run_tests(path: str) -> tuple[bool, str]:
+    return True
+
+
+def run_tests(
+    path: str,
+    python_executable: str = None,
+    shards: int = TEST_SHARDS,
+    durations: dict = None,
+    tests: list = None,
+    coverage_rc: str = None,
+    log: BuildLog = None,
+    env: dict = None,
+) -> tuple[bool, str]:
     """
     Runs all tests in the given repository path.
 
-    - Using pytest
+    - Using pytest, split across `shards` processes by test file
+    - The merged JUnit XML report is written to JUNIT_REPORT in the repository
 
     :param path: Path to the cloned repository.
     :type path: str
+    :param python_executable: Interpreter of the build environment, the environment
+                              is set up first if it is not given
+    :type python_executable: str
+    :param shards: Number of concurrent pytest processes.
+    :type shards: int
+    :param durations: Historical runtime of each test file used to balance the shards.
+    :type durations: dict
+    :param tests: Only run these test files instead of the whole suite.
+    :type tests: list
+    :param coverage_rc: Run the tests under coverage with this configuration.
+    :type coverage_rc: str
+    :param log: Stream the output of pytest into this build log as it runs.
+    :type log: BuildLog
+    :param env: Environment variables set for pytest besides the server's.
+    :type env: dict
 
     :returns: True if all tests pass, False otherwise.
     :rtype: bool
@@ -282,78 +1906,38 @@ def run_tests(path: str) -> tuple[bool, str]:
     if not os.path.exists(path):
         return False, "Path does not exist."
 
-    # Determine the virtual environment directory path
-    venv_dir = os.path.join(path, ".venv")
-    if not os.path.exists(venv_dir):
-        venv.create(venv_dir)
-
-    # Activate the virtual environment according to the OS
-    if os.name == "nt":
-        python_executable = os.path.join(venv_dir, "Scripts", "python.exe")
-    else:
-        python_executable = os.path.join(venv_dir, "bin", "python")
-
-    # Check if the python executable exists
-    if not os.path.exists(python_executable):
-        print(f"Error: Python executable not found at {python_executable}")
-        return False, "Python executable not found."
-
-    # Ensure pip is installed in the virtual environment
-    subprocess.run(
-        [python_executable, "-m", "ensurepip"],
-        cwd=path,
-        check=True,
-    )
-
-    # Install the requirements.txt file if it exists
-    try:
-        subprocess.run(
-            [python_executable, "-m", "pip", "install", "-r", "requirements.txt"],
-            cwd=path,  # Make sure the command runs in the directory containing requirements.txt
-            check=True,
-        )
-        print("Requirements installed successfully.")
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to install requirements: {e}")
-
-    # Check if pytest is installed in the environment
-    try:
-        subprocess.run(
-            [python_executable, "-m", "pytest", "--version"],
-            check=True,
-            capture_output=True,
-        )
-    except subprocess.CalledProcessError as e:
-        print(f"pytest not found in the environment: {e.stderr}")
+    # Set up the virtual environment with the requirements and pytest installed
+    if python_executable is None:
         try:
-            subprocess.run(
-                [python_executable, "-m", "pip", "install", "pytest"],
-                check=True,
-                text=True,
-            )
+            python_executable, _ = prepare_environment(path)
         except subprocess.CalledProcessError as e:
-            print(f"Failed to install pytest:\n{e.stderr}")
-            return False, "Failed to install pytest."
+            print(f"Failed to set up the environment: {e}")
+            return False, "Failed to set up the environment."
 
     # Run the tests using pytest
-    test_command = [python_executable, "-m", "pytest"]
-    try:
-        result = subprocess.run(
-            test_command, cwd=path, check=True, capture_output=True, text=True
-        )
-        print(f"Tests passed!\n{result.stdout}")
-        return (True, result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"Tests failed:\n{e.stdout}\n{e.stderr}")
-        error = e.stdout + e.stderr
-        return (False, error)
-
-
-def update_github_status(url: str, state: str, github_token: str) -> int:
+    passed, output = run_pytest(
+        path, python_executable, shards, durations, tests, coverage_rc, log, env
+    )
+    if passed:
+        print(f"Tests passed!\n{output}")
+    else:
+        print(f"Tests failed:\n{output}")
+    return (passed, output)
+
+
+def update_github_status(
+    url: str,
+    state: str,
+    github_token: str,
+    description: str = "CI test results",
+    target_url: str = None,
+    context: str = STATUS_CONTEXT,
+):
     """
     Updates the status of a commit on github.
 
-    This function sends a commit status update to github using the Statuses API.
+    This function queues a commit status update for the Statuses API, it is
+    sent in the background by :py:class:`status_client.StatusReporter`.
     The status can be one of the following: "success", "failure", "pending", or "error".
 
     :param url: The github API endpoint for updating commit statuses.
@@ -362,18 +1946,58 @@ def update_github_status(url: str, state: str, github_token: str) -> int:
     :type state: str
     :param github_token: The authentication token used to access the github API.
     :type github_token: str
+    :param description: Short description shown next to the status.
+    :type description: str
+    :param target_url: Optional link shown with the status.
+    :type target_url: str
+    :param context: Name of the status on github, matrix cells have their own.
+    :type context: str
+    """
+    payload = {"state": state, "description": description, "context": context}
+    if target_url is not None:
+        payload["target_url"] = target_url
 
-    :return: The HTTP status code returned by github.
-    :rtype: int
+    status_reporter.submit(url, payload, github_token)
+
+
+def start_background():
+    """
+    Prepares the database and starts the background threads: the build
+    workers and the processing of webhook deliveries. Builds left running by
+    a previous process are marked as errors and their jobs queued again, and
+    the workspaces it left behind are deleted.
     """
-    headers = {"Authorization": f"token {github_token}"}
-    payload = {"state": state, "description": "CI test results", "context": "CI/Test"}
+    initialise_db()
+    with closing(connect()) as conn:
+        abort_running_builds(conn)
+        prune_logs_if_due(conn)
+    workspaces.sweep()
+    if not WEBHOOK_SECRET:
+        print("GITHUB_WEBHOOK_SECRET is not set, webhook signatures are not checked")
+    scheduler.start()
+    delivery_processor.start()
+
 
-    response = requests.post(url, json=payload, headers=headers)
+def serve(development: bool = False):
+    """
+    Starts the server. waitress serves the app with HTTP_THREADS threads when
+    it is installed, otherwise or with development set Flask's development
+    server is used.
 
-    return response.status_code
+    :param development: Use Flask's development server
+    :type development: bool
+    """
+    start_background()
+    if not development:
+        try:
+            from waitress import serve as waitress_serve
+        except ImportError:
+            print("waitress is not installed, using the development server")
+        else:
+            waitress_serve(app, host=HOST, port=PORT, threads=HTTP_THREADS)
+            return
+    app.run(host=HOST, port=PORT, threaded=True)
 
 
 if __name__ == "__main__":
-    initialise_db()
-    app.run(host="127.0.0.1", port=5000)
+    serve(development="--dev" in sys.argv)
@@ -0,0 +1,191 @@
+import hashlib
+import json
+import math
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import resource_usage
+import sandbox
+from db import connect, get_writer, get_compiled_hashes, insert_compiled_hashes
+from env_cache import interpreter_version
+
+# Number of interpreters compiling files at the same time
+COMPILE_WORKERS = int(os.getenv("CI_COMPILE_WORKERS", str(os.cpu_count() or 1)))
+# Files per shard below which no further interpreters are started
+MIN_SHARD_SIZE = 50
+# Directories that never contain project sources
+IGNORED_DIRS = {
+    ".git",
+    ".hg",
+    ".venv",
+    "venv",
+    "__pycache__",
+    "site-packages",
+    "node_modules",
+    ".tox",
+    ".nox",
+    ".eggs",
+    ".mypy_cache",
+    ".pytest_cache",
+}
+
+# Runs inside the build interpreter, reads file paths as json from stdin and
+# prints the syntax errors as json. compile() is used so no .pyc files are written.
+_CHECKER = """
+import json, sys
+errors = []
+for path in json.load(sys.stdin):
+    try:
+        with open(path, "rb") as f:
+            compile(f.read(), path, "exec", dont_inherit=True)
+    except SyntaxError as e:
+        errors.append({"file": path, "line": e.lineno, "offset": e.offset,
+                       "type": type(e).__name__, "message": e.msg})
+    except (ValueError, OSError) as e:
+        errors.append({"file": path, "line": None, "offset": None,
+                       "type": type(e).__name__, "message": str(e)})
+json.dump(errors, sys.stdout)
+"""
+
+
+def find_python_files(path: str) -> list:
+    """
+    Lists the python files of a repository, skipping IGNORED_DIRS and
+    any directory that holds a virtual environment.
+
+    :param path: Path to the repository
+    :type path: str
+
+    :return: Paths of the python files
+    :rtype: list
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [
+            d
+            for d in dirnames
+            if d not in IGNORED_DIRS
+            and not os.path.exists(os.path.join(dirpath, d, "pyvenv.cfg"))
+        ]
+        for file in filenames:
+            if file.endswith(".py"):
+                files.append(os.path.join(dirpath, file))
+    return sorted(files)
+
+
+def _file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _compile_shard(
+    python_executable: str, files: list, usage: dict = None, limits: dict = None
+) -> list:
+    # Runs in a pool thread, the checker counts towards the usage and limits of the calling stage
+    with resource_usage.attach(usage), sandbox.attach(limits):
+        result = sandbox.run(
+            [python_executable, "-c", _CHECKER],
+            input=json.dumps(files),
+            capture_output=True,
+            text=True,
+        )
+    if result.returncode != 0:
+        return [
+            {
+                "file": file,
+                "line": None,
+                "offset": None,
+                "type": "CheckerError",
+                "message": result.stderr.strip(),
+            }
+            for file in files
+        ]
+    return json.loads(result.stdout)
+
+
+def check_syntax(
+    path: str, python_executable: str, workers: int = COMPILE_WORKERS
+) -> (list, dict):
+    """
+    Compiles all python files of a repository with the build interpreter.
+
+    Files are sharded across up to `workers` interpreter processes. Files whose
+    content already compiled with the same interpreter version are skipped,
+    the results are cached in the database by content hash.
+
+    :param path: Path to the repository
+    :type path: str
+    :param python_executable: Interpreter of the build environment
+    :type python_executable: str
+    :param workers: Maximum number of interpreter processes
+    :type workers: int
+
+    :return: The errors as dictionaries with file (relative to path), line,
+             offset, type and message
+    :return: Statistics with the number of files, cached files and shards
+    :rtype: (list, dict)
+    """
+    files = find_python_files(path)
+    if not files:
+        return [], {"files": 0, "cached": 0, "shards": 0}
+
+    interpreter = interpreter_version(python_executable)
+    hashes = {file: _file_hash(file) for file in files}
+    try:
+        with closing(connect()) as conn:
+            compiled = get_compiled_hashes(conn, interpreter, set(hashes.values()))
+    except sqlite3.Error as e:
+        print(f"Compile cache unavailable: {e}")
+        compiled = set()
+    pending = [file for file in files if hashes[file] not in compiled]
+
+    shards = []
+    if pending:
+        count = max(1, min(workers, math.ceil(len(pending) / MIN_SHARD_SIZE)))
+        shards = [pending[i::count] for i in range(count)]
+    usage = resource_usage.current()
+    limits = sandbox.current()
+    with ThreadPoolExecutor(max_workers=max(1, len(shards))) as pool:
+        results = pool.map(
+            lambda shard: _compile_shard(python_executable, shard, usage, limits),
+            shards,
+        )
+        errors = [error for shard_errors in results for error in shard_errors]
+
+    failed = {error["file"] for error in errors}
+    try:
+        get_writer().write(
+            insert_compiled_hashes,
+            interpreter,
+            {hashes[f] for f in pending if f not in failed},
+        )
+    except sqlite3.Error as e:
+        print(f"Compile cache unavailable: {e}")
+
+    for error in errors:
+        error["file"] = os.path.relpath(error["file"], path)
+    stats = {
+        "files": len(files),
+        "cached": len(files) - len(pending),
+        "shards": len(shards),
+    }
+    return errors, stats
+
+
+def format_errors(errors: list) -> str:
+    """
+    Formats compile errors as "file:line: type: message" lines.
+
+    :param errors: Errors returned by check_syntax
+    :type errors: list
+    :rtype: str
+    """
+    lines = []
+    for error in errors:
+        location = error["file"]
+        if error["line"] is not None:
+            location += f":{error['line']}"
+        lines.append(f"{location}: {error['type']}: {error['message']}")
+    return "\n".join(lines)
@@ -1,13 +1,358 @@
+import os
+import queue
 import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
 from flask import g
 
+from metrics import Histogram
+
 DATABASE = "ci_server.db"
+# Idle connections kept open per database, more are opened when needed
+DB_POOL_SIZE = int(os.getenv("CI_DB_POOL_SIZE", "8"))
+# Milliseconds a connection waits for a lock held by another connection
+DB_BUSY_TIMEOUT_MS = int(os.getenv("CI_DB_BUSY_TIMEOUT_MS", "30000"))
+# Prepared statements cached per connection
+DB_STATEMENT_CACHE = 256
+# Writes committed together by the writer thread
+WRITE_BATCH_SIZE = 100
+# Seconds the writer thread waits for work before it exits
+WRITER_IDLE_SECONDS = 5.0
+# Recent writes whose latency is kept for the write statistics
+WRITE_LATENCY_WINDOW = 1000
+
+_pools = {}
+_writers = {}
+_registry_lock = threading.Lock()
+
+QUERY_SECONDS = Histogram(
+    "ci_db_query_duration_seconds",
+    "Time to execute an SQLite statement, by statement type",
+    ("statement",),
+)
+WRITE_SECONDS = Histogram(
+    "ci_db_write_duration_seconds",
+    "Time from queueing a write with the database writer until it is committed",
+)
+
+
+# Open a connection with the pragmas every connection of the server uses.
+# WAL lets readers work while a build writes, and synchronous=NORMAL is safe with WAL.
+def _open(database, factory=sqlite3.Connection, isolation_level=""):
+    conn = sqlite3.connect(
+        database,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        factory=factory,
+        isolation_level=isolation_level,
+        check_same_thread=False,  # Pooled connections move between threads
+        cached_statements=DB_STATEMENT_CACHE,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class _TimedCursor(sqlite3.Cursor):
+    # Records the execution time of the statements, rows fetched later are not included
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            QUERY_SECONDS.observe(
+                time.perf_counter() - start, statement=_statement_type(sql)
+            )
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            QUERY_SECONDS.observe(
+                time.perf_counter() - start, statement=_statement_type(sql)
+            )
+
+
+def _statement_type(sql):
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+
+
+class _TimedConnection(sqlite3.Connection):
+    # A connection whose statements are timed, see _TimedCursor
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class _PooledConnection(_TimedConnection):
+    # A connection that goes back to its pool when it is closed
+
+    pool = None
+    idle = False
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of connections to one database. Connections keep their
+    cached prepared statements while they wait in the pool.
+
+    :param database: Path of the database
+    :type database: str
+    :param size: Maximum number of idle connections kept open
+    :type size: int
+    """
+
+    def __init__(self, database: str, size: int = DB_POOL_SIZE):
+        self.database = database
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Returns an idle connection, or a new one if none is idle.
+
+        :rtype: sqlite3.Connection
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = _open(self.database, factory=_PooledConnection)
+            conn.pool = self
+        conn.idle = False
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """
+        Returns a connection to the pool. An open transaction is rolled back,
+        connections beyond the pool size are closed.
+
+        :param conn: A connection from :py:meth:`acquire`
+        :type conn: sqlite3.Connection
+        """
+        if conn.idle:
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.idle = True
+            self._idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.pool = None
+            conn.close()
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.pool = None
+            conn.close()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the connection pool of DATABASE.
+
+    :rtype: ConnectionPool
+    """
+    with _registry_lock:
+        if DATABASE not in _pools:
+            _pools[DATABASE] = ConnectionPool(DATABASE)
+        return _pools[DATABASE]
+
+
+class _WriterConnection(_TimedConnection):
+    # Commits of the database functions are deferred until the batch is complete
+
+    batching = False
+
+    def commit(self):
+        if not self.batching:
+            super().commit()
+
+
+class DatabaseWriter:
+    """
+    Serialises the writes of the build workers to one database. Writes are
+    run in order by a single thread and committed in batches of up to
+    WRITE_BATCH_SIZE, each write in its own savepoint so a failing write
+    does not undo the others. The thread is started on demand and exits
+    when it has been idle for WRITER_IDLE_SECONDS.
+
+    :param database: Path of the database
+    :type database: str
+    """
+
+    def __init__(self, database: str):
+        self.database = database
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Seconds from submit to commit of the recent writes
+        self._latencies = deque(maxlen=WRITE_LATENCY_WINDOW)
+        self.writes = 0
+
+    def submit(self, function, *args) -> Future:
+        """
+        Queues a write. The function is called with the writer's connection
+        followed by args, e.g. ``submit(insert_cache_event, build_id, "env", True)``.
+
+        :param function: A database function taking a connection first
+        :type function: callable
+
+        :return: Resolves to the return value of the function once the batch
+                 holding the write is committed
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        with self._lock:
+            self._queue.put((function, args, future, time.monotonic()))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return future
+
+    def write(self, function, *args):
+        """
+        Queues a write and waits until it is committed, see :py:meth:`submit`.
+
+        :raises sqlite3.Error: If the write or the commit failed
+
+        :return: The return value of the function
+        """
+        return self.submit(function, *args).result()
+
+    def stats(self) -> dict:
+        """
+        Returns how long the recent writes took from being queued until their
+        batch was committed.
+
+        :return: Dictionary with writes (the total number of committed writes),
+                 queued, and avg_latency, p95_latency and max_latency in seconds
+        :rtype: dict
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        stats = {
+            "writes": self.writes,
+            "queued": self._queue.qsize(),
+            "avg_latency": 0.0,
+            "p95_latency": 0.0,
+            "max_latency": 0.0,
+        }
+        if latencies:
+            stats["avg_latency"] = sum(latencies) / len(latencies)
+            stats["p95_latency"] = latencies[int(0.95 * (len(latencies) - 1))]
+            stats["max_latency"] = latencies[-1]
+        return stats
+
+    def _run(self):
+        try:
+            conn = _open(self.database, factory=_WriterConnection, isolation_level=None)
+        except sqlite3.Error as e:
+            # Fail the queued writes, the next write tries to open the database again
+            with self._lock:
+                while not self._queue.empty():
+                    self._queue.get_nowait()[2].set_exception(e)
+                self._thread = None
+            return
+        try:
+            while True:
+                try:
+                    batch = [self._queue.get(timeout=WRITER_IDLE_SECONDS)]
+                except queue.Empty:
+                    with self._lock:
+                        if self._queue.empty():
+                            self._thread = None
+                            return
+                    continue
+                while len(batch) < WRITE_BATCH_SIZE:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._write_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.batching = True
+            for function, args, future, _ in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((future, function(conn, *args), None))
+                    conn.execute("RELEASE write")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    results.append((future, None, e))
+            conn.batching = False
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.batching = False
+            if conn.in_transaction:
+                conn.rollback()
+            for _, _, future, _ in batch:
+                future.set_exception(e)
+            return
+        committed = time.monotonic()
+        with self._lock:
+            self.writes += len(batch)
+            self._latencies.extend(committed - item[3] for item in batch)
+        for item in batch:
+            WRITE_SECONDS.observe(committed - item[3])
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+def get_writer() -> DatabaseWriter:
+    """
+    Returns the writer of DATABASE.
+
+    :rtype: DatabaseWriter
+    """
+    with _registry_lock:
+        if DATABASE not in _writers:
+            _writers[DATABASE] = DatabaseWriter(DATABASE)
+        return _writers[DATABASE]
+
+
+# Add a column to an existing table, databases created by older versions lack newer columns
+def _add_column(cursor, table, column, definition):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
 
 # Initialise the database
 def initialise_db():
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = _open(DATABASE)
 
         # Create the table if it doesn't exist
         cursor = conn.cursor()
@@ -22,6 +367,227 @@ def initialise_db():
             )
         """
         )
+
+        # Repository ("owner/name") a build belongs to
+        _add_column(cursor, "builds", "repo", "TEXT")
+        # "full", or "partial" when only the tests affected by the push ran
+        _add_column(cursor, "builds", "scope", "TEXT NOT NULL DEFAULT 'full'")
+        # Build whose result was reused because it built the same tree
+        _add_column(cursor, "builds", "cached_from", "INTEGER")
+        # Hash of the tree that was built, None if it was not computed
+        _add_column(cursor, "builds", "tree_hash", "TEXT")
+        # Build whose matrix this build is a cell of, and the name of the cell
+        _add_column(cursor, "builds", "matrix_parent", "INTEGER")
+        _add_column(cursor, "builds", "matrix_cell", "TEXT")
+
+        # Outcome of the last full build of each tree with each environment
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS build_results (
+                repo TEXT NOT NULL,
+                tree_hash TEXT NOT NULL,
+                env_key TEXT NOT NULL,
+                build_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                PRIMARY KEY (repo, tree_hash, env_key)
+            ) WITHOUT ROWID
+        """
+        )
+
+        # Which test files execute each source file, built from coverage of full runs
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS test_impact (
+                repo TEXT NOT NULL,
+                source_file TEXT NOT NULL,
+                test_file TEXT NOT NULL,
+                PRIMARY KEY (repo, source_file, test_file)
+            ) WITHOUT ROWID
+        """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS test_impact_meta (
+                repo TEXT PRIMARY KEY,
+                commit_identifier TEXT NOT NULL,
+                config_hash TEXT NOT NULL
+            )
+        """
+        )
+
+        # Outcome and duration of every test case of a build
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS test_results (
+                id INTEGER PRIMARY KEY,
+                build_id INTEGER NOT NULL,
+                test_id TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                duration REAL NOT NULL
+            )
+        """
+        )
+        # Failure message or skip reason, None for passed tests
+        _add_column(cursor, "test_results", "message", "TEXT")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_test_results_build ON test_results (build_id)"
+        )
+        # History of a test across builds
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_test_results_test ON test_results (test_id, build_id)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_builds_repo ON builds (repo, id)"
+        )
+        # Filters of the builds listing
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_builds_date ON builds (build_date)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_builds_commit ON builds (commit_identifier)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_builds_status ON builds (status, id)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_builds_matrix ON builds (matrix_parent)"
+        )
+
+        # Raw webhook deliveries, stored before the webhook responds and
+        # processed in the background. The delivery id makes redeliveries idempotent.
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS deliveries (
+                delivery_id TEXT PRIMARY KEY,
+                event TEXT NOT NULL,
+                body BLOB,
+                received_at REAL NOT NULL,
+                status TEXT NOT NULL,
+                job_id INTEGER
+            ) WITHOUT ROWID
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_deliveries_status ON deliveries (status, received_at)"
+        )
+
+        # Chunks of the archived build logs, the content lives in the log store
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS log_chunks (
+                build_id INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                PRIMARY KEY (build_id, offset)
+            ) WITHOUT ROWID
+        """
+        )
+
+        # Cache hits and misses of each build
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache_events (
+                id INTEGER PRIMARY KEY,
+                build_id INTEGER NOT NULL,
+                cache TEXT NOT NULL,
+                hit INTEGER NOT NULL
+            )
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_cache_events_build ON cache_events (build_id)"
+        )
+
+        # Outcome and timing of each pipeline stage of a build
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS build_stages (
+                id INTEGER PRIMARY KEY,
+                build_id INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL,
+                started_at REAL,
+                duration REAL NOT NULL
+            )
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_build_stages_build ON build_stages (build_id)"
+        )
+        # CPU seconds, peak RSS in KiB and bytes downloaded by each stage
+        _add_column(cursor, "build_stages", "cpu_time", "REAL")
+        _add_column(cursor, "build_stages", "max_rss", "INTEGER")
+        _add_column(cursor, "build_stages", "downloaded", "INTEGER")
+
+        # Content hashes of python files that compiled with an interpreter version
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS compile_cache (
+                file_hash TEXT NOT NULL,
+                interpreter TEXT NOT NULL,
+                PRIMARY KEY (file_hash, interpreter)
+            ) WITHOUT ROWID
+        """
+        )
+
+        # Durable build queue drained by the scheduler's worker pool
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+        """
+        )
+        # Jobs for the same repo and branch share a coalesce key so newer pushes can supersede them
+        _add_column(cursor, "jobs", "coalesce_key", "TEXT")
+        _add_column(cursor, "jobs", "superseded_by", "INTEGER")
+        # Jobs run by a build agent hold a lease that the agent renews while it builds
+        _add_column(cursor, "jobs", "agent", "TEXT")
+        _add_column(cursor, "jobs", "lease_token", "TEXT")
+        _add_column(cursor, "jobs", "lease_expires", "REAL")
+        _add_column(cursor, "jobs", "build_id", "INTEGER")
+        # The repo ("owner/name") and priority class, lower runs first, used to pick the next job
+        _add_column(cursor, "jobs", "repo", "TEXT")
+        _add_column(cursor, "jobs", "priority", "INTEGER NOT NULL DEFAULT 1")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_jobs_coalesce_key ON jobs (coalesce_key, status)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_jobs_started_at ON jobs (started_at)"
+        )
+
+        # Every job taken from the queue, with what the scheduler knew when it picked it
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schedule_decisions (
+                id INTEGER PRIMARY KEY,
+                job_id INTEGER NOT NULL,
+                decided_at REAL NOT NULL,
+                repo TEXT,
+                priority INTEGER NOT NULL,
+                effective_priority INTEGER NOT NULL,
+                wait REAL NOT NULL,
+                queued INTEGER NOT NULL,
+                held_back INTEGER NOT NULL,
+                repo_running INTEGER NOT NULL,
+                repo_recent INTEGER NOT NULL
+            )
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_schedule_decisions_decided_at "
+            "ON schedule_decisions (decided_at)"
+        )
         conn.commit()
         return conn
 
@@ -30,9 +596,10 @@ def initialise_db():
         return None
 
 
+# Get a connection for the current request, it goes back to the pool in close_db
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(DATABASE)
+        g.db = get_pool().acquire()
     return g.db
 
 
@@ -42,20 +609,439 @@ def close_db():
         db.close()
 
 
+# Get a connection for code running outside of a request, e.g. build workers.
+# Closing it returns it to the pool.
+def connect():
+    return get_pool().acquire()
+
+
 # Insert a new build record
-def insert_build(conn, commit_identifier, build_date, status, test_output):
+def insert_build(
+    conn,
+    commit_identifier,
+    build_date,
+    status,
+    test_output,
+    repo=None,
+    scope="full",
+    cached_from=None,
+    tree_hash=None,
+    matrix_parent=None,
+    matrix_cell=None,
+):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT INTO builds (
+            commit_identifier, build_date, status, test_output, repo, scope,
+            cached_from, tree_hash, matrix_parent, matrix_cell
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+        (
+            commit_identifier,
+            build_date,
+            status,
+            test_output,
+            repo,
+            scope,
+            cached_from,
+            tree_hash,
+            matrix_parent,
+            matrix_cell,
+        ),
+    )
+    conn.commit()
+    return cursor.lastrowid
+
+
+# Store the outcome of a build that was inserted while it was running
+def update_build(
+    conn,
+    build_id,
+    status,
+    test_output,
+    scope="full",
+    cached_from=None,
+    tree_hash=None,
+):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        UPDATE builds
+        SET status = ?, test_output = ?, scope = ?, cached_from = ?, tree_hash = ?
+        WHERE id = ?
+    """,
+        (status, test_output, scope, cached_from, tree_hash, build_id),
+    )
+    conn.commit()
+
+
+# Set the status of a build, only if its status is `current` when given.
+# Returns whether the status was changed.
+def set_build_status(conn, build_id, status, current=None):
+    cursor = conn.cursor()
+    if current is None:
+        cursor.execute("UPDATE builds SET status = ? WHERE id = ?", (status, build_id))
+    else:
+        cursor.execute(
+            "UPDATE builds SET status = ? WHERE id = ? AND status = ?",
+            (status, build_id, current),
+        )
+    conn.commit()
+    return cursor.rowcount > 0
+
+
+# Get the cells of a matrix build as (id, matrix_cell, status) rows in the order they were added
+def get_matrix_cells(conn, build_id):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT id, matrix_cell, status FROM builds WHERE matrix_parent = ? ORDER BY id",
+        (build_id,),
+    )
+    return cursor.fetchall()
+
+
+# Remember the outcome of a full build of a tree with an environment
+def insert_build_result(conn, repo, tree_hash, env_key, build_id, status):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO build_results (repo, tree_hash, env_key, build_id, status)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+        (repo, tree_hash, env_key, build_id, status),
+    )
+    conn.commit()
+
+
+# Get the (build_id, status) of the last full build of a tree with an environment,
+# None if it was not built
+def get_build_result(conn, repo, tree_hash, env_key):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT build_id, status FROM build_results
+        WHERE repo = ? AND tree_hash = ? AND env_key = ?
+    """,
+        (repo, tree_hash, env_key),
+    )
+    return cursor.fetchone()
+
+
+# Mark builds left running by a previous server process as errored
+def abort_running_builds(conn):
+    cursor = conn.cursor()
+    cursor.execute("UPDATE builds SET status = 'error' WHERE status = 'running'")
+    conn.commit()
+    return cursor.rowcount
+
+
+# Store the chunks of an archived build log as (offset, size, digest) tuples
+def insert_log_chunks(conn, build_id, chunks):
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT INTO log_chunks (build_id, offset, size, digest) VALUES (?, ?, ?, ?)",
+        [(build_id, offset, size, digest) for offset, size, digest in chunks],
+    )
+    conn.commit()
+
+
+# Get the chunks of an archived build log as (offset, size, digest) rows in order
+def get_log_chunks(conn, build_id):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT offset, size, digest FROM log_chunks WHERE build_id = ? ORDER BY offset",
+        (build_id,),
+    )
+    return cursor.fetchall()
+
+
+# Get the digests of all blobs referenced by archived build logs
+def get_log_digests(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT digest FROM log_chunks")
+    return {row[0] for row in cursor.fetchall()}
+
+
+# Remove the logs of builds that started before build_date, the builds are kept.
+# Returns the number of builds whose log was removed.
+def prune_build_logs(conn, build_date):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT id FROM builds
+        WHERE build_date < ? AND status != 'running'
+          AND (test_output != '' OR id IN (SELECT build_id FROM log_chunks))
+    """,
+        (build_date,),
+    )
+    ids = [(row[0],) for row in cursor.fetchall()]
+    cursor.executemany("DELETE FROM log_chunks WHERE build_id = ?", ids)
+    cursor.executemany("UPDATE builds SET test_output = '' WHERE id = ?", ids)
+    conn.commit()
+    return len(ids)
+
+
+# Record whether a build could reuse an entry of the named cache
+def insert_cache_event(conn, build_id, cache, hit):
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO cache_events (build_id, cache, hit) VALUES (?, ?, ?)",
+        (build_id, cache, int(hit)),
+    )
+    conn.commit()
+    return cursor.lastrowid
+
+
+# Get the cache hits and misses of a build as (cache, hit) rows
+def get_cache_events(conn, build_id):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT cache, hit FROM cache_events WHERE build_id = ? ORDER BY id",
+        (build_id,),
+    )
+    return cursor.fetchall()
+
+
+# Get the hit rate of each cache as (cache, hits, total) rows
+def get_cache_hit_rates(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT cache, SUM(hit), COUNT(*) FROM cache_events GROUP BY cache ORDER BY cache"
+    )
+    return cursor.fetchall()
+
+
+# Record the outcome and duration in seconds of a pipeline stage
+def insert_build_stage(
+    conn,
+    build_id,
+    stage,
+    status,
+    started_at,
+    duration,
+    cpu_time=None,
+    max_rss=None,
+    downloaded=None,
+):
     cursor = conn.cursor()
     cursor.execute(
         """
-        INSERT INTO builds (commit_identifier, build_date, status, test_output)
-        VALUES (?, ?, ?, ?)
+        INSERT INTO build_stages (
+            build_id, stage, status, started_at, duration, cpu_time, max_rss, downloaded
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
     """,
-        (commit_identifier, build_date, status, test_output,),
+        (
+            build_id,
+            stage,
+            status,
+            started_at,
+            duration,
+            cpu_time,
+            max_rss,
+            downloaded,
+        ),
     )
     conn.commit()
     return cursor.lastrowid
 
 
+# Get the stages of a build as
+# (stage, status, started_at, duration, cpu_time, max_rss, downloaded) rows
+def get_build_stages(conn, build_id):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT stage, status, started_at, duration, cpu_time, max_rss, downloaded
+        FROM build_stages
+        WHERE build_id = ? ORDER BY id
+    """,
+        (build_id,),
+    )
+    return cursor.fetchall()
+
+
+# Get the (stage, duration, cpu_time, max_rss, downloaded) rows of the stages that ran
+# in the last builds of a repository
+def get_stage_usage(conn, repo, builds=100):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT stage, duration, cpu_time, max_rss, downloaded FROM build_stages
+        WHERE status != 'skipped' AND build_id IN (
+            SELECT id FROM builds WHERE repo = ? ORDER BY id DESC LIMIT ?
+        )
+    """,
+        (repo, builds),
+    )
+    return cursor.fetchall()
+
+
+# Get which of the given file hashes already compiled with the interpreter
+def get_compiled_hashes(conn, interpreter, hashes):
+    cursor = conn.cursor()
+    hashes = list(hashes)
+    compiled = set()
+    # Stay below SQLite's limit on the number of parameters
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i : i + 500]
+        cursor.execute(
+            f"""
+            SELECT file_hash FROM compile_cache
+            WHERE interpreter = ? AND file_hash IN ({",".join("?" * len(chunk))})
+        """,
+            (interpreter, *chunk),
+        )
+        compiled.update(row[0] for row in cursor.fetchall())
+    return compiled
+
+
+# Remember file hashes that compiled with the interpreter
+def insert_compiled_hashes(conn, interpreter, hashes):
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO compile_cache (file_hash, interpreter) VALUES (?, ?)",
+        [(file_hash, interpreter) for file_hash in hashes],
+    )
+    conn.commit()
+
+
+# Store the (test_id, outcome, duration, message) results of a build.
+# A test that was run again in the same build has a row for every run.
+def insert_test_results(conn, build_id, results):
+    cursor = conn.cursor()
+    cursor.executemany(
+        """
+        INSERT INTO test_results (build_id, test_id, outcome, duration, message)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+        [
+            (build_id, test_id, outcome, duration, message)
+            for test_id, outcome, duration, message in results
+        ],
+    )
+    conn.commit()
+
+
+# Get the (test_id, outcome, duration, message) results of a build in the order they ran
+def get_test_results(conn, build_id):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT test_id, outcome, duration, message FROM test_results
+        WHERE build_id = ? ORDER BY id
+    """,
+        (build_id,),
+    )
+    return cursor.fetchall()
+
+
+# Get the (build_id, commit_identifier, build_date, outcome, duration, message) runs of
+# a test in the last `limit` builds of a repo that ran it, newest first
+def get_test_history(conn, repo, test_id, limit=20):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT b.id, b.commit_identifier, b.build_date, r.outcome, r.duration, r.message
+        FROM test_results r JOIN builds b ON b.id = r.build_id
+        WHERE r.test_id = ? AND b.repo = ?
+        ORDER BY r.build_id DESC, r.id DESC LIMIT ?
+    """,
+        (test_id, repo, limit),
+    )
+    return cursor.fetchall()
+
+
+# Get the tests that both passed and failed on the same tree within the last `window`
+# builds of a repo as (test_id, trees, last_build_id) rows, most often flipping first.
+# Builds without a tree hash are grouped by commit. The cells of a build matrix are
+# told apart, a test may fail on one interpreter and pass on another. A test that
+# failed and passed on a retry within one build counts as well.
+def get_flaky_tests(conn, repo, window=100):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT test_id, COUNT(*) AS trees, MAX(last_build_id)
+        FROM (
+            SELECT r.test_id, MAX(b.id) AS last_build_id
+            FROM builds b JOIN test_results r ON r.build_id = b.id
+            WHERE b.id IN (
+                SELECT id FROM builds WHERE repo = ? ORDER BY id DESC LIMIT ?
+            )
+            GROUP BY r.test_id, COALESCE(b.tree_hash, b.commit_identifier),
+                     b.matrix_cell
+            HAVING SUM(r.outcome = 'passed') > 0
+               AND SUM(r.outcome IN ('failed', 'error')) > 0
+        )
+        GROUP BY test_id
+        ORDER BY trees DESC, test_id
+    """,
+        (repo, window),
+    )
+    return cursor.fetchall()
+
+
+# Get the average runtime of each test file over the last `window` builds of a repo
+def get_test_file_durations(conn, repo, window=10):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT substr(test_id, 1, instr(test_id, '::') - 1) AS file,
+               SUM(duration) / COUNT(DISTINCT build_id)
+        FROM test_results
+        WHERE build_id IN (
+            SELECT id FROM builds WHERE repo = ? ORDER BY id DESC LIMIT ?
+        )
+        GROUP BY file
+    """,
+        (repo, window),
+    )
+    return dict(cursor.fetchall())
+
+
+# Replace the test impact index of a repo with {source file: set of test files}
+def replace_test_impact_index(conn, repo, commit_identifier, config_hash, mapping):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM test_impact WHERE repo = ?", (repo,))
+    cursor.executemany(
+        "INSERT INTO test_impact (repo, source_file, test_file) VALUES (?, ?, ?)",
+        [
+            (repo, source_file, test_file)
+            for source_file, test_files in mapping.items()
+            for test_file in test_files
+        ],
+    )
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO test_impact_meta (repo, commit_identifier, config_hash)
+        VALUES (?, ?, ?)
+    """,
+        (repo, commit_identifier, config_hash),
+    )
+    conn.commit()
+
+
+# Get the test impact index of a repo as (commit, config hash, mapping), None if there is none
+def get_test_impact_index(conn, repo):
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT commit_identifier, config_hash FROM test_impact_meta WHERE repo = ?",
+        (repo,),
+    )
+    meta = cursor.fetchone()
+    if meta is None:
+        return None
+    cursor.execute(
+        "SELECT source_file, test_file FROM test_impact WHERE repo = ?", (repo,)
+    )
+    mapping = {}
+    for source_file, test_file in cursor.fetchall():
+        mapping.setdefault(source_file, set()).add(test_file)
+    return meta[0], meta[1], mapping
+
+
 # Get all build records
 def get_builds(conn):
     cursor = conn.cursor()
@@ -63,8 +1049,420 @@ def get_builds(conn):
     return cursor.fetchall()
 
 
+# Get one page of build summaries, newest first, without the build output.
+# Pages continue after the id of the last build of the previous page (before_id).
+# commit_prefix must not contain glob characters, dates are "YYYY-MM-DD" and inclusive.
+def list_builds(
+    conn,
+    limit=50,
+    before_id=None,
+    status=None,
+    commit_prefix=None,
+    date_from=None,
+    date_to=None,
+):
+    conditions = []
+    params = []
+    if before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    if status is not None:
+        conditions.append("status = ?")
+        params.append(status)
+    if commit_prefix:
+        conditions.append("commit_identifier GLOB ?")
+        params.append(commit_prefix + "*")
+    if date_from is not None:
+        conditions.append("build_date >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("build_date < date(?, '+1 day')")
+        params.append(date_to)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""
+        SELECT id, commit_identifier, build_date, status, repo, scope, cached_from,
+               matrix_cell
+        FROM builds {where}
+        ORDER BY id DESC
+        LIMIT ?
+    """,
+        (*params, limit),
+    )
+    return cursor.fetchall()
+
+
 # Get a specific build record
 def get_build(conn, build_id):
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM builds WHERE id = ?", (build_id,))
     return cursor.fetchone()
+
+
+# Store a webhook delivery, returns False if a delivery with the same id exists
+def insert_delivery(conn, delivery_id, event, body, received_at):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        INSERT OR IGNORE INTO deliveries (delivery_id, event, body, received_at, status)
+        VALUES (?, ?, ?, ?, 'received')
+    """,
+        (delivery_id, event, body, received_at),
+    )
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+# Get up to limit deliveries that were not processed yet as (delivery_id, event, body) rows
+def get_received_deliveries(conn, limit=100):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT delivery_id, event, body FROM deliveries
+        WHERE status = 'received'
+        ORDER BY received_at
+        LIMIT ?
+    """,
+        (limit,),
+    )
+    return cursor.fetchall()
+
+
+# Mark a delivery as processed, the body is no longer needed
+def finish_delivery(conn, delivery_id, status, job_id=None):
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE deliveries SET status = ?, job_id = ?, body = NULL WHERE delivery_id = ?",
+        (status, job_id, delivery_id),
+    )
+    conn.commit()
+
+
+# Get a delivery as (delivery_id, event, body, received_at, status, job_id)
+def get_delivery(conn, delivery_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM deliveries WHERE delivery_id = ?", (delivery_id,))
+    return cursor.fetchone()
+
+
+# Delete processed deliveries received before received_at
+def prune_deliveries(conn, received_at):
+    cursor = conn.cursor()
+    cursor.execute(
+        "DELETE FROM deliveries WHERE status != 'received' AND received_at < ?",
+        (received_at,),
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+# Add a job to the build queue, returns None if the queue already holds max_depth jobs
+def enqueue_job(
+    conn, payload, enqueued_at, max_depth=None, coalesce_key=None, repo=None, priority=1
+):
+    cursor = conn.cursor()
+    if max_depth is None:
+        cursor.execute(
+            """
+            INSERT INTO jobs (payload, status, enqueued_at, coalesce_key, repo, priority)
+            VALUES (?, 'queued', ?, ?, ?, ?)
+        """,
+            (payload, enqueued_at, coalesce_key, repo, priority),
+        )
+    else:
+        # Check the depth and insert in one statement so concurrent submits can't overshoot.
+        # A job that will supersede a queued one doesn't grow the queue so it is always let in.
+        cursor.execute(
+            """
+            INSERT INTO jobs (payload, status, enqueued_at, coalesce_key, repo, priority)
+            SELECT ?, 'queued', ?, ?, ?, ?
+            WHERE (SELECT COUNT(*) FROM jobs WHERE status = 'queued') < ?
+               OR EXISTS (
+                   SELECT 1 FROM jobs WHERE status = 'queued' AND coalesce_key = ?
+               )
+        """,
+            (
+                payload,
+                enqueued_at,
+                coalesce_key,
+                repo,
+                priority,
+                max_depth,
+                coalesce_key,
+            ),
+        )
+    conn.commit()
+    if cursor.rowcount == 0:
+        return None
+    return cursor.lastrowid
+
+
+# Atomically take the next queued job and mark it as running, returns
+# (id, payload, enqueued_at, priority) or None.
+# Jobs are taken by effective priority, their priority class raised by one for every
+# aging_seconds they waited, then from the repo with the fewest running jobs and the
+# fewest jobs started in the last share_window seconds, then oldest first.
+# Jobs of repos that already run max_running jobs are held back, 0 for no cap.
+# The decision is recorded in schedule_decisions.
+# Jobs taken by a build agent are leased to it until lease_expires.
+def claim_next_job(
+    conn,
+    started_at,
+    agent=None,
+    lease_token=None,
+    lease_expires=None,
+    aging_seconds=0,
+    max_running=0,
+    share_window=3600,
+):
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute(
+            """
+            WITH running AS (
+                SELECT repo, COUNT(*) AS count FROM jobs
+                WHERE status = 'running' GROUP BY repo
+            ),
+            recent AS (
+                SELECT repo, COUNT(*) AS count FROM jobs
+                WHERE started_at > ? GROUP BY repo
+            ),
+            candidates AS (
+                SELECT jobs.id, jobs.payload, jobs.enqueued_at, jobs.repo, jobs.priority,
+                    CASE WHEN ? > 0
+                        THEN MAX(jobs.priority - CAST((? - jobs.enqueued_at) / ? AS INTEGER), 0)
+                        ELSE jobs.priority
+                    END AS effective,
+                    COALESCE(running.count, 0) AS running,
+                    COALESCE(recent.count, 0) AS recent
+                FROM jobs
+                LEFT JOIN running ON running.repo IS jobs.repo
+                LEFT JOIN recent ON recent.repo IS jobs.repo
+                WHERE jobs.status = 'queued'
+            )
+            SELECT id, payload, enqueued_at, priority, repo, effective, running, recent,
+                (SELECT COUNT(*) FROM candidates),
+                (SELECT COUNT(*) FROM candidates WHERE ? > 0 AND running >= ?)
+            FROM candidates
+            WHERE ? <= 0 OR running < ?
+            ORDER BY effective, running, recent, id
+            LIMIT 1
+        """,
+            (
+                started_at - share_window,
+                aging_seconds,
+                started_at,
+                aging_seconds,
+                max_running,
+                max_running,
+                max_running,
+                max_running,
+            ),
+        )
+        row = cursor.fetchone()
+        job = None
+        if row is not None:
+            job_id, payload, enqueued_at, priority, repo = row[:5]
+            job = (job_id, payload, enqueued_at, priority)
+            cursor.execute(
+                """
+                UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1,
+                    agent = ?, lease_token = ?, lease_expires = ?
+                WHERE id = ?
+            """,
+                (started_at, agent, lease_token, lease_expires, job_id),
+            )
+            cursor.execute(
+                """
+                INSERT INTO schedule_decisions (job_id, decided_at, repo, priority,
+                    effective_priority, wait, queued, held_back, repo_running, repo_recent)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+                (job_id, started_at, repo, priority, row[5], started_at - enqueued_at)
+                + tuple(row[8:10])
+                + tuple(row[6:8]),
+            )
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return job
+
+
+# Mark a job as finished with the given status. With a lease token only a running
+# job still leased with that token is finished, returns whether the job was finished.
+def finish_job(conn, job_id, status, finished_at, superseded_by=None, lease_token=None):
+    cursor = conn.cursor()
+    if lease_token is None:
+        cursor.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, superseded_by = ? WHERE id = ?",
+            (status, finished_at, superseded_by, job_id),
+        )
+    else:
+        cursor.execute(
+            """
+            UPDATE jobs SET status = ?, finished_at = ?, superseded_by = ?,
+                lease_token = NULL, lease_expires = NULL
+            WHERE id = ? AND status = 'running' AND lease_token = ?
+        """,
+            (status, finished_at, superseded_by, job_id, lease_token),
+        )
+    conn.commit()
+    return cursor.rowcount > 0
+
+
+# Extend the lease of a running job, returns False if the lease was lost
+def renew_lease(conn, job_id, lease_token, lease_expires):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        UPDATE jobs SET lease_expires = ?
+        WHERE id = ? AND status = 'running' AND lease_token = ?
+    """,
+        (lease_expires, job_id, lease_token),
+    )
+    conn.commit()
+    return cursor.rowcount > 0
+
+
+# Remember the build row of a leased job
+def set_job_build(conn, job_id, build_id):
+    cursor = conn.cursor()
+    cursor.execute("UPDATE jobs SET build_id = ? WHERE id = ?", (build_id, job_id))
+    conn.commit()
+
+
+# Put running jobs whose lease expired before now back on the queue.
+# Returns the (job id, build id) of the requeued jobs.
+def requeue_expired_leases(conn, now):
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute(
+            """
+            SELECT id, build_id FROM jobs
+            WHERE status = 'running' AND lease_expires < ?
+        """,
+            (now,),
+        )
+        expired = cursor.fetchall()
+        cursor.executemany(
+            """
+            UPDATE jobs SET status = 'queued', started_at = NULL, agent = NULL,
+                lease_token = NULL, lease_expires = NULL, build_id = NULL
+            WHERE id = ?
+        """,
+            [(job_id,) for job_id, _ in expired],
+        )
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return expired
+
+
+# Mark older queued jobs with the same coalesce key as superseded by job_id.
+# Returns the superseded queued jobs and the ids of older jobs that are still running.
+def supersede_jobs(conn, coalesce_key, job_id, finished_at):
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute(
+            """
+            SELECT id, payload FROM jobs
+            WHERE coalesce_key = ? AND status = 'queued' AND id < ?
+        """,
+            (coalesce_key, job_id),
+        )
+        superseded = cursor.fetchall()
+        cursor.execute(
+            """
+            UPDATE jobs SET status = 'superseded', superseded_by = ?, finished_at = ?
+            WHERE coalesce_key = ? AND status = 'queued' AND id < ?
+        """,
+            (job_id, finished_at, coalesce_key, job_id),
+        )
+        cursor.execute(
+            """
+            SELECT id FROM jobs
+            WHERE coalesce_key = ? AND status = 'running' AND id < ?
+        """,
+            (coalesce_key, job_id),
+        )
+        running = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return superseded, running
+
+
+# Put jobs that were running when the server stopped back on the queue
+def requeue_interrupted_jobs(conn):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        UPDATE jobs SET status = 'queued', started_at = NULL, agent = NULL,
+            lease_token = NULL, lease_expires = NULL, build_id = NULL
+        WHERE status = 'running'
+    """
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+# Get a specific job record
+def get_job(conn, job_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    return cursor.fetchone()
+
+
+# Get the number of jobs taken from the queue since `since` and their average and
+# maximum wait in seconds, by priority class
+def get_wait_stats(conn, since):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT priority, COUNT(*), AVG(wait), MAX(wait) FROM schedule_decisions
+        WHERE decided_at > ? GROUP BY priority ORDER BY priority
+    """,
+        (since,),
+    )
+    return {row[0]: row[1:] for row in cursor.fetchall()}
+
+
+# Get queue depth and wait times, waits are averaged over the last `window` started jobs
+def get_queue_stats(conn, now, window=100):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        SELECT
+            SUM(status = 'queued'),
+            SUM(status = 'running'),
+            MIN(CASE WHEN status = 'queued' THEN enqueued_at END)
+        FROM jobs
+    """
+    )
+    queued, running, oldest = cursor.fetchone()
+    cursor.execute(
+        """
+        SELECT AVG(started_at - enqueued_at), MAX(started_at - enqueued_at)
+        FROM (
+            SELECT started_at, enqueued_at FROM jobs
+            WHERE started_at IS NOT NULL ORDER BY started_at DESC LIMIT ?
+        )
+    """,
+        (window,),
+    )
+    avg_wait, max_wait = cursor.fetchone()
+    return {
+        "queued": queued or 0,
+        "running": running or 0,
+        "oldest_queued_wait": now - oldest if oldest is not None else 0.0,
+        "avg_wait": avg_wait or 0.0,
+        "max_wait": max_wait or 0.0,
+    }
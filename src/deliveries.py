@@ -0,0 +1,132 @@
+import hashlib
+import hmac
+import threading
+import time
+from threading import Thread
+from contextlib import closing
+
+from db import (
+    connect,
+    get_writer,
+    get_received_deliveries,
+    finish_delivery,
+    prune_deliveries,
+)
+
+# Processed deliveries are kept this long to recognise redeliveries
+DELIVERY_RETENTION_SECONDS = 7 * 24 * 3600
+
+
+def verify_signature(body: bytes, signature: str, secret: str) -> bool:
+    """
+    Checks the X-Hub-Signature-256 header of a webhook delivery.
+
+    :param body: The raw request body
+    :type body: bytes
+    :param signature: The header value, "sha256=<hex digest>"
+    :type signature: str
+    :param secret: The secret configured for the webhook
+    :type secret: str
+
+    :return: True if the body was signed with the secret
+    :rtype: bool
+    """
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature[len("sha256=") :], expected)
+
+
+class DeliveryProcessor:
+    """
+    Processes stored webhook deliveries in the background, so the webhook
+    endpoint only has to store a delivery before it responds.
+
+    Deliveries are handled in the order they were received, deliveries that
+    were stored but not handled before a restart are handled after it.
+
+    :param handler: Called with the event and the raw body of each delivery,
+                    returns the new status of the delivery and the id of the
+                    queued job or None
+    :type handler: callable
+    :param poll_interval: Seconds between checks for deliveries without a wakeup
+    :type poll_interval: float
+    :param batch_size: Deliveries read from the database at once
+    :type batch_size: int
+    """
+
+    def __init__(self, handler, poll_interval: float = 5.0, batch_size: int = 100):
+        self.handler = handler
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._thread = None
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._last_prune = 0.0
+
+    def start(self):
+        """
+        Starts the processing thread.
+        """
+        self._stopping.clear()
+        self._thread = Thread(target=self._loop, name="delivery-processor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stops the processing thread after the current delivery.
+
+        :param timeout: Seconds to wait for the thread to exit
+        :type timeout: float
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def notify(self):
+        """
+        Wakes up the processing thread after a delivery was stored.
+        """
+        self._wakeup.set()
+
+    def run_pending(self) -> int:
+        """
+        Handles the stored deliveries in the calling thread.
+
+        :return: The number of deliveries handled
+        :rtype: int
+        """
+        handled = 0
+        while True:
+            with closing(connect()) as conn:
+                deliveries = get_received_deliveries(conn, self.batch_size)
+            if not deliveries:
+                return handled
+            for delivery_id, event, body in deliveries:
+                job_id = None
+                try:
+                    status, job_id = self.handler(event, body)
+                except Exception as e:
+                    print(f"Delivery {delivery_id} raised an exception: {e}")
+                    status = "error"
+                get_writer().write(finish_delivery, delivery_id, status, job_id)
+                handled += 1
+
+    def _prune(self):
+        if time.time() - self._last_prune < 3600:
+            return
+        self._last_prune = time.time()
+        get_writer().write(prune_deliveries, time.time() - DELIVERY_RETENTION_SECONDS)
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                self.run_pending()
+                self._prune()
+            except Exception as e:
+                print(f"Delivery processor error: {e}")
+            self._wakeup.wait(self.poll_interval)
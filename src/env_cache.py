@@ -0,0 +1,303 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+import resource_usage
+import sandbox
+from cache_utils import cache_lock, touch, evict_lru, directory_size
+
+# Prebuilt virtual environments are kept here, one per environment key
+ENV_CACHE_DIR = os.getenv("CI_ENV_CACHE_DIR", "/tmp/ci-env-cache")
+# Least recently used environments are evicted once the cache grows past this size
+ENV_CACHE_MAX_BYTES = int(os.getenv("CI_ENV_CACHE_MAX_BYTES", str(20 * 1024**3)))
+# Requirement files installed into the environment when they exist in the repository
+REQUIREMENTS_FILES = [
+    "requirements.txt",
+    "requirements-dev.txt",
+    "requirements-test.txt",
+]
+
+# Marker files, one inside cached environments and one inside checkouts
+_COMPLETE_MARKER = "ci-env-complete"
+_KEY_MARKER = "ci-env-key"
+
+# Cached environments that are not evicted while in use outside of a checkout
+_pinned = set()
+_pinned_lock = threading.Lock()
+
+
+def venv_python(venv_dir: str) -> str:
+    """
+    Returns the path of the python executable of a virtual environment.
+
+    :param venv_dir: The virtual environment directory
+    :type venv_dir: str
+    :rtype: str
+    """
+    if os.name == "nt":
+        return os.path.join(venv_dir, "Scripts", "python.exe")
+    return os.path.join(venv_dir, "bin", "python")
+
+
+def _requirement_files(repo_path: str) -> list:
+    # Requirement files of the repository including the ones they reference with -r/-c
+    pending = [os.path.join(repo_path, name) for name in REQUIREMENTS_FILES]
+    found = []
+    while pending:
+        file = os.path.normpath(pending.pop(0))
+        if file in found or not os.path.isfile(file):
+            continue
+        found.append(file)
+        with open(file) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[0] in ("-r", "--requirement", "-c"):
+                    pending.append(os.path.join(os.path.dirname(file), parts[1]))
+    return found
+
+
+def interpreter_version(python: str = sys.executable) -> str:
+    """
+    Returns the full version string of an interpreter.
+
+    :param python: Path of the python executable
+    :type python: str
+    :rtype: str
+    """
+    if python == sys.executable:
+        return sys.version
+    result = sandbox.run(
+        [python, "-c", "import sys; print(sys.version)"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip()
+
+
+def environment_key(
+    repo_path: str, python: str = sys.executable, extra_packages: tuple = ()
+) -> str:
+    """
+    Hashes the interpreter version, the requirement files of a repository and
+    the extra packages. Checkouts with the same key can share one environment.
+
+    :param repo_path: Path to the checked out repository
+    :type repo_path: str
+    :param python: The interpreter the environment is created with
+    :type python: str
+    :param extra_packages: Tools installed in addition to pytest
+    :type extra_packages: tuple
+
+    :return: Hex digest identifying the environment
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    digest.update(interpreter_version(python).encode())
+    for package in sorted(extra_packages):
+        digest.update(f"+{package}".encode())
+    for file in _requirement_files(repo_path):
+        digest.update(os.path.relpath(file, repo_path).encode())
+        with open(file, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:24]
+
+
+def _is_cacheable(repo_path: str) -> bool:
+    # Editable installs point into the checkout they were installed from, and
+    # local paths and URLs may change without the requirement line changing,
+    # e.g. the project's own package installed with "."
+    for file in _requirement_files(repo_path):
+        with open(file) as f:
+            for line in f:
+                requirement = line.split(" #")[0].strip()
+                if requirement.startswith(("-e", "--editable")):
+                    return False
+                if requirement.startswith("-"):
+                    continue
+                if requirement.startswith((".", "/", "~", "file:")):
+                    return False
+                if "://" in requirement:
+                    return False
+    return True
+
+
+def _pip_cache_dir() -> str:
+    # pip's cache directory on Linux and macOS, downloads are kept in its http cache
+    return os.getenv("PIP_CACHE_DIR") or os.path.join(
+        os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "pip"
+    )
+
+
+def _pip_install(python_executable: str, args: list, cwd: str = None):
+    # Installs with pip and counts what it downloaded, i.e. how much its http cache grew.
+    # Nothing is counted when pip's cache is disabled.
+    cache_dirs = [os.path.join(_pip_cache_dir(), d) for d in ("http", "http-v2")]
+    before = sum(directory_size(d) for d in cache_dirs)
+    sandbox.run([python_executable, "-m", "pip", "install", *args], cwd=cwd, check=True)
+    resource_usage.add_downloaded(sum(directory_size(d) for d in cache_dirs) - before)
+
+
+def _create_environment(
+    repo_path: str, env_dir: str, python: str, extra_packages: tuple = ()
+):
+    # Create the environment with pip, install the requirements and make sure pytest
+    # and the extra packages are available. ensurepip runs with the build limits
+    # like the installs, also for the server's own interpreter
+    sandbox.run([python, "-m", "venv", env_dir], check=True)
+    python_executable = venv_python(env_dir)
+
+    for name in REQUIREMENTS_FILES:
+        file = os.path.join(repo_path, name)
+        if not os.path.isfile(file):
+            continue
+        # Requirement files may reference each other relatively
+        _pip_install(python_executable, ["-r", name], cwd=repo_path)
+        print(f"Requirements installed successfully from {name}.")
+
+    missing = []
+    for package in ["pytest", *extra_packages]:
+        result = sandbox.run(
+            [python_executable, "-c", f"import {package}"], capture_output=True
+        )
+        if result.returncode != 0:
+            missing.append(package)
+    if missing:
+        _pip_install(python_executable, missing)
+
+
+def _clone_environment(source: str, target: str):
+    # Hardlink the cached environment into the checkout, falling back to copies across devices
+    try:
+        shutil.copytree(source, target, symlinks=True, copy_function=os.link)
+    except (OSError, shutil.Error):
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.copytree(source, target, symlinks=True)
+
+
+def prepare_environment(
+    repo_path: str, python: str = sys.executable, extra_packages: tuple = ()
+) -> (str, bool):
+    """
+    Provides a virtual environment with the repository's requirements,
+    pytest and the extra packages installed in repo_path/.venv.
+
+    Environments are built once per environment key in ENV_CACHE_DIR and
+    hardlinked into each checkout. Requirements with editable installs are
+    installed directly into the checkout instead. Calling this again for the
+    same checkout reuses its environment.
+
+    :param repo_path: Path to the checked out repository
+    :type repo_path: str
+    :param python: The interpreter the environment is created with
+    :type python: str
+    :param extra_packages: Importable names of tools to install, e.g. coverage
+    :type extra_packages: tuple
+
+    :raises subprocess.CalledProcessError: If creating the environment or
+                                           installing the requirements fails
+    :raises sandbox.LimitExceeded: If it exceeded a build limit
+
+    :return: The python executable of the environment
+    :return: True if the environment came from the cache, False if it was built
+    :rtype: (str, bool)
+    """
+    repo_path = os.path.abspath(repo_path)
+    venv_dir = os.path.join(repo_path, ".venv")
+    key = environment_key(repo_path, python, extra_packages)
+    key_file = os.path.join(venv_dir, _KEY_MARKER)
+
+    if os.path.isfile(key_file):
+        with open(key_file) as f:
+            if f.read() == key:
+                return venv_python(venv_dir), True
+    shutil.rmtree(venv_dir, ignore_errors=True)
+
+    if not _is_cacheable(repo_path):
+        _create_environment(repo_path, venv_dir, python, extra_packages)
+        hit = False
+    else:
+        os.makedirs(ENV_CACHE_DIR, exist_ok=True)
+        cached = os.path.join(ENV_CACHE_DIR, key)
+        with cache_lock(cached):
+            hit = os.path.exists(os.path.join(cached, _COMPLETE_MARKER))
+            if not hit:
+                shutil.rmtree(cached, ignore_errors=True)
+                try:
+                    _create_environment(repo_path, cached, python, extra_packages)
+                except (subprocess.CalledProcessError, sandbox.LimitExceeded):
+                    shutil.rmtree(cached, ignore_errors=True)
+                    raise
+                open(os.path.join(cached, _COMPLETE_MARKER), "w").close()
+            _clone_environment(cached, venv_dir)
+            touch(cached)
+        print(f"Environment {key} {'reused from' if hit else 'added to'} cache")
+        if not hit:
+            evict_environments()
+
+    with open(key_file, "w") as f:
+        f.write(key)
+    return venv_python(venv_dir), hit
+
+
+def cached_environment(python_executable: str) -> str:
+    """
+    Returns the cached environment a checkout's environment was cloned from.
+
+    :param python_executable: The interpreter returned by
+                              :py:func:`prepare_environment`
+    :type python_executable: str
+
+    :return: The directory of the cached environment, None if the environment
+             was built in the checkout, e.g. for editable installs
+    :rtype: str
+    """
+    venv_dir = os.path.dirname(os.path.dirname(os.path.abspath(python_executable)))
+    try:
+        with open(os.path.join(venv_dir, _KEY_MARKER)) as f:
+            cached = os.path.join(ENV_CACHE_DIR, f.read())
+    except OSError:
+        return None
+    if not os.path.exists(os.path.join(cached, _COMPLETE_MARKER)):
+        return None
+    return cached
+
+
+def pin_environment(path: str, pinned: bool = True):
+    """
+    Keeps a cached environment from being evicted, e.g. while interpreters
+    run from it, see :py:mod:`warm_runner`.
+
+    :param path: The directory of the cached environment
+    :type path: str
+    :param pinned: False to allow the eviction again
+    :type pinned: bool
+    """
+    with _pinned_lock:
+        if pinned:
+            _pinned.add(path)
+        else:
+            _pinned.discard(path)
+
+
+def _is_pinned(path: str) -> bool:
+    with _pinned_lock:
+        return path in _pinned
+
+
+def evict_environments(max_bytes: int = ENV_CACHE_MAX_BYTES) -> int:
+    """
+    Deletes least recently used environments until the cache fits in max_bytes.
+    Checkouts keep working since they hold hardlinks or copies, pinned
+    environments are skipped.
+
+    :param max_bytes: Size cap of the environment cache
+    :type max_bytes: int
+
+    :return: The number of bytes freed
+    :rtype: int
+    """
+    return evict_lru(ENV_CACHE_DIR, max_bytes, in_use=_is_pinned)
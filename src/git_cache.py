@@ -0,0 +1,180 @@
+import hashlib
+import os
+import shutil
+
+import resource_usage
+import sandbox
+from cache_utils import cache_lock, touch, evict_lru, directory_size
+
+# One bare mirror per clone url is kept here and shared by all builds
+GIT_CACHE_DIR = os.getenv("CI_GIT_CACHE_DIR", "/tmp/ci-git-cache")
+# Least recently used mirrors are evicted once the cache grows past this size
+GIT_CACHE_MAX_BYTES = int(os.getenv("CI_GIT_CACHE_MAX_BYTES", str(10 * 1024**3)))
+
+
+def mirror_path(git_url: str) -> str:
+    """
+    Returns the path of the bare mirror for a clone url.
+
+    :param git_url: The URL of the repository
+    :type git_url: str
+    :rtype: str
+    """
+    name = git_url.rstrip("/").split("/")[-1].removesuffix(".git")
+    digest = hashlib.sha1(git_url.encode()).hexdigest()[:12]
+    return os.path.join(GIT_CACHE_DIR, f"{name}-{digest}.git")
+
+
+def _has_commit(mirror: str, sha: str) -> bool:
+    result = sandbox.run(
+        ["git", "cat-file", "-e", f"{sha}^{{commit}}"],
+        cwd=mirror,
+        capture_output=True,
+    )
+    return result.returncode == 0
+
+
+def _update_mirror(git_url: str, mirror: str, sha: str) -> bool:
+    # Must be called with the mirror locked, returns True if anything was downloaded
+    objects = os.path.join(mirror, "objects")
+    if not os.path.exists(os.path.join(mirror, "HEAD")):
+        shutil.rmtree(mirror, ignore_errors=True)
+        sandbox.run(["git", "clone", "--bare", git_url, mirror], check=True)
+        sandbox.run(
+            ["git", "config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*"],
+            cwd=mirror,
+            check=True,
+        )
+        resource_usage.add_downloaded(directory_size(objects))
+        print(f"Created mirror {mirror}")
+        return True
+
+    if sha is not None and _has_commit(mirror, sha):
+        return False
+
+    # The fetched objects are what the mirror grows by, packs are stored as received
+    size = directory_size(objects)
+    sandbox.run(["git", "fetch", "--prune", "--tags", "origin"], cwd=mirror, check=True)
+    if sha is not None and not _has_commit(mirror, sha):
+        # The commit is no longer on a branch, e.g. after a force-push
+        sandbox.run(["git", "fetch", "origin", sha], cwd=mirror, check=True)
+    resource_usage.add_downloaded(directory_size(objects) - size)
+    return True
+
+
+def update_mirror(git_url: str, sha: str = None) -> str:
+    """
+    Creates or incrementally fetches the bare mirror of a repository.
+    Nothing is fetched if the mirror already contains sha.
+
+    :param git_url: The URL of the repository
+    :type git_url: str
+    :param sha: Commit that has to be present in the mirror
+    :type sha: str
+
+    :raises subprocess.CalledProcessError: If a git command fails
+
+    :return: The path of the mirror
+    :rtype: str
+    """
+    os.makedirs(GIT_CACHE_DIR, exist_ok=True)
+    mirror = mirror_path(git_url)
+    with cache_lock(mirror):
+        downloaded = _update_mirror(git_url, mirror, sha)
+        touch(mirror)
+    if downloaded:
+        evict_mirrors()
+    return mirror
+
+
+def checkout_commit(git_url: str, sha: str, path: str) -> str:
+    """
+    Checks out a commit into path as a worktree of the repository's mirror,
+    so only the missing objects are downloaded and the history is shared.
+
+    :param git_url: The URL of the repository
+    :type git_url: str
+    :param sha: The commit to check out
+    :type sha: str
+    :param path: Directory for the checkout, must not exist
+    :type path: str
+
+    :raises subprocess.CalledProcessError: If a git command fails
+    :raises sandbox.LimitExceeded: If a git command exceeded a build limit
+
+    :return: The path of the mirror
+    :rtype: str
+    """
+    os.makedirs(GIT_CACHE_DIR, exist_ok=True)
+    mirror = mirror_path(git_url)
+    with cache_lock(mirror):
+        downloaded = _update_mirror(git_url, mirror, sha)
+        sandbox.run(
+            ["git", "worktree", "add", "--detach", "--force", path, sha],
+            cwd=mirror,
+            check=True,
+        )
+        touch(mirror)
+    if downloaded:
+        evict_mirrors()
+    return mirror
+
+
+def tree_hash(path: str) -> str:
+    """
+    Returns the hash of the tree checked out in path. Commits with the same
+    content have the same tree, e.g. a revert and the commit before the
+    reverted one.
+
+    :param path: Directory of the checkout
+    :type path: str
+
+    :raises subprocess.CalledProcessError: If path is not a checkout
+
+    :rtype: str
+    """
+    result = sandbox.run(
+        ["git", "rev-parse", "HEAD^{tree}"],
+        cwd=path,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip()
+
+
+def remove_checkout(git_url: str, path: str):
+    """
+    Deletes a checkout created by checkout_commit and unregisters the worktree.
+
+    :param git_url: The URL of the repository
+    :type git_url: str
+    :param path: Directory of the checkout
+    :type path: str
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    mirror = mirror_path(git_url)
+    if not os.path.isdir(mirror):
+        return
+    with cache_lock(mirror):
+        sandbox.run(["git", "worktree", "prune"], cwd=mirror, capture_output=True)
+
+
+def _has_worktrees(mirror: str) -> bool:
+    sandbox.run(["git", "worktree", "prune"], cwd=mirror, capture_output=True)
+    worktrees = os.path.join(mirror, "worktrees")
+    return os.path.isdir(worktrees) and len(os.listdir(worktrees)) > 0
+
+
+def evict_mirrors(max_bytes: int = GIT_CACHE_MAX_BYTES) -> int:
+    """
+    Deletes least recently used mirrors until the cache fits in max_bytes.
+    Mirrors that still have checkouts are kept.
+
+    :param max_bytes: Size cap of the mirror cache
+    :type max_bytes: int
+
+    :return: The number of bytes freed
+    :rtype: int
+    """
+    return evict_lru(GIT_CACHE_DIR, max_bytes, in_use=_has_worktrees)
@@ -0,0 +1,273 @@
+import hashlib
+import json
+import os
+
+import sandbox
+
+# Run only the tests affected by a push, based on coverage of earlier full runs
+TEST_IMPACT = os.getenv("CI_TEST_IMPACT", "0") == "1"
+# Commits a push may be ahead of the last full run before the full suite runs again
+TEST_IMPACT_MAX_COMMITS = int(os.getenv("CI_TEST_IMPACT_MAX_COMMITS", "50"))
+# Coverage configuration and report written into the repository by full runs
+COVERAGE_CONFIG = os.path.join(".ci", "coveragerc")
+COVERAGE_JSON = os.path.join(".ci", "coverage.json")
+# Changes to these files can affect any test, so they force a full run
+CONFIG_FILES = [
+    "requirements.txt",
+    "requirements-dev.txt",
+    "requirements-test.txt",
+    "setup.py",
+    "setup.cfg",
+    "pyproject.toml",
+    "pytest.ini",
+    "tox.ini",
+    ".coveragerc",
+    "conftest.py",
+]
+# Changes to documentation never affect tests
+IGNORED_SUFFIXES = (".md", ".rst")
+
+
+def config_hash(repo_path: str) -> str:
+    """
+    Hashes the configuration files in the root of the repository.
+    An index built with a different configuration is not used.
+
+    :param repo_path: Path to the repository
+    :type repo_path: str
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for name in CONFIG_FILES:
+        file = os.path.join(repo_path, name)
+        if os.path.isfile(file):
+            with open(file, "rb") as f:
+                digest.update(name.encode() + hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def changed_files(repo_path: str, before: str, after: str) -> list:
+    """
+    Lists the files changed between two commits.
+
+    :param repo_path: Path to the repository
+    :type repo_path: str
+    :param before: The commit before the push
+    :type before: str
+    :param after: The pushed commit
+    :type after: str
+
+    :return: Changed paths relative to the repository, or None if the diff is
+             unknown, e.g. for a new branch or a commit missing from the mirror
+    :rtype: list
+    """
+    if not before or set(before) == {"0"}:
+        return None
+    result = sandbox.run(
+        ["git", "diff", "--name-only", before, after],
+        cwd=repo_path,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return None
+    return [line for line in result.stdout.splitlines() if line]
+
+
+def index_is_current(
+    repo_path: str, commit: str, head: str, max_commits: int = TEST_IMPACT_MAX_COMMITS
+) -> bool:
+    """
+    Checks whether the index built at a commit can be used for a push. It
+    can not when the commit is not an ancestor of the push, e.g. after a
+    force-push, or more than max_commits behind it.
+
+    :param repo_path: Path to the repository
+    :type repo_path: str
+    :param commit: The commit of the last full run
+    :type commit: str
+    :param head: The pushed commit
+    :type head: str
+    :param max_commits: Commits the push may be ahead of the index
+    :type max_commits: int
+    :rtype: bool
+    """
+    result = sandbox.run(
+        ["git", "rev-list", "--count", f"{commit}..{head}"],
+        cwd=repo_path,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0 or int(result.stdout) > max_commits:
+        return False
+    ancestor = sandbox.run(
+        ["git", "merge-base", "--is-ancestor", commit, head],
+        cwd=repo_path,
+        capture_output=True,
+    )
+    return ancestor.returncode == 0
+
+
+def is_test_file(path: str) -> bool:
+    """
+    Returns whether a file is a test module by pytest's default naming.
+
+    :param path: Path relative to the repository
+    :type path: str
+    :rtype: bool
+    """
+    name = os.path.basename(path)
+    return name.endswith(".py") and (
+        name.startswith("test_") or name.endswith("_test.py")
+    )
+
+
+def select_tests(index, changed: list, current_config_hash: str) -> list:
+    """
+    Selects the test files affected by the changed files. Changed test files
+    always run, whether the index knows them or not.
+
+    :param index: (commit, config hash, {source file: set of test files}) as
+                  stored by the last full run, or None
+    :param changed: Files changed since the commit of the index, as returned
+                    by changed_files
+    :type changed: list
+    :param current_config_hash: config_hash of the pushed commit
+    :type current_config_hash: str
+
+    :return: The test files to run, or None if the full suite has to run
+             because the index is missing or stale, or a change is not covered
+    :rtype: list
+    """
+    if index is None or changed is None:
+        return None
+    _, indexed_config_hash, mapping = index
+    if indexed_config_hash != current_config_hash:
+        return None
+
+    test_files = set().union(*mapping.values()) if mapping else set()
+    selected = set()
+    for file in changed:
+        if os.path.basename(file) in CONFIG_FILES:
+            return None
+        if file.endswith(IGNORED_SUFFIXES) or file.startswith("docs/"):
+            continue
+        if file in test_files or is_test_file(file):
+            # New and edited test files, deleted ones are dropped by the caller
+            selected.add(file)
+            selected.update(mapping.get(file, ()))
+        elif file in mapping:
+            selected.update(mapping[file])
+        else:
+            return None
+    return sorted(selected)
+
+
+def write_coverage_config(repo_path: str) -> str:
+    """
+    Writes the coverage configuration used by full runs. Every test function
+    gets its own coverage context so lines can be traced back to tests.
+
+    :param repo_path: Path to the repository
+    :type repo_path: str
+
+    :return: Path of the configuration file
+    :rtype: str
+    """
+    repo_path = os.path.abspath(repo_path)
+    rcfile = os.path.join(repo_path, COVERAGE_CONFIG)
+    os.makedirs(os.path.dirname(rcfile), exist_ok=True)
+    with open(rcfile, "w") as f:
+        f.write(
+            "[run]\n"
+            "dynamic_context = test_function\n"
+            "parallel = True\n"
+            f"data_file = {os.path.join(repo_path, '.ci', '.coverage')}\n"
+            f"source = {repo_path}\n"
+            "omit =\n"
+            f"    {os.path.join(repo_path, '.venv', '*')}\n"
+            f"    {os.path.join(repo_path, '.ci', '*')}\n"
+        )
+    return rcfile
+
+
+def _module_names(test_file: str) -> list:
+    # Module names a test file may be imported as, depending on pytest's rootdir handling
+    parts = test_file.removesuffix(".py").split("/")
+    return [".".join(parts[i:]) for i in range(len(parts))]
+
+
+def map_contexts(report: dict, repo_path: str, test_files: set) -> dict:
+    """
+    Maps each measured source file to the test files that executed it.
+
+    :param report: Coverage JSON report written with --show-contexts
+    :type report: dict
+    :param repo_path: Path to the repository
+    :type repo_path: str
+    :param test_files: Test files of the run, relative to the repository
+    :type test_files: set
+
+    :return: {source file: set of test files}, paths relative to the repository
+    :rtype: dict
+    """
+    modules = {}
+    for test_file in test_files:
+        for name in _module_names(test_file):
+            modules.setdefault(name, test_file)
+
+    def test_file_of(context):
+        # Contexts are "module.Class.function", find the longest known module prefix
+        parts = context.split(".")
+        for i in range(len(parts) - 1, 0, -1):
+            test_file = modules.get(".".join(parts[:i]))
+            if test_file is not None:
+                return test_file
+        return None
+
+    mapping = {}
+    for file, data in report.get("files", {}).items():
+        if os.path.isabs(file):
+            file = os.path.relpath(file, repo_path)
+        file = file.replace(os.sep, "/")
+        contexts = {c for line in data.get("contexts", {}).values() for c in line}
+        tests = {test_file_of(c) for c in contexts if c} - {None}
+        if tests:
+            mapping[file] = tests
+    return mapping
+
+
+def collect_coverage(
+    repo_path: str, python_executable: str, rcfile: str, test_files: set
+) -> dict:
+    """
+    Combines the coverage data of a full run and maps it with map_contexts.
+
+    :param repo_path: Path to the repository
+    :type repo_path: str
+    :param python_executable: Interpreter of the build environment
+    :type python_executable: str
+    :param rcfile: Configuration written by write_coverage_config
+    :type rcfile: str
+    :param test_files: Test files of the run, relative to the repository
+    :type test_files: set
+
+    :return: {source file: set of test files}, empty if no data was collected
+    :rtype: dict
+    """
+    report = os.path.join(repo_path, COVERAGE_JSON)
+    for command in (
+        ["combine", f"--rcfile={rcfile}"],
+        ["json", f"--rcfile={rcfile}", "--show-contexts", "-o", report],
+    ):
+        result = sandbox.run(
+            [python_executable, "-m", "coverage", *command],
+            cwd=repo_path,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            print(f"Could not collect coverage: {result.stderr}")
+            return {}
+    with open(report) as f:
+        return map_contexts(json.load(f), repo_path, test_files)
@@ -0,0 +1,255 @@
+import datetime
+import gzip
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from build_log import iter_log as iter_live_log, log_path
+from db import (
+    insert_log_chunks,
+    get_log_chunks,
+    get_log_digests,
+    prune_build_logs,
+)
+
+try:
+    import zstandard
+except ImportError:  # Blobs are gzip compressed instead
+    zstandard = None
+
+# Finished build logs are kept here as compressed blobs named after their content hash
+LOG_STORE_DIR = os.getenv("CI_LOG_STORE_DIR", "/tmp/ci-log-store")
+# Logs of builds older than this many days are deleted, the builds are kept. 0 keeps them forever
+LOG_RETENTION_DAYS = int(os.getenv("CI_LOG_RETENTION_DAYS", "90"))
+# Seconds between two runs of the retention policy
+LOG_PRUNE_INTERVAL = 3600
+# Unreferenced blobs younger than this are kept, a build may be about to reference them
+BLOB_GRACE_SECONDS = 3600
+
+_prune_lock = threading.Lock()
+_last_prune = 0.0
+
+
+def _blob_base(digest: str) -> str:
+    return os.path.join(LOG_STORE_DIR, digest[:2], digest)
+
+
+def _existing_blob(digest: str) -> str:
+    # Blobs are read back whichever codec they were written with
+    for suffix in (".zst", ".gz"):
+        path = _blob_base(digest) + suffix
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def put_blob(data: bytes) -> str:
+    """
+    Stores data compressed in the log store, once per distinct content.
+
+    :param data: The content to store
+    :type data: bytes
+
+    :return: The sha256 hex digest of the content, which identifies the blob
+    :rtype: str
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    existing = _existing_blob(digest)
+    if existing is not None:
+        # Refresh the blob so the garbage collection leaves it alone
+        os.utime(existing)
+        return digest
+
+    path = _blob_base(digest) + (".zst" if zstandard is not None else ".gz")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        if zstandard is not None:
+            f.write(zstandard.ZstdCompressor().compress(data))
+        else:
+            f.write(gzip.compress(data))
+    os.replace(tmp, path)
+    return digest
+
+
+def read_blob(digest: str) -> bytes:
+    """
+    Reads the content of a blob.
+
+    :param digest: The digest returned by :py:func:`put_blob`
+    :type digest: str
+
+    :raises FileNotFoundError: If the blob does not exist
+
+    :rtype: bytes
+    """
+    path = _existing_blob(digest)
+    if path is None:
+        raise FileNotFoundError(_blob_base(digest))
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".zst"):
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def archive_log(conn, build_id: int) -> int:
+    """
+    Moves the finished log of a build from the log directory into the log
+    store. Every chunk of the log becomes a blob, chunks with the same content
+    are stored once, and the chunk list of the build is kept in the database.
+
+    :param conn: Database connection
+    :param build_id: The id of the build
+    :type build_id: int
+
+    :return: The size of the log in bytes
+    :rtype: int
+    """
+    chunks = []
+    offset = 0
+    for data in iter_live_log(build_id):
+        chunks.append((offset, len(data), put_blob(data)))
+        offset += len(data)
+    insert_log_chunks(conn, build_id, chunks)
+    shutil.rmtree(log_path(build_id), ignore_errors=True)
+    return offset
+
+
+def append_log(conn, build_id: int, source_id: int) -> int:
+    """
+    Appends the archived log of another build to the archived log of a
+    build. Nothing is copied, both builds reference the same blobs.
+
+    :param conn: Database connection
+    :param build_id: The id of the build whose log grows
+    :type build_id: int
+    :param source_id: The id of the build whose log is appended
+    :type source_id: int
+
+    :return: The size of the log in bytes
+    :rtype: int
+    """
+    size = log_size(conn, build_id) or 0
+    chunks = [
+        (size + offset, length, digest)
+        for offset, length, digest in get_log_chunks(conn, source_id)
+    ]
+    insert_log_chunks(conn, build_id, chunks)
+    return size + sum(length for _, length, _ in chunks)
+
+
+def log_size(conn, build_id: int) -> int:
+    """
+    Returns the size in bytes of an archived log, None if the build has none.
+
+    :param conn: Database connection
+    :param build_id: The id of the build
+    :type build_id: int
+    :rtype: int
+    """
+    chunks = get_log_chunks(conn, build_id)
+    if not chunks:
+        return None
+    offset, size, _ = chunks[-1]
+    return offset + size
+
+
+def iter_log(conn, build_id: int):
+    """
+    Reads an archived log chunk by chunk.
+
+    :param conn: Database connection
+    :param build_id: The id of the build
+    :type build_id: int
+
+    :return: Yields the contents of the chunks as bytes
+    """
+    for _, _, digest in get_log_chunks(conn, build_id):
+        yield read_blob(digest)
+
+
+def read_range(conn, build_id: int, offset: int, length: int) -> bytes:
+    """
+    Reads part of an archived log, only the chunks that overlap the range
+    are decompressed.
+
+    :param conn: Database connection
+    :param build_id: The id of the build
+    :type build_id: int
+    :param offset: Byte offset of the range
+    :type offset: int
+    :param length: Maximum number of bytes to read
+    :type length: int
+    :rtype: bytes
+    """
+    end = offset + length
+    parts = []
+    for start, size, digest in get_log_chunks(conn, build_id):
+        if start + size <= offset or start >= end:
+            continue
+        data = read_blob(digest)
+        parts.append(data[max(0, offset - start) : end - start])
+    return b"".join(parts)
+
+
+def prune_logs(conn, retention_days: int = LOG_RETENTION_DAYS) -> int:
+    """
+    Applies the retention policy. The logs of builds older than retention_days
+    are removed from the database and blobs no build refers to any more are
+    deleted from the log store. The builds themselves are kept.
+
+    :param conn: Database connection
+    :param retention_days: Age in days after which logs are removed, 0 keeps them
+    :type retention_days: int
+
+    :return: The number of builds whose logs were removed
+    :rtype: int
+    """
+    pruned = 0
+    if retention_days > 0:
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+        pruned = prune_build_logs(conn, cutoff.strftime("%Y-%m-%d %H:%M:%S"))
+
+    if not os.path.isdir(LOG_STORE_DIR):
+        return pruned
+    referenced = get_log_digests(conn)
+    now = time.time()
+    freed = 0
+    for dirpath, _, filenames in os.walk(LOG_STORE_DIR):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if (
+                name.split(".")[0] in referenced
+                or now - stat.st_mtime < BLOB_GRACE_SECONDS
+            ):
+                continue
+            os.remove(path)
+            freed += stat.st_size
+    if pruned or freed:
+        print(f"Pruned the logs of {pruned} builds, freed {freed} bytes")
+    return pruned
+
+
+def prune_logs_if_due(conn) -> bool:
+    """
+    Runs :py:func:`prune_logs` unless it ran in the last LOG_PRUNE_INTERVAL seconds.
+
+    :param conn: Database connection
+
+    :return: True if the retention policy ran
+    :rtype: bool
+    """
+    global _last_prune
+    with _prune_lock:
+        if time.time() - _last_prune < LOG_PRUNE_INTERVAL:
+            return False
+        _last_prune = time.time()
+    prune_logs(conn)
+    return True
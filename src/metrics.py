@@ -0,0 +1,250 @@
+import bisect
+import math
+import threading
+
+# Upper bounds in seconds of the histogram buckets of fast operations, e.g. requests
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds in seconds of the histogram buckets of build stages
+BUILD_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+# Metrics in the order they are exposed
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    Base of the metrics. Every thread records into its own shard, so recording
+    never waits for another thread, and the shards are summed when scraped.
+    The shards of exited threads are folded into a base shard, so threads
+    that come and go, e.g. one per request, do not add up.
+    """
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        # (thread, shard) of the threads that recorded since the last prune
+        self._shards = []
+        # The totals of the exited threads, only changed with the lock held
+        self._base = {}
+        self._shards_lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            # Only taken once per thread
+            with self._shards_lock:
+                self._prune()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _prune(self):
+        # Folds the shards of exited threads into the base, called with the lock held
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self._base, shard)
+        self._shards = alive
+
+    def _merge(self, total: dict, shard: dict):
+        """
+        Adds the values of a shard to total.
+        """
+        raise NotImplementedError
+
+    def _snapshots(self):
+        with self._shards_lock:
+            self._prune()
+            base = {}
+            self._merge(base, self._base)
+            shards = [shard for _, shard in self._shards]
+        # dict.copy does not release the GIL, the owning thread may keep writing
+        return [base] + [shard.copy() for shard in shards]
+
+    def samples(self):
+        """
+        Returns the current (suffix, labels, value) samples of the metric.
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_number(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """
+    A count that only goes up, e.g. the number of webhook deliveries.
+
+    :param name: The metric name
+    :type name: str
+    :param documentation: The help text
+    :type documentation: str
+    :param labels: The label names
+    :type labels: tuple
+    """
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Increases the count of the labels by amount.
+        """
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """
+        Returns the count of the labels summed over all threads.
+        """
+        key = self._key(labels)
+        return sum(shard.get(key, 0) for shard in self._snapshots())
+
+    def _merge(self, total: dict, shard: dict):
+        for key, value in shard.items():
+            total[key] = total.get(key, 0) + value
+
+    def samples(self):
+        totals = {}
+        for shard in self._snapshots():
+            self._merge(totals, shard)
+        for key in sorted(totals):
+            yield "_total", _labels(self.labels, key), totals[key]
+
+
+class Histogram(_Metric):
+    """
+    Counts observations, e.g. durations, in buckets by upper bound.
+
+    :param name: The metric name
+    :type name: str
+    :param documentation: The help text
+    :type documentation: str
+    :param labels: The label names
+    :type labels: tuple
+    :param buckets: Upper bounds of the buckets in increasing order
+    :type buckets: tuple
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        """
+        Records an observation for the labels.
+        """
+        shard = self._shard()
+        key = self._key(labels)
+        counts = shard.get(key)
+        if counts is None:
+            # One count per bucket, one for larger values, and the sum
+            counts = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, total: dict, shard: dict):
+        for key, counts in shard.items():
+            merged = total.setdefault(key, [0] * len(counts))
+            for i, count in enumerate(list(counts)):
+                merged[i] += count
+
+    def samples(self):
+        totals = {}
+        for shard in self._snapshots():
+            self._merge(totals, shard)
+        for key in sorted(totals):
+            counts = totals[key]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                yield "_bucket", _labels(self.labels, key, le), cumulative
+            yield "_sum", _labels(self.labels, key), counts[-1]
+            yield "_count", _labels(self.labels, key), cumulative
+
+
+class Gauge(_Metric):
+    """
+    A value read when the metrics are scraped, e.g. the queue depth.
+
+    :param name: The metric name
+    :type name: str
+    :param documentation: The help text
+    :type documentation: str
+    :param function: Returns the value, or with labels a dictionary of label
+                     value tuples to values
+    :type function: callable
+    :param labels: The label names
+    :type labels: tuple
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, function, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def samples(self):
+        values = self.function()
+        if not self.labels:
+            values = {(): values}
+        for key in sorted(values):
+            yield "", _labels(self.labels, key), values[key]
+
+
+def render() -> str:
+    """
+    Returns all metrics in the Prometheus text exposition format. A metric
+    that fails to read is left out.
+
+    :rtype: str
+    """
+    parts = []
+    for metric in REGISTRY:
+        try:
+            parts.append(metric.render())
+        except Exception as e:
+            print(f"Metric {metric.name} could not be read: {e}")
+    return "\n".join(parts) + "\n"
@@ -0,0 +1,268 @@
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import resource_usage
+import sandbox
+import warm_runner
+from build_log import stream_process
+
+# Number of pytest processes a test suite is split across
+TEST_SHARDS = int(os.getenv("CI_TEST_SHARDS", "1"))
+# Merged JUnit XML report, relative to the repository
+JUNIT_REPORT = os.path.join(".ci", "junit.xml")
+# Assumed runtime in seconds of a test file without history
+DEFAULT_FILE_DURATION = 1.0
+# Characters of a failure message kept with a test result
+TEST_MESSAGE_LENGTH = 2000
+
+
+def collect_test_files(path: str, python_executable: str, env: dict = None) -> list:
+    """
+    Lists the files that contain tests according to pytest's collection.
+
+    :param path: Path to the repository
+    :type path: str
+    :param python_executable: Interpreter of the build environment
+    :type python_executable: str
+    :param env: Environment variables set for pytest besides the server's
+    :type env: dict
+
+    :return: Test files relative to path, in collection order
+    :rtype: list
+    """
+    args = ["--collect-only", "-q"]
+    environment = _environment(env)
+    result = None
+    if warm_runner.WARM_RUNNER:
+        result = warm_runner.pool.run(python_executable, path, args, env=environment)
+    if result is not None:
+        output = result[1]
+    else:
+        output = sandbox.run(
+            [python_executable, "-m", "pytest", *args],
+            cwd=path,
+            env=environment,
+            capture_output=True,
+            text=True,
+        ).stdout
+    files = []
+    for line in output.splitlines():
+        if "::" in line:
+            file = line.split("::")[0]
+            if file not in files:
+                files.append(file)
+    return files
+
+
+def _environment(env: dict) -> dict:
+    # The server's environment with the variables of the build, None without any
+    if not env:
+        return None
+    return {**os.environ, **env}
+
+
+def plan_shards(test_files: list, shards: int, durations: dict = None) -> list:
+    """
+    Splits test files into shards with about the same expected runtime.
+    Files are assigned longest first to the shard with the least work so far.
+
+    :param test_files: The test files to distribute
+    :type test_files: list
+    :param shards: Maximum number of shards
+    :type shards: int
+    :param durations: Historical runtime in seconds of each test file, files
+                      without history are assumed to take DEFAULT_FILE_DURATION
+    :type durations: dict
+
+    :return: Lists of test files, empty shards are left out
+    :rtype: list
+    """
+    durations = durations or {}
+    plan = [[0.0, []] for _ in range(max(1, shards))]
+    for file in sorted(
+        test_files, key=lambda f: -durations.get(f, DEFAULT_FILE_DURATION)
+    ):
+        lightest = min(plan, key=lambda shard: shard[0])
+        lightest[0] += durations.get(file, DEFAULT_FILE_DURATION)
+        lightest[1].append(file)
+    return [files for _, files in plan if files]
+
+
+def merge_junit(reports: list, target: str):
+    """
+    Combines the test suites of several JUnit XML reports into one file.
+
+    :param reports: Paths of the reports to merge, missing files are skipped
+    :type reports: list
+    :param target: Path of the merged report
+    :type target: str
+    """
+    merged = ET.Element("testsuites")
+    for report in reports:
+        if not os.path.exists(report):
+            continue
+        root = ET.parse(report).getroot()
+        suites = [root] if root.tag == "testsuite" else root.findall("testsuite")
+        merged.extend(suites)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    ET.ElementTree(merged).write(target, encoding="utf-8", xml_declaration=True)
+
+
+def read_junit(report: str) -> list:
+    """
+    Reads the test cases of a JUnit XML report written with junit_family=xunit1.
+
+    :param report: Path of the report
+    :type report: str
+
+    :return: (test id, outcome, duration, message) tuples, the test id is the
+             pytest node id, the outcome is "passed", "failed", "error" or
+             "skipped" and the message is the failure message or skip reason,
+             None for passed tests
+    :rtype: list
+    """
+    if not os.path.exists(report):
+        return []
+    results = []
+    for case in ET.parse(report).getroot().iter("testcase"):
+        file = case.get("file", "")
+        module = file.removesuffix(".py").replace("/", ".")
+        classname = case.get("classname", "")
+        parts = [file or classname]
+        if file and classname.startswith(module + "."):
+            parts.append(classname[len(module) + 1 :].replace(".", "::"))
+        parts.append(case.get("name", ""))
+
+        outcome = "passed"
+        message = None
+        for tag, name in (
+            ("failure", "failed"),
+            ("error", "error"),
+            ("skipped", "skipped"),
+        ):
+            element = case.find(tag)
+            if element is not None:
+                outcome = name
+                message = (element.get("message") or element.text or "")[
+                    :TEST_MESSAGE_LENGTH
+                ]
+                break
+        results.append(("::".join(parts), outcome, float(case.get("time", 0)), message))
+    return results
+
+
+def _run_shard(
+    path: str,
+    python_executable: str,
+    files: list,
+    report: str,
+    coverage_rc: str,
+    log,
+    prefix: str,
+    env: dict = None,
+) -> (int, str):
+    args = [f"--junitxml={report}", "-o", "junit_family=xunit1", *files]
+    environment = _environment(env)
+    # Sessions under coverage need the coverage command, they always start cold
+    if warm_runner.WARM_RUNNER and coverage_rc is None:
+        result = warm_runner.pool.run(
+            python_executable, path, args, log, prefix, environment
+        )
+        if result is not None:
+            return result
+    command = [python_executable, "-m"]
+    if coverage_rc is not None:
+        command += ["coverage", "run", f"--rcfile={coverage_rc}", "-m"]
+    command += ["pytest", *args]
+    if log is not None:
+        return stream_process(command, path, log, prefix, environment), ""
+    result = sandbox.run(
+        command, cwd=path, env=environment, capture_output=True, text=True
+    )
+    return result.returncode, result.stdout + result.stderr
+
+
+def run_pytest(
+    path: str,
+    python_executable: str,
+    shards: int = TEST_SHARDS,
+    durations: dict = None,
+    files: list = None,
+    coverage_rc: str = None,
+    log=None,
+    env: dict = None,
+) -> (bool, str):
+    """
+    Runs the test suite, split by test file across `shards` concurrent pytest
+    processes. The JUnit XML reports of the shards are merged into JUNIT_REPORT.
+    With the warm runner enabled the sessions run in pre-forked interpreters,
+    see :py:mod:`warm_runner`.
+
+    :param path: Path to the repository
+    :type path: str
+    :param python_executable: Interpreter of the build environment
+    :type python_executable: str
+    :param shards: Maximum number of pytest processes
+    :type shards: int
+    :param durations: Historical runtime in seconds of each test file
+    :type durations: dict
+    :param files: Only run these test files instead of the whole suite
+    :type files: list
+    :param coverage_rc: Run pytest under coverage with this configuration
+    :type coverage_rc: str
+    :param log: Stream the output into this log while pytest runs instead of
+                returning it, the lines of each shard are prefixed with its number
+    :type log: build_log.BuildLog
+    :param env: Environment variables set for pytest besides the server's
+    :type env: dict
+
+    :return: True if every shard passed
+    :return: The output of pytest, one section per shard, empty if it was
+             written to log
+    :rtype: (bool, str)
+    """
+    plan = [[]]
+    if files is not None:
+        plan = plan_shards(files, shards, durations)
+    elif shards > 1:
+        plan = plan_shards(
+            collect_test_files(path, python_executable, env), shards, durations
+        )
+    plan = plan or [[]]
+
+    usage = resource_usage.current()
+    limits = sandbox.current()
+
+    def run(i):
+        prefix = f"[{i + 1}/{len(plan)}] " if len(plan) > 1 else ""
+        with resource_usage.attach(usage), sandbox.attach(limits):
+            return _run_shard(
+                path,
+                python_executable,
+                plan[i],
+                reports[i],
+                coverage_rc,
+                log,
+                prefix,
+                env,
+            )
+
+    with tempfile.TemporaryDirectory() as reports_dir:
+        reports = [
+            os.path.join(reports_dir, f"shard-{i}.xml") for i in range(len(plan))
+        ]
+        with ThreadPoolExecutor(max_workers=len(plan)) as pool:
+            results = list(pool.map(run, range(len(plan))))
+        merge_junit(reports, os.path.join(path, JUNIT_REPORT))
+
+    if log is not None or len(results) == 1:
+        output = results[0][1]
+    else:
+        output = "\n".join(
+            f"== shard {i + 1}/{len(results)} ==\n{output}"
+            for i, (_, output) in enumerate(results)
+        )
+    passed = all(returncode == 0 for returncode, _ in results)
+    return passed, output
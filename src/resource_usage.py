@@ -0,0 +1,198 @@
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+# Guards records shared by the worker threads of a stage
+_lock = threading.Lock()
+
+
+def new_usage() -> dict:
+    """
+    Returns an empty usage record.
+
+    :return: Dictionary with cpu_time in seconds, the max_rss of the largest
+             process in KiB and the bytes downloaded
+    :rtype: dict
+    """
+    return {"cpu_time": 0.0, "max_rss": 0, "downloaded": 0}
+
+
+def current() -> dict:
+    """
+    Returns the usage record of the calling thread, None outside of
+    :py:func:`measure`.
+
+    :rtype: dict
+    """
+    return getattr(_local, "usage", None)
+
+
+@contextmanager
+def attach(usage: dict):
+    """
+    Adds the usage of the calling thread to a record for the duration of the
+    block, used by worker threads helping with a measured stage.
+
+    :param usage: The record, None to measure nothing
+    :type usage: dict
+    """
+    previous = current()
+    _local.usage = usage
+    start = time.thread_time()
+    try:
+        yield usage
+    finally:
+        if usage is not None:
+            with _lock:
+                usage["cpu_time"] += time.thread_time() - start
+        _local.usage = previous
+
+
+@contextmanager
+def measure():
+    """
+    Measures the CPU time of the calling thread and of the processes it runs
+    with :py:func:`run` or :py:class:`Popen`, the peak memory of those
+    processes and the bytes reported with :py:func:`add_downloaded`.
+
+    Builds run in parallel threads, so the usage of a child is read when it is
+    reaped instead of from the process-wide RUSAGE_CHILDREN totals.
+
+    :return: Yields the usage record, see :py:func:`new_usage`
+    :rtype: dict
+    """
+    with attach(new_usage()) as usage:
+        yield usage
+
+
+def add_downloaded(size: int):
+    """
+    Counts bytes downloaded by the calling thread.
+
+    :param size: The number of bytes
+    :type size: int
+    """
+    usage = current()
+    if usage is not None and size > 0:
+        with _lock:
+            usage["downloaded"] += size
+
+
+def add_process(rusage):
+    """
+    Counts a process the calling thread ran but did not reap itself, e.g. a
+    test session of the warm runner.
+
+    :param rusage: The resource usage of the process, with ru_utime,
+                   ru_stime and ru_maxrss like :py:func:`os.wait4` returns it
+    """
+    usage = current()
+    if usage is not None:
+        _add_rusage(usage, rusage)
+
+
+def _add_rusage(usage: dict, rusage):
+    with _lock:
+        usage["cpu_time"] += rusage.ru_utime + rusage.ru_stime
+        # ru_maxrss is in KiB on Linux, the largest of the process and its reaped children
+        usage["max_rss"] = max(usage["max_rss"], rusage.ru_maxrss)
+
+
+class Popen(subprocess.Popen):
+    """
+    :py:class:`subprocess.Popen` that adds the resource usage of the process
+    to the usage record of the thread that started it. The usage of the
+    process alone is kept in rusage once it was waited for.
+    """
+
+    rusage = None
+
+    def __init__(self, *args, **kwargs):
+        self._usage = current()
+        super().__init__(*args, **kwargs)
+
+    if hasattr(os, "wait4"):
+
+        # Popen.wait reaps the process here, wait4 also returns its resource usage
+        def _try_wait(self, wait_flags):
+            try:
+                pid, sts, rusage = os.wait4(self.pid, wait_flags)
+            except ChildProcessError:
+                return self.pid, 0
+            if pid == self.pid:
+                self.rusage = rusage
+                if self._usage is not None:
+                    _add_rusage(self._usage, rusage)
+            return pid, sts
+
+
+def run(
+    *popenargs, input=None, capture_output=False, timeout=None, check=False, **kwargs
+) -> subprocess.CompletedProcess:
+    """
+    :py:func:`subprocess.run` with the resource usage of the process added to
+    the usage record of the calling thread, takes the same arguments.
+
+    :rtype: subprocess.CompletedProcess
+    """
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+    if capture_output:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    with Popen(*popenargs, **kwargs) as process:
+        try:
+            stdout, stderr = process.communicate(input, timeout=timeout)
+        except:  # Including KeyboardInterrupt, like subprocess.run
+            process.kill()
+            raise
+        returncode = process.poll()
+    if check and returncode:
+        raise subprocess.CalledProcessError(
+            returncode, process.args, output=stdout, stderr=stderr
+        )
+    return subprocess.CompletedProcess(process.args, returncode, stdout, stderr)
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Returns the p-th percentile of values, None if there are none.
+
+    :param values: The measurements
+    :type values: list
+    :param p: The percentile between 0 and 100
+    :type p: float
+    """
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return values[round(p / 100 * (len(values) - 1))]
+
+
+def stage_percentiles(rows) -> dict:
+    """
+    Aggregates the usage of stages of many builds.
+
+    :param rows: (stage, duration, cpu_time, max_rss, downloaded) rows
+    :type rows: list
+
+    :return: Dictionary of stage to a dictionary of duration, cpu_time,
+             max_rss and downloaded, each a (p50, p95) pair
+    :rtype: dict
+    """
+    columns = ("duration", "cpu_time", "max_rss", "downloaded")
+    values = {}
+    for stage, *measurements in rows:
+        per_stage = values.setdefault(stage, {column: [] for column in columns})
+        for column, value in zip(columns, measurements):
+            per_stage[column].append(value)
+    return {
+        stage: {
+            column: (percentile(v, 50), percentile(v, 95))
+            for column, v in per_stage.items()
+        }
+        for stage, per_stage in values.items()
+    }
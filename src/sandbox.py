@@ -0,0 +1,444 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import resource_usage
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Memory in MiB a build command may use, 0 for no limit
+BUILD_MEMORY_MB = int(os.getenv("CI_BUILD_MEMORY_MB", "0"))
+# CPU seconds a single build process may use, 0 for no limit
+BUILD_CPU_SECONDS = int(os.getenv("CI_BUILD_CPU_SECONDS", "0"))
+# Processes a build command may run at once, 0 for no limit
+BUILD_MAX_PROCESSES = int(os.getenv("CI_BUILD_MAX_PROCESSES", "0"))
+# CPUs a build command may keep busy, only enforced with cgroups, 0 for no limit
+BUILD_CPUS = float(os.getenv("CI_BUILD_CPUS", "0"))
+# Delegated cgroup v2 directory, every build command runs in a child group of it.
+# Without it the limits are set as rlimits of the command's process.
+CGROUP_ROOT = os.getenv("CI_CGROUP_ROOT", "")
+# Seconds between the soft and the hard CPU rlimit, i.e. SIGXCPU and SIGKILL
+CPU_GRACE_SECONDS = 5
+# With rlimits a command that failed after using this share of the memory
+# limit is taken to have run out of memory
+OOM_RSS_RATIO = 0.9
+# Seconds between checks whether the build of a running command was cancelled
+CANCEL_POLL_SECONDS = 0.2
+
+_local = threading.local()
+
+_MESSAGES = {
+    "timed_out": "ran out of time",
+    "oom": "ran out of memory",
+    "superseded": "was cancelled",
+}
+
+
+class LimitExceeded(subprocess.SubprocessError):
+    """
+    Raised when a build command was killed because it exceeded a limit.
+
+    :param status: "timed_out" for the wall-clock or CPU time limit, "oom"
+                   for the memory limit, "superseded" if the build was
+                   cancelled
+    :type status: str
+    :param cmd: The command
+    :type cmd: list
+    """
+
+    def __init__(self, status: str, cmd):
+        super().__init__(status, cmd)
+        self.status = status
+        self.cmd = cmd
+
+    def __str__(self):
+        return f"Command '{self.cmd}' {_MESSAGES[self.status]}"
+
+
+def new_limits(
+    timeout: float = None,
+    memory_mb: int = BUILD_MEMORY_MB,
+    cpu_seconds: int = BUILD_CPU_SECONDS,
+    processes: int = BUILD_MAX_PROCESSES,
+    cpus: float = BUILD_CPUS,
+    cancelled: threading.Event = None,
+) -> dict:
+    """
+    Returns the limits of a build stage, 0 or None means no limit.
+
+    :param timeout: Wall-clock seconds from now until the commands are killed
+    :type timeout: float
+    :param cancelled: The commands are killed once it is set
+    :type cancelled: threading.Event
+
+    :return: Dictionary with the monotonic deadline, memory in bytes,
+             cpu_seconds, processes, cpus and the cancelled event
+    :rtype: dict
+    """
+    return {
+        "deadline": time.monotonic() + timeout if timeout is not None else None,
+        "memory": memory_mb * 1024 * 1024,
+        "cpu_seconds": cpu_seconds,
+        "processes": processes,
+        "cpus": cpus,
+        "cancelled": cancelled,
+    }
+
+
+def current() -> dict:
+    """
+    Returns the limits of the calling thread, None outside of :py:func:`limit`.
+
+    :rtype: dict
+    """
+    return getattr(_local, "limits", None)
+
+
+@contextmanager
+def attach(limits: dict):
+    """
+    Applies limits to the commands the calling thread runs for the duration
+    of the block, used by worker threads helping with a limited stage.
+
+    :param limits: The limits, None for no limits
+    :type limits: dict
+    """
+    previous = current()
+    _local.limits = limits
+    try:
+        yield limits
+    finally:
+        _local.limits = previous
+
+
+@contextmanager
+def limit(timeout: float = None, **kwargs):
+    """
+    Runs the commands started with :py:func:`run` or :py:class:`Popen` in
+    the block with the build limits, see :py:func:`new_limits`. All commands
+    share the wall-clock deadline, a command that exceeds a limit is killed
+    together with every process it started and raises
+    :py:class:`LimitExceeded`.
+
+    :param timeout: Wall-clock seconds the block may take, None for no limit
+    :type timeout: float
+
+    :return: Yields the limits
+    :rtype: dict
+    """
+    with attach(new_limits(timeout, **kwargs)) as limits:
+        yield limits
+
+
+def check_start(limits: dict, cmd):
+    """
+    Refuses to start a command when its build ran out of time or was cancelled.
+
+    :param limits: The limits, see :py:func:`new_limits`
+    :type limits: dict
+    :param cmd: The command
+    :type cmd: list
+
+    :raises LimitExceeded: If the command must not start
+    """
+    if limits.get("cancelled") is not None and limits["cancelled"].is_set():
+        raise LimitExceeded("superseded", cmd)
+    if limits["deadline"] is not None and limits["deadline"] <= time.monotonic():
+        raise LimitExceeded("timed_out", cmd)
+
+
+class Watchdog(threading.Thread):
+    """
+    Kills a command at the deadline of its limits or once its build is
+    cancelled. Stop it with :py:meth:`cancel` when the command finished.
+
+    :param limits: The limits of the command, see :py:func:`new_limits`
+    :type limits: dict
+    :param expire: Called with "timed_out" or "superseded" to kill the command
+    :type expire: callable
+    """
+
+    def __init__(self, limits: dict, expire):
+        super().__init__(daemon=True)
+        self.limits = limits
+        self.expire = expire
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def needed(limits: dict) -> bool:
+        """
+        Returns whether the commands of the limits need a watchdog.
+
+        :rtype: bool
+        """
+        return limits["deadline"] is not None or limits.get("cancelled") is not None
+
+    def run(self):
+        deadline = self.limits["deadline"]
+        cancelled = self.limits.get("cancelled")
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                self.expire("superseded")
+                return
+            wait = CANCEL_POLL_SECONDS if cancelled is not None else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.expire("timed_out")
+                    return
+                wait = remaining if wait is None else min(wait, remaining)
+            if self._stopped.wait(wait):
+                return
+
+    def cancel(self):
+        """
+        Stops watching, the command finished.
+        """
+        self._stopped.set()
+
+
+def _write(path: str, value: str):
+    with open(path, "w") as f:
+        f.write(value)
+
+
+def _create_cgroup(pid: int, limits: dict) -> str:
+    path = os.path.join(CGROUP_ROOT, f"ci-{pid}")
+    os.mkdir(path)
+    settings = {}
+    if limits["memory"]:
+        settings["memory.max"] = str(limits["memory"])
+        settings["memory.swap.max"] = "0"
+    if limits["processes"]:
+        settings["pids.max"] = str(limits["processes"])
+    if limits["cpus"]:
+        settings["cpu.max"] = f"{int(limits['cpus'] * 100000)} 100000"
+    for name, value in settings.items():
+        _write(os.path.join(path, name), value)
+    _write(os.path.join(path, "cgroup.procs"), str(pid))
+    return path
+
+
+def _oom_killed(cgroup: str) -> bool:
+    try:
+        with open(os.path.join(cgroup, "memory.events")) as f:
+            events = dict(line.split() for line in f if line.strip())
+    except OSError:
+        return False
+    return int(events.get("oom_kill", 0)) > 0
+
+
+def apply_limits(pid: int, limits: dict) -> str:
+    """
+    Applies the memory, process and CPU limits to a running process, with
+    a cgroup when CGROUP_ROOT is set and as rlimits otherwise.
+
+    :param pid: The process, the leader of its own session
+    :type pid: int
+    :param limits: The limits, see :py:func:`new_limits`
+    :type limits: dict
+
+    :raises OSError: If a limit could not be set
+
+    :return: The cgroup of the process, None without cgroups
+    :rtype: str
+    """
+    cgroup = None
+    if CGROUP_ROOT:
+        cgroup = _create_cgroup(pid, limits)
+    if resource is None or not hasattr(resource, "prlimit"):
+        return cgroup
+    if limits["cpu_seconds"]:
+        soft = limits["cpu_seconds"]
+        resource.prlimit(pid, resource.RLIMIT_CPU, (soft, soft + CPU_GRACE_SECONDS))
+    if cgroup is not None:
+        return cgroup
+    if limits["memory"]:
+        resource.prlimit(pid, resource.RLIMIT_AS, (limits["memory"], limits["memory"]))
+    if limits["processes"]:
+        # Counted per user by the kernel, cgroups limit the command only
+        resource.prlimit(
+            pid, resource.RLIMIT_NPROC, (limits["processes"], limits["processes"])
+        )
+    return cgroup
+
+
+def kill_group(pid: int, cgroup: str = None):
+    """
+    Kills a process started in its own session and every process it started.
+
+    :param pid: The process
+    :type pid: int
+    :param cgroup: The cgroup returned by :py:func:`apply_limits`
+    :type cgroup: str
+    """
+    if cgroup is not None:
+        try:
+            _write(os.path.join(cgroup, "cgroup.kill"), "1")
+        except OSError:
+            pass
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def exceeded_limit(returncode: int, rusage, limits: dict, cgroup: str = None) -> str:
+    """
+    Returns which limit a finished process exceeded.
+
+    :param returncode: The return code of the process
+    :type returncode: int
+    :param rusage: The resource usage of the process, None if unknown
+    :param limits: The limits of the process
+    :type limits: dict
+    :param cgroup: The cgroup returned by :py:func:`apply_limits`
+    :type cgroup: str
+
+    :return: "timed_out" if it was killed for its CPU time, "oom" if it ran
+             out of memory, otherwise None
+    :rtype: str
+    """
+    if hasattr(signal, "SIGXCPU") and returncode == -signal.SIGXCPU:
+        return "timed_out"
+    if cgroup is not None:
+        return "oom" if _oom_killed(cgroup) else None
+    memory = limits["memory"]
+    if returncode and memory and rusage is not None:
+        # ru_maxrss is in KiB
+        if rusage.ru_maxrss * 1024 >= memory * OOM_RSS_RATIO:
+            return "oom"
+    return None
+
+
+def remove_cgroup(cgroup: str):
+    """
+    Removes the cgroup of a finished process.
+
+    :param cgroup: The cgroup returned by :py:func:`apply_limits`
+    :type cgroup: str
+    """
+    # The killed processes leave the group shortly after the signal
+    for _ in range(100):
+        try:
+            os.rmdir(cgroup)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(0.01)
+    print(f"Could not remove cgroup {cgroup}")
+
+
+class Popen(resource_usage.Popen):
+    """
+    :py:class:`resource_usage.Popen` that enforces the limits of the thread
+    that started it, see :py:func:`limit`. Without limits it behaves the same.
+
+    The command runs in its own session so it can be killed with everything
+    it started. Memory, process and CPU limits are set with cgroups when
+    CGROUP_ROOT is set and as rlimits otherwise, a watchdog kills the
+    command at the deadline or once the build is cancelled. Call :py:meth:`check_limits` once the process
+    was waited for.
+    """
+
+    def __init__(self, args, **kwargs):
+        self.limits = current()
+        self.limit_exceeded = None
+        self._cgroup = None
+        self._watchdog = None
+        self._finished = False
+        if self.limits is None:
+            super().__init__(args, **kwargs)
+            return
+
+        check_start(self.limits, args)
+        if os.name == "posix":
+            kwargs["start_new_session"] = True
+        super().__init__(args, **kwargs)
+        # The limits are applied right after the start instead of in a
+        # preexec_fn, which may deadlock in a process with threads
+        try:
+            self._cgroup = apply_limits(self.pid, self.limits)
+        except OSError as e:
+            print(f"Could not limit process {self.pid}: {e}")
+        if Watchdog.needed(self.limits):
+            self._watchdog = Watchdog(self.limits, self._expire)
+            self._watchdog.start()
+
+    def _expire(self, status: str):
+        if self.returncode is None:
+            self.limit_exceeded = status
+            self.kill()
+
+    def kill(self):
+        """
+        Kills the command and, when it is limited, every process it started.
+        """
+        if self.limits is None or os.name != "posix":
+            super().kill()
+            return
+        kill_group(self.pid, self._cgroup)
+
+    def wait(self, timeout: float = None) -> int:
+        returncode = super().wait(timeout)
+        if self.limits is not None and not self._finished:
+            self._finished = True
+            self._finish()
+        return returncode
+
+    def _finish(self):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+        # Nothing the command left running in the background outlives it
+        self.kill()
+        if self.limit_exceeded is None:
+            self.limit_exceeded = exceeded_limit(
+                self.returncode, self.rusage, self.limits, self._cgroup
+            )
+        if self._cgroup is not None:
+            remove_cgroup(self._cgroup)
+
+    def check_limits(self):
+        """
+        Raises :py:class:`LimitExceeded` if the command was killed by a limit.
+        """
+        if self.limit_exceeded is not None:
+            raise LimitExceeded(self.limit_exceeded, self.args)
+
+
+def run(
+    *popenargs, input=None, capture_output=False, timeout=None, check=False, **kwargs
+) -> subprocess.CompletedProcess:
+    """
+    :py:func:`resource_usage.run` with the limits of the calling thread
+    enforced, takes the same arguments.
+
+    :raises LimitExceeded: If the command exceeded a limit
+
+    :rtype: subprocess.CompletedProcess
+    """
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+    if capture_output:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    with Popen(*popenargs, **kwargs) as process:
+        try:
+            stdout, stderr = process.communicate(input, timeout=timeout)
+        except:  # Including KeyboardInterrupt, like subprocess.run
+            process.kill()
+            raise
+        returncode = process.poll()
+    process.check_limits()
+    if check and returncode:
+        raise subprocess.CalledProcessError(
+            returncode, process.args, output=stdout, stderr=stderr
+        )
+    return subprocess.CompletedProcess(process.args, returncode, stdout, stderr)
@@ -0,0 +1,523 @@
+import fnmatch
+import json
+import os
+import threading
+import time
+import uuid
+from threading import Thread
+from contextlib import closing
+
+from db import (
+    connect,
+    enqueue_job,
+    claim_next_job,
+    finish_job,
+    supersede_jobs,
+    requeue_interrupted_jobs,
+    renew_lease,
+    requeue_expired_leases,
+    get_job,
+    get_queue_stats,
+    get_wait_stats,
+)
+from metrics import Histogram, BUILD_BUCKETS
+
+# Number of builds that may run at the same time
+BUILD_WORKERS = int(os.getenv("CI_BUILD_WORKERS", "2"))
+# Pushes are rejected once this many jobs are waiting in the queue
+MAX_QUEUE_DEPTH = int(os.getenv("CI_MAX_QUEUE_DEPTH", "100"))
+# Skip queued builds of a branch once a newer push to the same branch arrives
+COALESCE_BUILDS = os.getenv("CI_COALESCE_BUILDS", "1") == "1"
+# Also abort superseded builds that are already running
+ABORT_SUPERSEDED = os.getenv("CI_ABORT_SUPERSEDED", "0") == "1"
+# Seconds a build agent may go without renewing its lease before its job is queued again
+AGENT_LEASE_SECONDS = float(os.getenv("CI_AGENT_LEASE_SECONDS", "60"))
+# Seconds between checks for expired leases
+LEASE_CHECK_INTERVAL = 5.0
+# Names of the priority classes, jobs of the first class run first
+PRIORITY_CLASSES = ("high", "normal")
+# Branches built with high priority besides the default branch and tags, comma separated patterns
+PRIORITY_BRANCHES = [
+    pattern.strip()
+    for pattern in os.getenv("CI_PRIORITY_BRANCHES", "release/*,release-*").split(",")
+    if pattern.strip()
+]
+# Seconds after which a queued job moves up a priority class, so none is starved, 0 to disable
+PRIORITY_AGING_SECONDS = float(os.getenv("CI_PRIORITY_AGING_SECONDS", "600"))
+# Jobs of one repository that may run at the same time, 0 for no limit
+MAX_RUNNING_PER_REPO = int(os.getenv("CI_MAX_RUNNING_PER_REPO", "0"))
+# Seconds of started jobs a repository's share of the workers is measured over
+FAIR_SHARE_WINDOW = float(os.getenv("CI_FAIR_SHARE_WINDOW", "3600"))
+
+QUEUE_WAIT_SECONDS = Histogram(
+    "ci_queue_wait_seconds",
+    "Time jobs waited in the build queue by priority class",
+    ("priority",),
+    BUILD_BUCKETS,
+)
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the build queue is at capacity."""
+
+
+def coalesce_key(payload: dict) -> str:
+    """
+    Returns the key that identifies pushes which supersede each other.
+    The cells of a build matrix only supersede the same cell of earlier pushes.
+
+    :param payload: The json payload of the push event
+    :type payload: dict
+
+    :return: "owner/repo:ref", "owner/repo:ref [cell]" for a matrix cell, or
+             None if the payload has no ref
+    :rtype: str
+    """
+    ref = payload.get("ref")
+    if ref is None:
+        return None
+    repository = payload["repository"]
+    key = f"{repository['owner']['login']}/{repository['name']}:{ref}"
+    if payload.get("matrix"):
+        key += f" [{payload['matrix']['name']}]"
+    return key
+
+
+def job_repo(payload: dict) -> str:
+    """
+    Returns the repository of a push, the unit of fair sharing.
+
+    :param payload: The json payload of the push event
+    :type payload: dict
+
+    :return: "owner/repo", or None if the payload has no repository
+    :rtype: str
+    """
+    repository = payload.get("repository")
+    if not repository:
+        return None
+    return f"{repository['owner']['login']}/{repository['name']}"
+
+
+def job_priority(payload: dict, branches: list = PRIORITY_BRANCHES) -> int:
+    """
+    Returns the priority class of a push, see PRIORITY_CLASSES. Pushes to
+    the default branch, to tags and to branches matching one of the
+    patterns are "high", all others "normal".
+
+    :param payload: The json payload of the push event
+    :type payload: dict
+    :param branches: fnmatch patterns of release branches
+    :type branches: list
+
+    :return: The index of the class in PRIORITY_CLASSES
+    :rtype: int
+    """
+    ref = payload.get("ref") or ""
+    if ref.startswith("refs/tags/"):
+        return 0
+    if ref.startswith("refs/heads/"):
+        branch = ref[len("refs/heads/") :]
+        if branch == (payload.get("repository") or {}).get("default_branch"):
+            return 0
+        if any(fnmatch.fnmatchcase(branch, pattern) for pattern in branches):
+            return 0
+    return 1
+
+
+class BuildScheduler:
+    """
+    Durable build queue drained by a bounded pool of worker threads.
+
+    Jobs are stored in the ``jobs`` table so that they survive a restart; jobs
+    that were running when the server stopped are put back on the queue by
+    :py:meth:`start`. The workers are threads because the expensive parts of a
+    build (clone, pip, pytest) already run in subprocesses.
+
+    With coalescing enabled, a push supersedes the queued jobs of earlier pushes
+    to the same branch, and optionally aborts the ones that are already running.
+
+    The next job is picked by priority class, see :py:func:`job_priority`. A
+    job moves up a class for every aging_seconds it waited, so a busy high
+    class never starves the others. Within a class the repository with the
+    fewest running jobs, and then the fewest jobs started in the last
+    share_window seconds, goes first, so a repository that pushes constantly
+    only gets its share of the workers. Repositories already running
+    max_running_per_repo jobs are skipped. Every pick is recorded in the
+    ``schedule_decisions`` table with the time the job waited.
+
+    Jobs can also be leased to build agents running on other hosts, see
+    :py:meth:`lease`. An agent renews its lease while it builds, jobs whose
+    lease expires, e.g. because the agent died, are queued again. With zero
+    workers the scheduler only queues jobs for the agents.
+
+    :param handler: Called with the payload of each job and a threading.Event that
+                    is set when the job is superseded, returns 200 on success
+    :type handler: callable
+    :param workers: Number of worker threads
+    :type workers: int
+    :param max_queue_depth: Maximum number of queued jobs before submits are rejected
+    :type max_queue_depth: int
+    :param poll_interval: Seconds an idle worker waits before checking the queue again
+    :type poll_interval: float
+    :param coalesce: Whether newer pushes supersede queued jobs of the same branch
+    :type coalesce: bool
+    :param abort_superseded: Whether superseded jobs that are running are aborted
+    :type abort_superseded: bool
+    :param on_superseded: Called with the payloads of the skipped and the replacing push
+    :type on_superseded: callable
+    :param lease_seconds: Seconds a lease lasts without being renewed
+    :type lease_seconds: float
+    :param on_lease_expired: Called with the job id and build id of each job
+                             whose lease expired
+    :type on_lease_expired: callable
+    :param aging_seconds: Seconds of waiting that raise a job one priority class,
+                          0 to disable aging
+    :type aging_seconds: float
+    :param max_running_per_repo: Jobs of one repository that may run at the
+                                 same time, 0 for no limit
+    :type max_running_per_repo: int
+    :param share_window: Seconds of started jobs the fair share is measured over
+    :type share_window: float
+    """
+
+    def __init__(
+        self,
+        handler,
+        workers: int = BUILD_WORKERS,
+        max_queue_depth: int = MAX_QUEUE_DEPTH,
+        poll_interval: float = 1.0,
+        coalesce: bool = COALESCE_BUILDS,
+        abort_superseded: bool = ABORT_SUPERSEDED,
+        on_superseded=None,
+        lease_seconds: float = AGENT_LEASE_SECONDS,
+        on_lease_expired=None,
+        aging_seconds: float = PRIORITY_AGING_SECONDS,
+        max_running_per_repo: int = MAX_RUNNING_PER_REPO,
+        share_window: float = FAIR_SHARE_WINDOW,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue_depth = max_queue_depth
+        self.poll_interval = poll_interval
+        self.coalesce = coalesce
+        self.abort_superseded = abort_superseded
+        self.on_superseded = on_superseded
+        self.lease_seconds = lease_seconds
+        self.on_lease_expired = on_lease_expired
+        self.aging_seconds = aging_seconds
+        self.max_running_per_repo = max_running_per_repo
+        self.share_window = share_window
+        self.active_workers = 0
+        # job id -> (payload, cancel event, superseding job id) of running jobs
+        self._running = {}
+        # job id -> superseding job id of leased jobs the agent has to abort
+        self._cancelled_leases = {}
+        self._threads = []
+        self._stopping = threading.Event()
+        self._wakeup = threading.Condition()
+        self._active_lock = threading.Lock()
+
+    def start(self) -> int:
+        """
+        Re-queues interrupted jobs, including the ones leased to agents, and
+        starts the worker threads and the check for expired leases.
+
+        :return: The number of jobs that were re-queued
+        :rtype: int
+        """
+        with closing(connect()) as conn:
+            requeued = requeue_interrupted_jobs(conn)
+        if requeued:
+            print(f"Re-queued {requeued} interrupted build(s)")
+
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = Thread(target=self._worker_loop, name=f"build-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        thread = Thread(target=self._lease_loop, name="lease-checker")
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+        return requeued
+
+    def stop(self, timeout: float = None):
+        """
+        Stops the workers after their current job has finished.
+
+        :param timeout: Seconds to wait for each worker to exit
+        :type timeout: float
+        """
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, payload: dict) -> int:
+        """
+        Adds a build to the queue and wakes up an idle worker.
+        Queued jobs of earlier pushes to the same branch are superseded.
+
+        :param payload: The json payload of the push event
+        :type payload: dict
+
+        :raises QueueFullError: If the queue already holds max_queue_depth jobs
+
+        :return: The id of the queued job
+        :rtype: int
+        """
+        key = coalesce_key(payload) if self.coalesce else None
+        with closing(connect()) as conn:
+            job_id = enqueue_job(
+                conn,
+                json.dumps(payload),
+                time.time(),
+                self.max_queue_depth,
+                key,
+                job_repo(payload),
+                job_priority(payload),
+            )
+            if job_id is None:
+                raise QueueFullError(
+                    f"Build queue is full ({self.max_queue_depth} jobs)"
+                )
+            if key is not None:
+                superseded, running = supersede_jobs(conn, key, job_id, time.time())
+            else:
+                superseded, running = [], []
+
+        for old_job_id, old_payload in superseded:
+            print(f"Job {old_job_id} superseded by job {job_id}")
+            self._report_superseded(json.loads(old_payload), payload)
+        if self.abort_superseded:
+            for old_job_id in running:
+                self._abort(old_job_id, job_id, payload)
+
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def stats(self) -> dict:
+        """
+        Returns the queue depth and wait times used to size the worker pool.
+
+        :return: Dictionary with queued, running, oldest_queued_wait, avg_wait,
+                 max_wait, workers and active_workers, and by priority class
+                 the jobs, avg_wait and max_wait of the jobs started within
+                 the share window
+        :rtype: dict
+        """
+        now = time.time()
+        with closing(connect()) as conn:
+            stats = get_queue_stats(conn, now)
+            waits = get_wait_stats(conn, now - self.share_window)
+        stats["priorities"] = {
+            name: dict(
+                zip(("jobs", "avg_wait", "max_wait"), waits.get(i, (0, 0.0, 0.0)))
+            )
+            for i, name in enumerate(PRIORITY_CLASSES)
+        }
+        stats["workers"] = self.workers
+        stats["active_workers"] = self.active_workers
+        return stats
+
+    def run_next(self) -> bool:
+        """
+        Claims and runs the next queued job in the calling thread.
+
+        :return: True if a job was run, False if the queue was empty
+        :rtype: bool
+        """
+        job = self._claim()
+        if job is None:
+            return False
+
+        job_id, payload, _, _ = job
+        payload = json.loads(payload)
+        cancelled = threading.Event()
+        with self._active_lock:
+            self.active_workers += 1
+            self._running[job_id] = [payload, cancelled, None]
+        status = "failed"
+        try:
+            if self.handler(payload, cancelled) == 200:
+                status = "done"
+        except Exception as e:
+            print(f"Job {job_id} raised an exception: {e}")
+        finally:
+            with self._active_lock:
+                self.active_workers -= 1
+                _, _, superseded_by = self._running.pop(job_id)
+            if cancelled.is_set():
+                status = "superseded"
+            with closing(connect()) as conn:
+                finish_job(conn, job_id, status, time.time(), superseded_by)
+            # Jobs held back by the repository's cap may run now
+            with self._wakeup:
+                self._wakeup.notify()
+        return True
+
+    def _claim(self, agent=None, lease_token=None):
+        now = time.time()
+        with closing(connect()) as conn:
+            job = claim_next_job(
+                conn,
+                now,
+                agent,
+                lease_token,
+                now + self.lease_seconds if agent is not None else None,
+                self.aging_seconds,
+                self.max_running_per_repo,
+                self.share_window,
+            )
+        if job is not None:
+            QUEUE_WAIT_SECONDS.observe(now - job[2], priority=PRIORITY_CLASSES[job[3]])
+        return job
+
+    def lease(self, agent: str) -> dict:
+        """
+        Leases the next queued job to a build agent. The agent has to renew
+        the lease with :py:meth:`renew` within lease_seconds and report the
+        outcome with :py:meth:`complete`.
+
+        :param agent: Name of the agent
+        :type agent: str
+
+        :return: Dictionary with job_id, payload, lease_token and
+                 lease_seconds, None if the queue is empty
+        :rtype: dict
+        """
+        token = uuid.uuid4().hex
+        job = self._claim(agent, token)
+        if job is None:
+            return None
+        print(f"Job {job[0]} leased to agent {agent}")
+        return {
+            "job_id": job[0],
+            "payload": json.loads(job[1]),
+            "lease_token": token,
+            "lease_seconds": self.lease_seconds,
+        }
+
+    def renew(self, job_id: int, lease_token: str) -> bool:
+        """
+        Extends the lease of a job by lease_seconds.
+
+        :param job_id: The leased job
+        :type job_id: int
+        :param lease_token: The token returned by :py:meth:`lease`
+        :type lease_token: str
+
+        :return: False if the lease expired or the job was queued again
+        :rtype: bool
+        """
+        with closing(connect()) as conn:
+            return renew_lease(
+                conn, job_id, lease_token, time.time() + self.lease_seconds
+            )
+
+    def is_cancelled(self, job_id: int) -> bool:
+        """
+        Returns whether the agent building a leased job has to abort it
+        because a newer push superseded it.
+
+        :rtype: bool
+        """
+        with self._active_lock:
+            return job_id in self._cancelled_leases
+
+    def complete(self, job_id: int, lease_token: str, status: str) -> bool:
+        """
+        Finishes a leased job, see :py:meth:`lease`.
+
+        :param job_id: The leased job
+        :type job_id: int
+        :param lease_token: The token returned by :py:meth:`lease`
+        :type lease_token: str
+        :param status: "done" or "failed", aborted jobs are finished as superseded
+        :type status: str
+
+        :return: False if the lease was lost, the job is then built again
+        :rtype: bool
+        """
+        with self._active_lock:
+            superseded_by = self._cancelled_leases.pop(job_id, None)
+        if superseded_by is not None:
+            status = "superseded"
+        with closing(connect()) as conn:
+            return finish_job(
+                conn, job_id, status, time.time(), superseded_by, lease_token
+            )
+
+    def expire_leases(self) -> list:
+        """
+        Queues the jobs whose lease expired again.
+
+        :return: The (job id, build id) of those jobs
+        :rtype: list
+        """
+        with closing(connect()) as conn:
+            expired = requeue_expired_leases(conn, time.time())
+        for job_id, build_id in expired:
+            print(f"Lease of job {job_id} expired, queued again")
+            with self._active_lock:
+                self._cancelled_leases.pop(job_id, None)
+            if self.on_lease_expired is not None:
+                try:
+                    self.on_lease_expired(job_id, build_id)
+                except Exception as e:
+                    print(f"Could not report the expired lease of job {job_id}: {e}")
+        if expired:
+            with self._wakeup:
+                self._wakeup.notify_all()
+        return expired
+
+    def _abort(self, job_id: int, superseded_by: int, payload: dict):
+        with self._active_lock:
+            running = self._running.get(job_id)
+            if running is not None:
+                if running[1].is_set():
+                    return
+                running[1].set()
+                running[2] = superseded_by
+        if running is None:
+            with closing(connect()) as conn:
+                job = get_job(conn, job_id)
+            # Leased to an agent, which is told by its next heartbeat
+            with self._active_lock:
+                leased = job is not None and job[2] == "running" and job[10]
+                if not leased or job_id in self._cancelled_leases:
+                    return
+                self._cancelled_leases[job_id] = superseded_by
+            running = [json.loads(job[1])]
+        print(f"Aborting job {job_id}, superseded by job {superseded_by}")
+        self._report_superseded(running[0], payload)
+
+    def _report_superseded(self, payload: dict, replacement: dict):
+        if self.on_superseded is None:
+            return
+        try:
+            self.on_superseded(payload, replacement)
+        except Exception as e:
+            print(f"Could not report superseded build: {e}")
+
+    def _lease_loop(self):
+        while not self._stopping.wait(LEASE_CHECK_INTERVAL):
+            try:
+                self.expire_leases()
+            except Exception as e:
+                print(f"Lease check failed: {e}")
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                if self.run_next():
+                    continue
+            except Exception as e:
+                print(f"Build worker error: {e}")
+            with self._wakeup:
+                self._wakeup.wait(self.poll_interval)
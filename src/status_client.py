@@ -0,0 +1,216 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Counter, Histogram
+
+# Seconds to wait for github to answer a status update
+STATUS_TIMEOUT = float(os.getenv("CI_STATUS_TIMEOUT", "10"))
+# Attempts before a status update that keeps failing is dropped
+STATUS_MAX_ATTEMPTS = int(os.getenv("CI_STATUS_MAX_ATTEMPTS", "6"))
+# Seconds an update waits in the outbox so a newer state for the same commit can replace it
+STATUS_COALESCE_SECONDS = float(os.getenv("CI_STATUS_COALESCE_SECONDS", "1"))
+# First and longest delay in seconds between attempts, the delay doubles after each failure
+STATUS_BACKOFF = 1.0
+STATUS_BACKOFF_MAX = 300.0
+# Seconds the sender thread waits for work before it exits
+SENDER_IDLE_SECONDS = 30.0
+
+GITHUB_REQUESTS = Counter(
+    "ci_github_requests",
+    "Status updates sent to github by outcome: sent, retry, wait (rate limited) or drop",
+    ("outcome",),
+)
+GITHUB_SECONDS = Histogram(
+    "ci_github_request_duration_seconds",
+    "Latency of the status update requests to github, failed connections included",
+)
+
+
+class StatusReporter:
+    """
+    Sends commit statuses to github from a background thread, so webhook
+    requests and builds never wait on the github API.
+
+    Updates wait in an outbox keyed by status URL, which includes the commit,
+    and context. A newer state for a commit and context replaces one that has
+    not been sent yet, e.g. pending followed quickly by success only sends
+    success, while the statuses of other contexts, e.g. the cells of a build
+    matrix, are all sent. All updates go
+    through one keep-alive session. Failed updates are retried with
+    exponential backoff, and while the X-RateLimit-* headers report an
+    exhausted rate limit nothing is sent until it resets.
+
+    :param timeout: Seconds to wait for a response
+    :type timeout: float
+    :param max_attempts: Attempts before an update is dropped
+    :type max_attempts: int
+    :param coalesce_seconds: Seconds an update waits before it is sent
+    :type coalesce_seconds: float
+    :param backoff: Delay in seconds after the first failed attempt
+    :type backoff: float
+    """
+
+    def __init__(
+        self,
+        timeout: float = STATUS_TIMEOUT,
+        max_attempts: int = STATUS_MAX_ATTEMPTS,
+        coalesce_seconds: float = STATUS_COALESCE_SECONDS,
+        backoff: float = STATUS_BACKOFF,
+    ):
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.coalesce_seconds = coalesce_seconds
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Epoch time before which the rate limit is exhausted
+        self.rate_limited_until = 0.0
+        self._outbox = {}
+        self._in_flight = None
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self, url: str, payload: dict, token: str):
+        """
+        Queues a status update, replacing an unsent update for the same URL
+        and context.
+
+        :param url: The statuses endpoint of the commit
+        :type url: str
+        :param payload: The status, with state, description and context
+        :type payload: dict
+        :param token: The github token used to authenticate
+        :type token: str
+        """
+        key = (url, payload.get("context"))
+        with self._condition:
+            previous = self._outbox.get(key)
+            due = time.time() + self.coalesce_seconds
+            if previous is not None and previous is not self._in_flight:
+                print(
+                    f"Status {previous['payload']['state']} replaced by {payload['state']}"
+                )
+                due = previous["due"]
+            self._outbox[key] = {
+                "key": key,
+                "url": url,
+                "payload": payload,
+                "headers": {"Authorization": f"token {token}"},
+                "attempts": 0,
+                "due": due,
+            }
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def pending(self) -> int:
+        """
+        Returns the number of updates waiting to be sent.
+
+        :rtype: int
+        """
+        with self._condition:
+            return len(self._outbox)
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until the outbox is empty.
+
+        :param timeout: Maximum number of seconds to wait
+        :type timeout: float
+
+        :return: True if every update was sent or dropped
+        :rtype: bool
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._outbox, timeout)
+
+    def _next_update(self) -> dict:
+        # Wait for the next update that is due, returns None once idle for SENDER_IDLE_SECONDS
+        with self._condition:
+            while True:
+                if not self._outbox:
+                    self._condition.wait(SENDER_IDLE_SECONDS)
+                    if not self._outbox:
+                        self._thread = None
+                        return None
+                    continue
+                update = min(self._outbox.values(), key=lambda u: u["due"])
+                delay = max(update["due"], self.rate_limited_until) - time.time()
+                if delay <= 0:
+                    self._in_flight = update
+                    return update
+                self._condition.wait(delay)
+
+    def _run(self):
+        while True:
+            update = self._next_update()
+            if update is None:
+                return
+            outcome, delay = self._send(update)
+            with self._condition:
+                self._in_flight = None
+                if self._outbox.get(update["key"]) is update:
+                    if outcome == "retry":
+                        update["attempts"] += 1
+                        if update["attempts"] >= self.max_attempts:
+                            print(f"Giving up on status update for {update['url']}")
+                            outcome = "drop"
+                    if outcome in ("sent", "drop"):
+                        del self._outbox[update["key"]]
+                    else:
+                        update["due"] = time.time() + delay
+                self._condition.notify_all()
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(STATUS_BACKOFF_MAX, self.backoff * 2**attempts)
+        return delay * random.uniform(0.5, 1.0)
+
+    def _send(self, update: dict) -> (str, float):
+        start = time.perf_counter()
+        outcome, delay = self._post(update)
+        GITHUB_SECONDS.observe(time.perf_counter() - start)
+        GITHUB_REQUESTS.inc(outcome=outcome)
+        return outcome, delay
+
+    def _post(self, update: dict) -> (str, float):
+        # Returns "sent", "retry", "wait" (rate limited) or "drop", and the delay before the next attempt
+        try:
+            response = self.session.post(
+                update["url"],
+                json=update["payload"],
+                headers=update["headers"],
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            print(f"Status update failed: {e}")
+            return "retry", self._backoff(update["attempts"])
+
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        retry_after = response.headers.get("Retry-After")
+        if remaining == "0" and reset is not None:
+            self.rate_limited_until = float(reset)
+        if response.status_code < 300:
+            return "sent", 0.0
+        if response.status_code in (403, 429) and (
+            remaining == "0" or retry_after is not None
+        ):
+            if retry_after is not None:
+                # Retry-After may also be an HTTP date, wait a minute then
+                seconds = float(retry_after) if retry_after.isdigit() else 60.0
+                self.rate_limited_until = time.time() + seconds
+            print(f"Rate limited by github until {self.rate_limited_until:.0f}")
+            return "wait", 0.0
+        if response.status_code >= 500:
+            return "retry", self._backoff(update["attempts"])
+        print(f"Status update rejected with {response.status_code}: {response.text}")
+        return "drop", 0.0
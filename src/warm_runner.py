@@ -0,0 +1,379 @@
+import json
+import os
+import socket
+import subprocess
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import resource_usage
+import sandbox
+from env_cache import cached_environment, pin_environment, venv_python
+from metrics import Counter
+
+# Run test sessions in pre-forked interpreters that already imported pytest, needs fork
+WARM_RUNNER = os.getenv("CI_WARM_RUNNER", "0") == "1" and hasattr(os, "fork")
+# Idle interpreters kept ready per environment
+WARM_RUNNER_SIZE = int(os.getenv("CI_WARM_RUNNER_SIZE", "2"))
+# Test sessions an interpreter runs before it is replaced by a fresh one
+WARM_RUNNER_MAX_RUNS = int(os.getenv("CI_WARM_RUNNER_MAX_RUNS", "20"))
+# Modules the interpreters import besides pytest and its plugins, comma separated
+WARM_RUNNER_PRELOAD = [
+    name.strip()
+    for name in os.getenv("CI_WARM_RUNNER_PRELOAD", "").split(",")
+    if name.strip()
+]
+# Environments with warm interpreters, the least recently used one loses its interpreters
+WARM_RUNNER_ENVIRONMENTS = int(os.getenv("CI_WARM_RUNNER_ENVIRONMENTS", "4"))
+# Seconds a new interpreter may take for its imports
+WARM_RUNNER_START_TIMEOUT = 60.0
+
+_WORKER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "warm_worker.py"
+)
+# Largest message exchanged with an interpreter, see warm_worker.MAX_MESSAGE
+_MAX_MESSAGE = 1024**2
+
+WARM_SESSIONS = Counter(
+    "ci_warm_runner_sessions",
+    "Test sessions by how they ran: warm, or cold when no warm interpreter was available",
+    ("mode",),
+)
+
+
+class WarmRunnerError(OSError):
+    """Raised when a warm interpreter could not be started or stopped responding."""
+
+
+class WarmInterpreter:
+    """
+    An interpreter of a cached environment that imported pytest once and
+    forks a child for every test session, see :py:mod:`warm_worker`.
+
+    :param python: The python executable of the cached environment
+    :type python: str
+    :param preload: Modules to import besides pytest and its plugins
+    :type preload: list
+
+    :raises WarmRunnerError: If the interpreter did not start
+    """
+
+    def __init__(self, python: str, preload: list = WARM_RUNNER_PRELOAD):
+        self.runs = 0
+        self._sock, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            # Not limited like the build commands, only its children run tests
+            self._process = subprocess.Popen(
+                [python, _WORKER_SCRIPT, str(theirs.fileno()), *preload],
+                pass_fds=[theirs.fileno()],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                cwd="/",
+            )
+        except OSError as e:
+            self._sock.close()
+            raise WarmRunnerError(f"Could not start {python}: {e}")
+        finally:
+            theirs.close()
+        self._sock.settimeout(WARM_RUNNER_START_TIMEOUT)
+        try:
+            self._receive()
+        except WarmRunnerError:
+            self.close()
+            raise
+        self._sock.settimeout(None)
+
+    def _receive(self) -> dict:
+        try:
+            data = self._sock.recv(_MAX_MESSAGE)
+        except OSError as e:
+            raise WarmRunnerError(f"Warm interpreter failed: {e}")
+        if not data:
+            raise WarmRunnerError("Warm interpreter exited")
+        return json.loads(data)
+
+    def alive(self) -> bool:
+        """
+        Returns whether the interpreter is still running.
+
+        :rtype: bool
+        """
+        return self._process.poll() is None
+
+    def close(self):
+        """
+        Stops the interpreter, it exits once it sees the socket closed.
+        """
+        self._sock.close()
+        try:
+            self._process.wait(5)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+    def run(
+        self, cwd: str, args: list, log=None, prefix: str = "", env: dict = None
+    ) -> (int, str):
+        """
+        Runs a pytest session in a child of the interpreter with the limits
+        and usage record of the calling thread, like :py:func:`sandbox.run`.
+
+        :param cwd: The repository
+        :type cwd: str
+        :param args: The pytest arguments
+        :type args: list
+        :param log: Stream the output into this log instead of returning it
+        :type log: build_log.BuildLog
+        :param prefix: Text put in front of every line written to log
+        :type prefix: str
+        :param env: Environment of the session, the server's if None
+        :type env: dict
+
+        :raises sandbox.LimitExceeded: If the session exceeded a build limit
+        :raises WarmRunnerError: If the interpreter stopped responding
+
+        :return: The exit code of pytest and its output, empty if it was
+                 written to log
+        :rtype: (int, str)
+        """
+        command = ["pytest", *args]
+        limits = sandbox.current()
+        if limits is not None:
+            sandbox.check_start(limits, command)
+
+        self.runs += 1
+        read_fd, write_fd = os.pipe()
+        try:
+            request = {"cwd": cwd, "args": args, "env": env or dict(os.environ)}
+            socket.send_fds(self._sock, [json.dumps(request).encode()], [write_fd])
+        except OSError as e:
+            os.close(read_fd)
+            raise WarmRunnerError(f"Warm interpreter failed: {e}")
+        finally:
+            os.close(write_fd)
+        stream = os.fdopen(read_fd, errors="replace")
+        try:
+            pid = self._receive()["pid"]
+        except WarmRunnerError:
+            stream.close()
+            raise
+
+        cgroup = None
+        exceeded = []
+        watchdog = None
+        if limits is not None:
+            try:
+                cgroup = sandbox.apply_limits(pid, limits)
+            except OSError as e:
+                print(f"Could not limit process {pid}: {e}")
+            if sandbox.Watchdog.needed(limits):
+
+                def expire(status):
+                    exceeded.append(status)
+                    sandbox.kill_group(pid, cgroup)
+
+                watchdog = sandbox.Watchdog(limits, expire)
+                watchdog.start()
+
+        output = []
+        try:
+            with stream:
+                for line in stream:
+                    if log is not None:
+                        log.write(prefix + line)
+                    else:
+                        output.append(line)
+            result = self._receive()
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            if limits is not None:
+                # Nothing the session left running in the background outlives it
+                sandbox.kill_group(pid, cgroup)
+
+        rusage = SimpleNamespace(
+            ru_utime=result["cpu_time"], ru_stime=0.0, ru_maxrss=result["max_rss"]
+        )
+        resource_usage.add_process(rusage)
+        if limits is not None:
+            if not exceeded:
+                status = sandbox.exceeded_limit(
+                    result["returncode"], rusage, limits, cgroup
+                )
+                if status is not None:
+                    exceeded.append(status)
+            if cgroup is not None:
+                sandbox.remove_cgroup(cgroup)
+        if exceeded:
+            raise sandbox.LimitExceeded(exceeded[0], command)
+        return result["returncode"], "".join(output)
+
+
+class WarmPool:
+    """
+    Keeps warm interpreters ready for the cached environments used by the
+    latest builds, see :py:class:`WarmInterpreter`. Each session runs in a
+    fresh fork, an interpreter is replaced after max_runs sessions so
+    anything that leaks into it, e.g. through imports with side effects
+    outside of Python, does not build up.
+
+    Only environments from the environment cache get warm interpreters, the
+    cached environment is pinned so it is not evicted while they run.
+
+    :param size: Idle interpreters kept per environment
+    :type size: int
+    :param max_runs: Sessions after which an interpreter is replaced
+    :type max_runs: int
+    :param environments: Environments that keep interpreters
+    :type environments: int
+    :param preload: Modules to import besides pytest and its plugins
+    :type preload: list
+    """
+
+    def __init__(
+        self,
+        size: int = WARM_RUNNER_SIZE,
+        max_runs: int = WARM_RUNNER_MAX_RUNS,
+        environments: int = WARM_RUNNER_ENVIRONMENTS,
+        preload: list = WARM_RUNNER_PRELOAD,
+    ):
+        self.size = size
+        self.max_runs = max_runs
+        self.environments = environments
+        self.preload = preload
+        # cached environment -> idle interpreters, least recently used first
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, python_executable: str) -> WarmInterpreter:
+        """
+        Takes an idle interpreter for the environment of a checkout, or
+        starts one. Return it with :py:meth:`release`.
+
+        :param python_executable: The interpreter of the checkout's environment
+        :type python_executable: str
+
+        :raises WarmRunnerError: If the interpreter could not be started
+
+        :return: The interpreter, None if the environment is not cached
+        :rtype: WarmInterpreter
+        """
+        environment = cached_environment(python_executable)
+        if environment is None:
+            return None
+        evicted = []
+        with self._lock:
+            if environment not in self._idle:
+                self._idle[environment] = []
+                pin_environment(environment)
+                while len(self._idle) > max(self.environments, 1):
+                    old, interpreters = self._idle.popitem(last=False)
+                    pin_environment(old, False)
+                    evicted += interpreters
+            self._idle.move_to_end(environment)
+            idle = self._idle[environment]
+            interpreter = None
+            while idle and interpreter is None:
+                interpreter = idle.pop()
+                if not interpreter.alive():
+                    evicted.append(interpreter)
+                    interpreter = None
+        for old in evicted:
+            old.close()
+        if interpreter is None:
+            interpreter = WarmInterpreter(venv_python(environment), self.preload)
+        interpreter.environment = environment
+        return interpreter
+
+    def release(self, interpreter: WarmInterpreter):
+        """
+        Returns an interpreter after a session. Interpreters that ran
+        max_runs sessions, exited or are not needed are stopped, a worn
+        out one is replaced in the background so the next build finds it
+        warm.
+
+        :param interpreter: The interpreter returned by :py:meth:`acquire`
+        :type interpreter: WarmInterpreter
+        """
+        environment = interpreter.environment
+        replace = interpreter.runs >= self.max_runs or not interpreter.alive()
+        with self._lock:
+            idle = self._idle.get(environment)
+            keep = not replace and idle is not None and len(idle) < self.size
+            if keep:
+                idle.append(interpreter)
+        if keep:
+            return
+        interpreter.close()
+        if replace:
+            thread = threading.Thread(
+                target=self._replace, args=(environment,), daemon=True
+            )
+            thread.start()
+
+    def _replace(self, environment):
+        try:
+            interpreter = WarmInterpreter(venv_python(environment), self.preload)
+        except WarmRunnerError as e:
+            print(f"Could not start a warm interpreter: {e}")
+            return
+        interpreter.environment = environment
+        with self._lock:
+            idle = self._idle.get(environment)
+            if idle is not None and len(idle) < self.size:
+                idle.append(interpreter)
+                return
+        interpreter.close()
+
+    def close(self):
+        """
+        Stops all idle interpreters and unpins their environments.
+        """
+        with self._lock:
+            pools, self._idle = self._idle, OrderedDict()
+        for environment, interpreters in pools.items():
+            pin_environment(environment, False)
+            for interpreter in interpreters:
+                interpreter.close()
+
+    def run(
+        self,
+        python_executable: str,
+        cwd: str,
+        args: list,
+        log=None,
+        prefix: str = "",
+        env: dict = None,
+    ):
+        """
+        Runs a pytest session in a warm interpreter, see
+        :py:meth:`WarmInterpreter.run`.
+
+        :raises sandbox.LimitExceeded: If the session exceeded a build limit
+
+        :return: The exit code of pytest and its output, None if no warm
+                 interpreter was available and the session has to run cold
+        :rtype: (int, str)
+        """
+        try:
+            interpreter = self.acquire(python_executable)
+        except WarmRunnerError as e:
+            print(f"Warm runner unavailable: {e}")
+            interpreter = None
+        if interpreter is None:
+            WARM_SESSIONS.inc(mode="cold")
+            return None
+        try:
+            result = interpreter.run(cwd, args, log, prefix, env)
+        except WarmRunnerError as e:
+            print(f"Warm runner failed: {e}")
+            WARM_SESSIONS.inc(mode="cold")
+            return None
+        finally:
+            self.release(interpreter)
+        WARM_SESSIONS.inc(mode="warm")
+        return result
+
+
+# Shared by the builds of the process, used by pytest_runner when WARM_RUNNER is set
+pool = WarmPool()
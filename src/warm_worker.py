@@ -0,0 +1,135 @@
+"""
+Pre-forked interpreter of the warm runner, see :py:mod:`warm_runner`.
+
+Runs with the interpreter of a build environment, so it only uses the
+standard library. It imports pytest, its plugins and the modules named on the
+command line once, then forks a child for every test session the server sends
+over the socket. The child starts from the state right after the imports, so
+nothing a session does is seen by the next one.
+
+Usage: python warm_worker.py <socket fd> [module ...]
+"""
+
+import importlib
+import json
+import os
+import socket
+import sys
+import traceback
+
+# Largest message exchanged with the server
+MAX_MESSAGE = 1024**2
+
+
+def preload(modules: list):
+    """
+    Imports pytest, the pytest plugins installed in the environment and the
+    given modules. Modules that fail to import are left to the test session.
+
+    :param modules: Names of further modules to import
+    :type modules: list
+    """
+    for name in ["pytest", *modules]:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"warm worker: could not import {name}: {e}", file=sys.stderr)
+    try:
+        from importlib.metadata import entry_points
+
+        plugins = entry_points(group="pytest11")
+    except Exception:
+        return
+    for plugin in plugins:
+        try:
+            plugin.load()
+        except Exception as e:
+            print(f"warm worker: could not load {plugin.name}: {e}", file=sys.stderr)
+
+
+def run_session(request: dict, output: int):
+    """
+    Runs one pytest session in the forked child and exits with its exit code.
+
+    :param request: Dictionary with the cwd, args and env of the session
+    :type request: dict
+    :param output: File descriptor that receives stdout and stderr
+    :type output: int
+    """
+    code = 3
+    try:
+        # A session of its own so the server can kill it with everything it starts
+        os.setsid()
+        os.dup2(output, 1)
+        os.dup2(output, 2)
+        os.close(output)
+        stdin = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(stdin, 0)
+        os.close(stdin)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        # Like python -m pytest
+        sys.path.insert(0, request["cwd"])
+        sys.argv = [sys.executable, "-m", "pytest", *request["args"]]
+
+        import pytest
+
+        code = int(pytest.main(request["args"]))
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def serve(sock: socket.socket):
+    """
+    Answers requests until the server closes the socket. A request is a
+    json message with the write end of the session's output pipe attached,
+    it is answered with the pid of the child and, once the child exited,
+    with its returncode, cpu_time and max_rss.
+
+    :param sock: SOCK_SEQPACKET socket connected to the server
+    :type sock: socket.socket
+    """
+    while True:
+        data, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE, 1)
+        if not data:
+            return
+        request = json.loads(data)
+        pid = os.fork()
+        if pid == 0:
+            sock.close()
+            run_session(request, fds[0])
+        for fd in fds:
+            os.close(fd)
+        sock.send(json.dumps({"pid": pid}).encode())
+        _, status, rusage = os.wait4(pid, 0)
+        result = {
+            "returncode": os.waitstatus_to_exitcode(status),
+            "cpu_time": rusage.ru_utime + rusage.ru_stime,
+            "max_rss": rusage.ru_maxrss,
+        }
+        sock.send(json.dumps(result).encode())
+
+
+def main():
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    # The directory of this script is not part of the build environment
+    del sys.path[0]
+    preload(sys.argv[2:])
+    sock.send(json.dumps({"ready": True}).encode())
+    try:
+        serve(sock)
+    except (ConnectionError, EOFError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from cache_utils import cache_lock, directory_size, evict_lru, fcntl, touch
+from git_cache import remove_checkout
+from metrics import Counter
+
+# Builds check out and install into directories below this one
+WORKSPACE_DIR = os.getenv("CI_WORKSPACE_DIR", "/tmp/ci-workspaces")
+# Least recently used kept workspaces are deleted once all workspaces take up more than this
+WORKSPACE_MAX_BYTES = int(os.getenv("CI_WORKSPACE_MAX_BYTES", str(20 * 1024**3)))
+# Keep the workspaces of failed builds for debugging, until the quota evicts them
+KEEP_FAILED_WORKSPACES = os.getenv("CI_KEEP_FAILED_WORKSPACES", "0") == "1"
+# Seconds the cleaner thread waits for work before it exits
+CLEANER_IDLE_SECONDS = 30.0
+
+RECLAIMED_BYTES = Counter(
+    "ci_workspace_reclaimed_bytes",
+    "Disk space freed by deleting workspaces, by reason: finished, stale or quota",
+    ("reason",),
+)
+
+
+class WorkspaceManager:
+    """
+    Hands out a fresh directory below root to every build and deletes it in
+    the background once the build has finished, so builds never wait for
+    hundreds of megabytes of checkout and virtual environment to be removed.
+
+    Several processes, e.g. the server and build agents on the same host,
+    may share root. Each keeps its workspaces in a directory of its own,
+    root/<host>-<pid>-<random>, and holds the lock file next to it for as
+    long as it runs. Only directories whose lock is free, i.e. of processes
+    that exited, are swept.
+
+    Workspaces that are kept, e.g. of failed builds, count towards max_bytes.
+    Above it the least recently used of them are deleted, workspaces of
+    running builds never are.
+
+    :param root: Directory the workspaces are created in
+    :type root: str
+    :param max_bytes: Disk quota of the workspaces of this process
+    :type max_bytes: int
+    """
+
+    def __init__(self, root: str = WORKSPACE_DIR, max_bytes: int = WORKSPACE_MAX_BYTES):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        # The directory of this process and its open lock file, see _directory
+        self._own = None
+        self._own_lock = None
+        self._active = set()
+        self._pending = []
+        self._busy = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def allocate(self, name: str) -> str:
+        """
+        Creates an empty workspace.
+
+        :param name: Start of the directory name, e.g. the repository and commit
+        :type name: str
+
+        :return: The path of the workspace
+        :rtype: str
+        """
+        path = tempfile.mkdtemp(prefix=f"{name}-", dir=self._directory())
+        with self._condition:
+            self._active.add(path)
+        return path
+
+    def _directory(self) -> str:
+        # Creates the directory of this process on first use. The lock is taken
+        # before the directory exists, so other processes never see it unlocked
+        with self._condition:
+            if self._own is None:
+                os.makedirs(self.root, exist_ok=True)
+                fd, lock_path = tempfile.mkstemp(
+                    prefix=f"{socket.gethostname()}-{os.getpid()}-",
+                    suffix=".lock",
+                    dir=self.root,
+                )
+                lock_file = os.fdopen(fd, "a")
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                own = lock_path.removesuffix(".lock")
+                os.mkdir(own)
+                self._own, self._own_lock = own, lock_file
+            return self._own
+
+    def release(self, path: str, git_url: str = None, keep: bool = False):
+        """
+        Marks a workspace as no longer used by its build and queues its
+        deletion, or with keep only the quota check. Paths outside of root
+        are ignored.
+
+        :param path: The path returned by :py:meth:`allocate`
+        :type path: str
+        :param git_url: The repository checked out into the workspace, its
+                        worktree is unregistered from the mirror
+        :type git_url: str
+        :param keep: Leave the workspace until the quota evicts it
+        :type keep: bool
+        """
+        path = os.path.abspath(path)
+        if self._own is None or os.path.dirname(path) != self._own:
+            print(f"Not releasing {path}, it is not a workspace")
+            return
+        with self._condition:
+            self._active.discard(path)
+        if keep:
+            touch(path)
+            print(f"Keeping workspace {path}")
+            self._queue(None, None, None)
+        else:
+            self._queue(path, git_url, "finished")
+
+    def sweep(self):
+        """
+        Queues the deletion of the workspaces left behind by processes that
+        exited. Directories of running processes are locked and left alone.
+        """
+        if not os.path.isdir(self.root):
+            return
+        for entry in os.scandir(self.root):
+            if entry.is_dir(follow_symlinks=False) and entry.path != self._own:
+                self._queue(entry.path, None, "stale")
+
+    def active(self) -> int:
+        """
+        Returns the number of workspaces in use by builds.
+
+        :rtype: int
+        """
+        with self._condition:
+            return len(self._active)
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until the queued deletions are done.
+
+        :param timeout: Maximum number of seconds to wait
+        :type timeout: float
+
+        :return: True if nothing is left to delete
+        :rtype: bool
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._pending and not self._busy, timeout
+            )
+
+    def _queue(self, path, git_url, reason):
+        # A None path only runs the quota check
+        with self._condition:
+            self._pending.append((path, git_url, reason))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._pending:
+                    self._condition.wait(CLEANER_IDLE_SECONDS)
+                    if not self._pending:
+                        self._thread = None
+                        return
+                work, self._pending = self._pending, []
+                self._busy = True
+            try:
+                for path, git_url, reason in work:
+                    if path is not None:
+                        self._remove(path, git_url, reason)
+                self._enforce_quota()
+            except Exception as e:
+                print(f"Workspace cleanup failed: {e}")
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def _remove(self, path, git_url, reason):
+        if reason != "stale":
+            self._delete(path, git_url, reason)
+            return
+        # The directory of another process, only deleted once that process exited
+        with cache_lock(path, blocking=False) as locked:
+            if not locked:
+                return
+            self._delete(path, None, reason)
+            try:
+                os.remove(path + ".lock")
+            except OSError:
+                pass
+
+    def _delete(self, path, git_url, reason):
+        if not os.path.isdir(path):
+            return
+        size = directory_size(path)
+        if git_url is not None:
+            remove_checkout(git_url, path)
+        else:
+            # Stale worktrees are unregistered from their mirror by the next prune
+            shutil.rmtree(path, ignore_errors=True)
+        RECLAIMED_BYTES.inc(size, reason=reason)
+        print(f"Deleted workspace {path} ({size} bytes)")
+
+    def _in_use(self, path):
+        with self._condition:
+            return path in self._active
+
+    def _enforce_quota(self):
+        if self._own is None or not os.path.isdir(self._own):
+            return
+        freed = evict_lru(self._own, self.max_bytes, in_use=self._in_use)
+        if freed:
+            RECLAIMED_BYTES.inc(freed, reason="quota")
+        # The eviction leaves a lock file next to every workspace it looked at,
+        # only this thread locks the workspaces of this process
+        for entry in os.scandir(self._own):
+            if entry.name.endswith(".lock"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
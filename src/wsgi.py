@@ -0,0 +1,10 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from ci_server import app, start_background
+
+# Entry point for WSGI servers, e.g. `waitress-serve --threads 16 wsgi:app` from src/.
+# Run a single server process, the build workers and the delivery processor
+# run as threads of that process.
+start_background()
@@ -0,0 +1,159 @@
+import sys
+import os
+import threading
+import time
+import pytest
+from unittest.mock import patch
+from werkzeug.serving import make_server
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from db import *
+import ci_server
+import log_store
+from agent import *
+
+TOKEN = "secret"
+
+
+@pytest.fixture(autouse=True)
+def temp_dirs(tmp_path, monkeypatch):
+    # Keep the database and logs of the coordinator out of the real ones
+    monkeypatch.setattr("db.DATABASE", str(tmp_path / "test_agent.db"))
+    monkeypatch.setattr("build_log.LOG_DIR", str(tmp_path / "logs"))
+    monkeypatch.setattr("log_store.LOG_STORE_DIR", str(tmp_path / "log-store"))
+    monkeypatch.setattr("ci_server.AGENT_TOKEN", TOKEN)
+    initialise_db()
+
+
+@pytest.fixture
+def coordinator():
+    # A coordinator on localhost, its scheduler only queues jobs
+    server = make_server("127.0.0.1", 0, ci_server.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    with patch("ci_server.update_github_status"):
+        yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def push(sha, ref="refs/heads/main"):
+    return {
+        "ref": ref,
+        "after": sha,
+        "repository": {
+            "clone_url": "https://github.com/example/repo.git",
+            "owner": {"login": "example"},
+            "name": "repo",
+        },
+    }
+
+
+def fake_build(state, cancelled):
+    state["log"].write(f"building {state['payload']['after']}\n")
+    time.sleep(0.1)
+    state["stages"].append(("checkout", "success", time.time(), 0.1, 0.0, 0, 0))
+    return "success"
+
+
+def builds():
+    return {build[1]: build for build in get_builds(connect())}
+
+
+def full_log(build_id):
+    return b"".join(log_store.iter_log(connect(), build_id)).decode()
+
+
+def test_several_agents(coordinator, monkeypatch):
+    monkeypatch.setattr("agent.execute_build", fake_build)
+    shas = [f"sha{i}" for i in range(6)]
+    for sha in shas:
+        ci_server.scheduler.submit(push(sha, ref=f"refs/heads/{sha}"))
+
+    agents = [
+        BuildAgent(coordinator, f"agent-{i}", TOKEN, poll_interval=0.05)
+        for i in range(3)
+    ]
+    threads = [threading.Thread(target=agent.run) for agent in agents]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 30
+    while (
+        ci_server.scheduler.stats()["queued"] or ci_server.scheduler.stats()["running"]
+    ):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    for agent in agents:
+        agent.stop()
+    for thread in threads:
+        thread.join(10)
+
+    results = builds()
+    assert sorted(results) == shas
+    for sha, build in results.items():
+        assert build[3] == "success"
+        log = full_log(build[0])
+        assert "Building on agent agent-" in log
+        assert f"building {sha}\n" in log
+        assert [s[:2] for s in get_build_stages(connect(), build[0])] == [
+            ("checkout", "success")
+        ]
+
+
+def test_dead_agent_job_is_built_again(coordinator, monkeypatch):
+    monkeypatch.setattr("agent.execute_build", fake_build)
+    monkeypatch.setattr(ci_server.scheduler, "lease_seconds", 0.2)
+    job_id = ci_server.scheduler.submit(push("abc"))
+
+    # An agent leases the job and dies without a heartbeat
+    dead = BuildAgent(coordinator, "dead", TOKEN)
+    job = dead._post("/agent/lease", {"agent": "dead"}).json()
+    assert job["job_id"] == job_id
+    time.sleep(0.3)
+    assert ci_server.scheduler.expire_leases() == [(job_id, job["build_id"])]
+    abandoned = get_build(connect(), job["build_id"])
+    assert abandoned[3] == "error"
+    assert "agent stopped responding" in full_log(job["build_id"])
+
+    # Its late result is refused, another agent builds the job again
+    response = dead._post(
+        f"/agent/jobs/{job_id}/result",
+        {"lease_token": job["lease_token"], "status": "success"},
+    )
+    assert response.status_code == 409
+    monkeypatch.setattr(ci_server.scheduler, "lease_seconds", 60)
+    assert BuildAgent(coordinator, "alive", TOKEN).run_once()
+    assert get_job(connect(), job_id)[2] == "done"
+    rebuilt = get_builds(connect())[-1]
+    assert rebuilt[0] != job["build_id"]
+    assert rebuilt[3] == "success"
+    assert not BuildAgent(coordinator, "alive", TOKEN).run_once()
+
+
+def test_agents_need_the_token(monkeypatch):
+    client = ci_server.app.test_client()
+    assert client.post("/agent/lease", json={}).status_code == 403
+
+    # Without a token no agent is accepted, not even from the loopback address
+    monkeypatch.setattr("ci_server.AGENT_TOKEN", None)
+    response = client.post(
+        "/agent/lease", json={}, headers={"Authorization": "Bearer secret"}
+    )
+    assert response.status_code == 403
+
+    monkeypatch.setattr("ci_server.AGENT_TOKEN", "secret")
+    assert client.post("/agent/lease", json={}).status_code == 403
+    response = client.post(
+        "/agent/lease", json={}, headers={"Authorization": "Bearer secret"}
+    )
+    assert response.status_code == 204
+
+
+def test_agent_log_take():
+    log = AgentLog()
+    log.write("a")
+    log.write("b")
+    assert log.take() == "ab"
+    log.write("c")
+    log.give_back("ab")
+    assert log.take() == "abc"
+    assert log.tail() == "abc"
@@ -0,0 +1,66 @@
+import sys
+import os
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import build_log
+from build_log import *
+
+
+@pytest.fixture(autouse=True)
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_log, "LOG_DIR", str(tmp_path / "logs"))
+    return tmp_path / "logs"
+
+
+def test_log_is_chunked_and_compressed(log_dir, monkeypatch):
+    monkeypatch.setattr(build_log, "LOG_CHUNK_BYTES", 10)
+    log = BuildLog(1)
+    for i in range(5):
+        log.write(f"line {i}\n")
+
+    # Readers see the output while the build runs, sealed chunks are compressed
+    assert b"".join(iter_log(1)) == b"".join(f"line {i}\n".encode() for i in range(5))
+    assert any(name.endswith(".log.gz") for name in os.listdir(log_dir / "1"))
+    assert not is_complete(1)
+
+    log.close()
+    assert is_complete(1)
+    assert all(
+        name.endswith(".gz") or name == "complete" for name in os.listdir(log_dir / "1")
+    )
+    assert b"".join(iter_log(1, offset=7)) == b"line 1\nline 2\nline 3\nline 4\n"
+
+
+def test_read_log_returns_complete_lines():
+    log = BuildLog(2)
+    log.write("first\nsec")
+    data, offset, complete = read_log(2)
+    assert (data, offset, complete) == (b"first\n", 6, False)
+
+    log.write("ond\n")
+    assert read_log(2, offset) == (b"second\n", 13, False)
+
+    log.close()
+    assert read_log(2, 13) == (b"", 13, True)
+
+
+def test_tail_is_bounded(monkeypatch):
+    monkeypatch.setattr(build_log, "LOG_TAIL_BYTES", 4)
+    log = BuildLog()
+    log.write("abcdef")
+    assert log.tail() == "[2 bytes truncated]\ncdef"
+    # Without a build id nothing is written to disk
+    assert not log_exists(None)
+
+
+def test_stream_process(tmp_path):
+    log = BuildLog(3)
+    returncode = stream_process(
+        [sys.executable, "-c", "import sys; print('out'); sys.exit(3)"],
+        str(tmp_path),
+        log,
+        prefix="> ",
+    )
+    assert returncode == 3
+    assert log.tail() == "> out\n"
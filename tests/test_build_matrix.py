@@ -0,0 +1,91 @@
+import sys
+import os
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from build_matrix import *
+
+PYTHON = f"{sys.version_info.major}.{sys.version_info.minor}"
+
+
+def test_parse_matrix():
+    cells = parse_matrix(
+        """
+[matrix]
+python = ["3.11", "3.12"]
+env = [{}, {DJANGO = "5.0", DEBUG = 1}]
+"""
+    )
+    assert [cell["name"] for cell in cells] == [
+        "py3.11",
+        "py3.11, DEBUG=1, DJANGO=5.0",
+        "py3.12",
+        "py3.12, DEBUG=1, DJANGO=5.0",
+    ]
+    assert cells[1] == {
+        "name": "py3.11, DEBUG=1, DJANGO=5.0",
+        "python": "3.11",
+        "env": {"DJANGO": "5.0", "DEBUG": "1"},
+    }
+
+    # Both lists are optional
+    assert parse_matrix('[matrix]\nenv = [{A = "1"}, {A = "2"}]') == [
+        {"name": "A=1", "python": None, "env": {"A": "1"}},
+        {"name": "A=2", "python": None, "env": {"A": "2"}},
+    ]
+    assert parse_matrix("[tool.other]\nkey = 1\n") == []
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        "[matrix\n",
+        "matrix = 1",
+        '[matrix]\npython = "3.12"',
+        '[matrix]\npython = ["3.x"]',
+        "[matrix]\nenv = [1]",
+        '[matrix]\nenv = [{"NOT-A-NAME" = "1"}]',
+        "[matrix]\nenv = [{A = [1]}]",
+    ],
+)
+def test_parse_matrix_rejects_invalid_configs(config):
+    with pytest.raises(MatrixConfigError):
+        parse_matrix(config)
+
+
+def test_parse_matrix_limits_cells(monkeypatch):
+    monkeypatch.setattr("build_matrix.MATRIX_MAX_CELLS", 3)
+    with pytest.raises(MatrixConfigError, match="4 cells"):
+        parse_matrix('[matrix]\npython = ["3.11", "3.12"]\nenv = [{}, {A = "1"}]')
+
+
+def test_read_matrix(tmp_path):
+    assert read_matrix(str(tmp_path)) == []
+    (tmp_path / MATRIX_CONFIG).write_text('[matrix]\npython = ["3.12"]\n')
+    assert read_matrix(str(tmp_path)) == [
+        {"name": "py3.12", "python": "3.12", "env": {}}
+    ]
+
+
+def test_find_interpreter(monkeypatch):
+    assert find_interpreter(None) == sys.executable
+    assert find_interpreter(PYTHON) == sys.executable
+    assert find_interpreter("2.1") is None
+    monkeypatch.setattr("build_matrix.PYTHON_INTERPRETERS", {"2.1": "/opt/py21"})
+    assert find_interpreter("2.1") == "/opt/py21"
+
+
+def test_status_context_and_digest():
+    assert status_context({}) == "CI/Test"
+    assert status_context({"matrix": {"name": "py3.12"}}) == "CI/Test (py3.12)"
+    assert env_digest({}) == ""
+    assert env_digest({"A": "1", "B": "2"}) == env_digest({"B": "2", "A": "1"})
+    assert env_digest({"A": "1"}) != env_digest({"A": "2"})
+
+
+def test_combined_status():
+    assert combined_status(["success", "running"]) == "running"
+    assert combined_status(["success", "success"]) == "success"
+    assert combined_status(["success", "failure"]) == "failure"
+    assert combined_status(["oom", "failure"]) == "error"
+    assert combined_status(["superseded", "error"]) == "superseded"
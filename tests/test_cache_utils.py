@@ -0,0 +1,49 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from cache_utils import *
+
+
+def make_entry(root, name, size, mtime):
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "data"), "wb") as f:
+        f.write(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_directory_size(tmp_path):
+    path = make_entry(str(tmp_path), "entry", 100, 0)
+    os.makedirs(os.path.join(path, "sub"))
+    with open(os.path.join(path, "sub", "more"), "wb") as f:
+        f.write(b"x" * 50)
+    assert directory_size(path) == 150
+
+
+def test_evict_lru_removes_oldest_first(tmp_path):
+    root = str(tmp_path)
+    old = make_entry(root, "old", 100, 1000)
+    middle = make_entry(root, "middle", 100, 2000)
+    new = make_entry(root, "new", 100, 3000)
+
+    assert evict_lru(root, max_bytes=200) == 100
+    assert not os.path.exists(old)
+    assert os.path.exists(middle)
+    assert os.path.exists(new)
+
+
+def test_evict_lru_skips_entries_in_use(tmp_path):
+    root = str(tmp_path)
+    old = make_entry(root, "old", 100, 1000)
+    new = make_entry(root, "new", 100, 2000)
+
+    assert evict_lru(root, max_bytes=100, in_use=lambda path: path == old) == 100
+    assert os.path.exists(old)
+    assert not os.path.exists(new)
+
+    # Locked entries are skipped as well
+    with cache_lock(old):
+        assert evict_lru(root, max_bytes=0) == 0
+    assert evict_lru(root, max_bytes=0) == 100
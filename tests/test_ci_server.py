@@ -1,18 +1,22 @@
 import pytest
 import requests
-from unittest.mock import patch, call
+from unittest.mock import ANY, patch
 import sys
 import os
-import shutil
 
 import json
+import hashlib
+import hmac
 import tempfile
+import threading
 
 from src.ci_server import build_project
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 
 from ci_server import *
+import build_log
+import log_store
 
 
 @pytest.fixture
@@ -21,65 +25,157 @@ def client():
     return app.test_client()
 
 
+@pytest.fixture(autouse=True)
+def temp_env_cache(tmp_path, monkeypatch):
+    # Keep environments built by the tests out of the real environment cache
+    monkeypatch.setattr("env_cache.ENV_CACHE_DIR", str(tmp_path / "env-cache"))
+
+
+@pytest.fixture(autouse=True)
+def temp_log_dir(tmp_path, monkeypatch):
+    # Keep the logs of the builds run by the tests out of the real log directory
+    monkeypatch.setattr("build_log.LOG_DIR", str(tmp_path / "logs"))
+    monkeypatch.setattr("log_store.LOG_STORE_DIR", str(tmp_path / "log-store"))
+
+
+@pytest.fixture(autouse=True)
+def temp_db(tmp_path, monkeypatch):
+    # Use a temporary file as the database so builds and jobs don't leak between tests.
+    monkeypatch.setattr("db.DATABASE", str(tmp_path / "test_ci_server.db"))
+    initialise_db()
+
+
+PUSH = {
+    "repository": {
+        "clone_url": "https://github.com/example/repo.git",
+        "owner": {"login": "example"},
+        "name": "repo",
+    },
+    "after": "abcd1234",
+}
+
+
 @patch("ci_server.process_request")
-@patch("ci_server.clone_repo")
-@patch("ci_server.build_project")
-@patch("ci_server.run_tests")
 @patch("ci_server.update_github_status")
-def test_handle_webhook(
-    mock_update_status,
-    mock_run_tests,
-    mock_build,
-    mock_clone_repo,
-    mock_process,
-    client,
-):
+def test_handle_webhook(mock_update_status, mock_process, client, temp_db):
     mock_process.return_value = 200
-    # Invalid event
-    headers = {"X-GitHub-Event": "push", "Content-Type": "application/json"}
-
-    payload = {
-        "repository": {
-            "clone_url": "https://github.com/example/repo.git",
-            "owner": {"login": "example"},
-            "name": "repo",
-        },
-        "after": "abcd1234",
+    headers = {
+        "X-GitHub-Event": "push",
+        "Content-Type": "application/json",
+        "X-GitHub-Delivery": "delivery-1",
     }
 
-    response = client.post("/webhook", data=json.dumps(payload), headers=headers)
+    response = client.post("/webhook", data=json.dumps(PUSH), headers=headers)
     assert response.status_code == 202
+    assert response.get_json()["delivery_id"] == "delivery-1"
+
+    # The delivery is only stored, it is handled in the background
+    delivery = get_delivery(connect(), "delivery-1")
+    assert delivery[4] == "received"
+    assert json.loads(delivery[2]) == PUSH
+    mock_update_status.assert_not_called()
+
+    # A redelivery is acknowledged without being stored again
+    response = client.post("/webhook", data=json.dumps(PUSH), headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()["message"] == "Duplicate delivery"
+
+    # Handling the delivery sets the status to pending and queues the build
+    assert delivery_processor.run_pending() == 1
+    delivery = get_delivery(connect(), "delivery-1")
+    assert delivery[4] == "queued"
+    job = get_job(connect(), delivery[5])
+    assert job[2] == "queued"
+    assert json.loads(job[1]) == PUSH
+    mock_update_status.assert_called_once_with(
+        "https://api.github.com/repos/example/repo/statuses/abcd1234",
+        "pending",
+        GITHUB_TOKEN,
+    )
+    mock_process.assert_not_called()
 
     # Invalid event
     headers = {"X-GitHub-Event": "pull_request", "Content-Type": "application/json"}
-    response = client.post("/webhook", data=json.dumps(payload), headers=headers)
+    response = client.post("/webhook", data=json.dumps(PUSH), headers=headers)
 
     assert response.status_code == 400
 
     # Ping event
     headers = {"X-GitHub-Event": "ping", "Content-Type": "application/json"}
-    response = client.post("/webhook", data=json.dumps(payload), headers=headers)
+    response = client.post("/webhook", data=json.dumps(PUSH), headers=headers)
 
     assert response.status_code == 200
 
 
+def test_handle_webhook_signature(client, temp_db, monkeypatch):
+    monkeypatch.setattr("ci_server.WEBHOOK_SECRET", "secret")
+    body = json.dumps(PUSH).encode()
+    headers = {"X-GitHub-Event": "push", "Content-Type": "application/json"}
+
+    response = client.post("/webhook", data=body, headers=headers)
+    assert response.status_code == 401
+    headers["X-Hub-Signature-256"] = "sha256=" + "0" * 64
+    response = client.post("/webhook", data=body, headers=headers)
+    assert response.status_code == 401
+
+    signature = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+    headers["X-Hub-Signature-256"] = f"sha256={signature}"
+    response = client.post("/webhook", data=body, headers=headers)
+    assert response.status_code == 202
+
+
+@patch("ci_server.update_github_status")
+def test_handle_webhook_queue_full(mock_update_status, client, temp_db, monkeypatch):
+    monkeypatch.setattr(scheduler, "max_queue_depth", 1)
+    for delivery_id in ("delivery-1", "delivery-2"):
+        headers = {
+            "X-GitHub-Event": "push",
+            "Content-Type": "application/json",
+            "X-GitHub-Delivery": delivery_id,
+        }
+        response = client.post("/webhook", data=json.dumps(PUSH), headers=headers)
+        assert response.status_code == 202
+    delivery_processor.run_pending()
+
+    # Second push is rejected while the first one is still waiting for a worker
+    assert get_delivery(connect(), "delivery-1")[4] == "queued"
+    assert get_delivery(connect(), "delivery-2")[4] == "rejected"
+    mock_update_status.assert_called_with(
+        "https://api.github.com/repos/example/repo/statuses/abcd1234",
+        "error",
+        GITHUB_TOKEN,
+    )
+
+    response = client.get("/queue")
+    assert response.get_json()["queued"] == 1
+
+
 @patch("ci_server.get_db")
 @patch("ci_server.insert_build")
+@patch("ci_server.update_build")
+@patch("ci_server.insert_build_stage")
+@patch("ci_server.insert_cache_event")
+@patch("ci_server.prepare_environment")
 @patch("ci_server.clone_repo")
-@patch("ci_server.build_project")
+@patch("ci_server.check_syntax")
 @patch("ci_server.run_tests")
 @patch("ci_server.update_github_status")
 def test_process_request(
     mock_update_status,
     mock_run_tests,
-    mock_build,
+    mock_check_syntax,
     mock_clone_repo,
+    mock_prepare_env,
+    mock_insert_cache_event,
+    mock_insert_build_stage,
+    mock_update_build,
     mock_insert_build,
     mock_get_db,
 ):
     # Passing commit
     mock_clone_repo.return_value = (True, "/repo/path")
-    mock_build.return_value = True
+    mock_prepare_env.return_value = ("/repo/path/.venv/bin/python", True)
+    mock_check_syntax.return_value = ([], {"files": 1, "cached": 0, "shards": 1})
     mock_run_tests.return_value = (True, "")
     mock_get_db.return_value = None
     mock_insert_build.return_value = 1
@@ -98,13 +194,35 @@ def test_process_request(
     mock_clone_repo.assert_any_call(
         "https://github.com/example/repo.git", "abcd1234", "repo"
     )
-    mock_build.assert_any_call("/repo/path")
-    mock_run_tests.assert_any_call("/repo/path")
+    mock_check_syntax.assert_any_call("/repo/path", "/repo/path/.venv/bin/python")
+    mock_run_tests.assert_any_call(
+        "/repo/path",
+        "/repo/path/.venv/bin/python",
+        durations={},
+        tests=None,
+        coverage_rc=None,
+        log=ANY,
+        env={},
+    )
     mock_update_status.assert_any_call(
         "https://api.github.com/repos/example/repo/statuses/abcd1234",
         "success",
         GITHUB_TOKEN,
     )
+    mock_prepare_env.assert_called_once_with(
+        "/repo/path", python=sys.executable, extra_packages=()
+    )
+    mock_insert_cache_event.assert_any_call(ANY, 1, "env", True)
+    mock_insert_cache_event.assert_any_call(ANY, 1, "compile", False)
+    stages = [c.args[2:4] for c in mock_insert_build_stage.call_args_list]
+    assert stages == [
+        ("checkout", "success"),
+        ("matrix", "success"),
+        ("result_cache", "success"),
+        ("env", "success"),
+        ("compile", "success"),
+        ("test", "success"),
+    ]
     assert state == 200
 
     # Test failing commit
@@ -114,8 +232,16 @@ def test_process_request(
     mock_clone_repo.assert_any_call(
         "https://github.com/example/repo.git", "abcd1234", "repo"
     )
-    mock_build.assert_any_call("/repo/path")
-    mock_run_tests.assert_any_call("/repo/path")
+    mock_check_syntax.assert_any_call("/repo/path", "/repo/path/.venv/bin/python")
+    mock_run_tests.assert_any_call(
+        "/repo/path",
+        "/repo/path/.venv/bin/python",
+        durations={},
+        tests=None,
+        coverage_rc=None,
+        log=ANY,
+        env={},
+    )
     mock_update_status.assert_any_call(
         "https://api.github.com/repos/example/repo/statuses/abcd1234",
         "failure",
@@ -124,15 +250,32 @@ def test_process_request(
 
     assert state == 200
 
-    # Build failing commit
-    mock_build.return_value = False
+    # Build failing commit, the tests are skipped
+    mock_check_syntax.return_value = (
+        [
+            {
+                "file": "a.py",
+                "line": 1,
+                "offset": 1,
+                "type": "SyntaxError",
+                "message": "x",
+            }
+        ],
+        {"files": 1, "cached": 0, "shards": 1},
+    )
     mock_run_tests.return_value = (True, "")
+    mock_run_tests.reset_mock()
+    mock_insert_build_stage.reset_mock()
     state = process_request(payload)
 
+    mock_run_tests.assert_not_called()
+    stages = [c.args[2:4] for c in mock_insert_build_stage.call_args_list]
+    assert stages[4:] == [("compile", "failure"), ("test", "skipped")]
+
     mock_clone_repo.assert_any_call(
         "https://github.com/example/repo.git", "abcd1234", "repo"
     )
-    mock_build.assert_any_call("/repo/path")
+    mock_check_syntax.assert_any_call("/repo/path", "/repo/path/.venv/bin/python")
     mock_update_status.assert_any_call(
         "https://api.github.com/repos/example/repo/statuses/abcd1234",
         "failure",
@@ -143,7 +286,7 @@ def test_process_request(
 
     # Clone failing commit
     mock_clone_repo.return_value = (False, None)
-    mock_build.return_value = True
+    mock_check_syntax.return_value = ([], {"files": 1, "cached": 0, "shards": 1})
     mock_run_tests.return_value = (True, "")
     state = process_request(payload)
 
@@ -159,33 +302,136 @@ def test_process_request(
     assert state == 500
 
 
-@patch("subprocess.run")
-def test_clone_repo(mock_subprocess):
-    """Test that clone_repo correctly calls git clone"""
+@patch("ci_server.clone_repo")
+@patch("ci_server.run_tests")
+@patch("ci_server.update_github_status")
+def test_process_request_superseded(
+    mock_update_status, mock_run_tests, mock_clone_repo
+):
+    mock_clone_repo.return_value = (True, "/repo/path")
+    payload = {
+        "repository": {
+            "clone_url": "https://github.com/example/repo.git",
+            "owner": {"login": "example"},
+            "name": "repo",
+        },
+        "after": "abcd1234",
+    }
+    cancelled = threading.Event()
+    cancelled.set()
+
+    # A superseded build stops before running the tests and leaves the status alone
+    assert process_request(payload, cancelled) == 409
+    mock_run_tests.assert_not_called()
+    mock_update_status.assert_not_called()
+
+
+@patch("ci_server.prepare_environment")
+@patch("ci_server.clone_repo")
+@patch("ci_server.check_syntax")
+@patch("ci_server.run_tests")
+@patch("ci_server.update_github_status")
+def test_process_request_superseded_while_testing(
+    mock_update_status,
+    mock_run_tests,
+    mock_check_syntax,
+    mock_clone_repo,
+    mock_prepare_env,
+    temp_db,
+):
+    mock_clone_repo.return_value = (True, "/repo/path")
+    mock_prepare_env.return_value = (sys.executable, True)
+    mock_check_syntax.return_value = ([], {"files": 1, "cached": 0, "shards": 1})
+    cancelled = threading.Event()
+
+    def run_tests(*args, **kwargs):
+        # The tests fail because they were killed when the build was cancelled
+        cancelled.set()
+        return False, ""
+
+    mock_run_tests.side_effect = run_tests
+
+    # The outcome of the interrupted stage is neither posted nor recorded
+    assert process_request(PUSH, cancelled) == 409
+    mock_update_status.assert_not_called()
+    assert get_builds(connect())[0][3] == "superseded"
+
+
+@patch("ci_server.prepare_environment")
+@patch("ci_server.clone_repo")
+@patch("ci_server.run_tests")
+@patch("ci_server.update_github_status")
+def test_process_request_environment_failure(
+    mock_update_status, mock_run_tests, mock_clone_repo, mock_prepare_env, temp_db
+):
+    mock_clone_repo.return_value = (True, "/repo/path")
+    mock_prepare_env.side_effect = subprocess.CalledProcessError(1, "pip")
+    payload = {
+        "repository": {
+            "clone_url": "https://github.com/example/repo.git",
+            "owner": {"login": "example"},
+            "name": "repo",
+        },
+        "after": "abcd1234",
+    }
+
+    assert process_request(payload) == 200
+    mock_run_tests.assert_not_called()
+    mock_update_status.assert_called_with(
+        "https://api.github.com/repos/example/repo/statuses/abcd1234",
+        "failure",
+        GITHUB_TOKEN,
+    )
+    build = get_builds(connect())[0]
+    assert build[3] == "failure"
+    # The log moved to the log store once the build finished
+    assert build[4] == ""
+    assert not os.path.exists(os.path.join(build_log.LOG_DIR, str(build[0])))
+    log = b"".join(log_store.iter_log(connect(), build[0])).decode()
+    assert "Failed to set up the environment" in log
+
+
+@patch("ci_server.update_github_status")
+def test_report_superseded(mock_update_status):
+    def push(sha):
+        return {
+            "repository": {"owner": {"login": "example"}, "name": "repo"},
+            "after": sha,
+        }
+
+    report_superseded(push("abcd1234"), push("ef567890"))
+    mock_update_status.assert_called_once_with(
+        "https://api.github.com/repos/example/repo/statuses/abcd1234",
+        "error",
+        GITHUB_TOKEN,
+        description="Skipped, superseded by ef56789",
+        target_url="https://github.com/example/repo/commit/ef567890",
+    )
+
+
+@patch("ci_server.checkout_commit")
+def test_clone_repo(mock_checkout, tmp_path, monkeypatch):
+    """Test that clone_repo checks the commit out of the git cache"""
+    monkeypatch.setattr("ci_server.workspaces", WorkspaceManager(str(tmp_path)))
     git_url = "https://github.com/Group-19-DD2480/Continuous-Integration-Server.git"
     sha = "abcd1234"
-    repo_name = "Continuous-Integration-Server"
-    mock_subprocess.return_value = None
-
     repo_name = git_url.split("/")[-1].replace(".git", "")
-    repo_path = os.path.join(
-        CLONE_DIR, f"{repo_name}-{sha}"
-    )  # This is "/tmp/Continuous-Integration-Server"
-
-    if os.path.exists(repo_path):
-        shutil.rmtree(repo_path, ignore_errors=True)
 
-    success, _ = clone_repo(git_url=git_url, sha=sha, repo_name=repo_name)
+    success, path = clone_repo(git_url=git_url, sha=sha, repo_name=repo_name)
 
     assert success is True, "Cloning repo failed"
-    expected_calls = [
-        call(["git", "clone", git_url, f"/tmp/{repo_name}-{sha}"], check=True),
-        call(["git", "checkout", sha], cwd=repo_path, check=True),
-    ]
-    mock_subprocess.assert_has_calls(expected_calls)
+    assert os.path.dirname(os.path.dirname(path)) == str(tmp_path)
+    assert os.path.basename(path).startswith(f"{repo_name}-{sha}-")
+    mock_checkout.assert_called_once_with(git_url, sha, path)
+
+    # Builds of the same commit get their own workspace
+    _, other = clone_repo(git_url=git_url, sha=sha, repo_name=repo_name)
+    assert other != path
 
-    if os.path.exists(repo_path):
-        shutil.rmtree(repo_path, ignore_errors=True)
+    # Failing git command
+    mock_checkout.side_effect = subprocess.CalledProcessError(128, "git")
+    success, _ = clone_repo(git_url=git_url, sha=sha, repo_name=repo_name)
+    assert success is False
 
 
 # @pytest.fixture
@@ -293,26 +539,510 @@ def test_run_tests(setup_test_repo_success, setup_test_repo_failure):
     assert not result, "Expected run_tests() to return False due to a failing test"
 
 
-@patch("requests.post")
-@patch("requests.Response")
-def test_update_github_status(mock_response, mock_post):
-    mock_response.status_code = 201
-    mock_post.return_value = mock_response
-
-    status_code = update_github_status(
+@patch("ci_server.status_reporter")
+def test_update_github_status(mock_reporter):
+    update_github_status(
         url="https://api.github.com/repos/user/repo",
         state="success",
         github_token="token",
     )
 
-    mock_post.assert_called_once_with(
+    # The update is queued for the background reporter
+    mock_reporter.submit.assert_called_once_with(
         "https://api.github.com/repos/user/repo",
-        json={
+        {
             "state": "success",
             "description": "CI test results",
             "context": "CI/Test",
         },
-        headers={"Authorization": "token token"},
+        "token",
+    )
+
+
+def test_build_view_shows_cache_events(client, temp_db):
+    conn = connect()
+    build_id = insert_build(conn, "abcd1234", "2025-01-01 00:00:00", "success", "ok")
+    insert_cache_event(conn, build_id, "env", True)
+
+    response = client.get(f"/build/{build_id}")
+    assert response.status_code == 200
+    assert b"env hit" in response.data
+
+
+def test_build_view_shows_stage_usage(client, temp_db):
+    conn = connect()
+    for duration in (1.0, 3.0):
+        build_id = insert_build(
+            conn, "abcd1234", "2025-01-01 00:00:00", "success", "", "example/repo"
+        )
+        insert_build_stage(
+            conn, build_id, "test", "success", 100.0, duration, 0.5, 2048, 1536
+        )
+
+    response = client.get(f"/build/{build_id}")
+    assert b"3.0s" in response.data
+    assert b"2.0 MiB" in response.data
+    assert b"1.5 KiB" in response.data
+    # The percentiles over both builds of the repository
+    assert b"1.0s / 3.0s" in response.data
+
+
+def test_builds_view_pages_and_filters(client, temp_db, monkeypatch):
+    monkeypatch.setattr("ci_server.BUILDS_PAGE_SIZE", 2)
+    conn = connect()
+    for i, status in enumerate(["success", "failure", "success"]):
+        insert_build(conn, f"abcd{i}", f"2025-01-0{i + 1} 00:00:00", status, "")
+
+    response = client.get("/builds")
+    assert b"abcd2" in response.data and b"abcd1" in response.data
+    assert b"abcd0" not in response.data
+    assert b"before=2" in response.data
+
+    response = client.get("/builds?before=2")
+    assert b"abcd0" in response.data and b"abcd1" not in response.data
+
+    response = client.get("/builds?status=success&from=2025-01-02")
+    assert b"abcd2" in response.data and b"abcd0" not in response.data
+
+    assert client.get("/builds?commit=xyz").status_code == 400
+    assert client.get("/builds?from=yesterday").status_code == 400
+    assert client.get("/builds?before=-1").status_code == 400
+    # Out of range page sizes are clamped instead of listing every build
+    response = client.get("/builds?limit=-1")
+    assert b"abcd2" in response.data and b"abcd1" not in response.data
+    assert b"before=3" in response.data
+    assert b'value="matrix"' in client.get("/builds").data
+
+
+def test_build_log_endpoints(client, temp_db):
+    conn = connect()
+    build_id = insert_build(conn, "abcd1234", "2025-01-01 00:00:00", "running", "")
+    log = BuildLog(build_id)
+    log.write("collecting\n")
+    log.write("1 passed\n")
+    log.close()
+
+    response = client.get(f"/build/{build_id}/log")
+    assert response.data == b"collecting\n1 passed\n"
+
+    # The stream resumes after the offset of the last event and ends with the log
+    response = client.get(
+        f"/build/{build_id}/log/stream", headers={"Last-Event-ID": "11"}
+    )
+    assert response.mimetype == "text/event-stream"
+    assert response.get_data(as_text=True) == (
+        "id: 20\ndata: 1 passed\n\nevent: end\ndata: \n\n"
+    )
+
+    # Archived logs are served from the log store and paged on the build page
+    archive_log(conn, build_id)
+    assert client.get(f"/build/{build_id}/log").data == b"collecting\n1 passed\n"
+    response = client.get(
+        f"/build/{build_id}/log/stream", headers={"Last-Event-ID": "11"}
+    )
+    assert response.get_data(as_text=True) == (
+        "id: 20\ndata: 1 passed\n\nevent: end\ndata: \n\n"
+    )
+    # A malformed id starts over instead of failing
+    response = client.get(
+        f"/build/{build_id}/log/stream", headers={"Last-Event-ID": "abc"}
+    )
+    assert response.status_code == 200
+    assert "data: collecting\n" in response.get_data(as_text=True)
+    response = client.get(f"/build/{build_id}?offset=11")
+    assert b"bytes 11-20 of 20" in response.data
+    assert b"collecting" not in response.data
+
+    # Builds without a log fall back to the stored output
+    other = insert_build(conn, "ef567890", "2025-01-01 00:00:00", "success", "ok")
+    assert client.get(f"/build/{other}/log").data == b"ok"
+    assert client.get(f"/build/{other}/log/stream").status_code == 404
+    assert client.get("/build/999/log").status_code == 404
+
+
+def test_run_pipeline_records_stages(monkeypatch):
+    calls = []
+
+    def stage(name, status):
+        def run(state):
+            calls.append(name)
+            return status
+
+        return run
+
+    monkeypatch.setattr(
+        "ci_server.BUILD_PIPELINE",
+        [("a", stage("a", "success")), ("b", stage("b", "failure")), ("c", None)],
+    )
+    state = new_build_state({})
+    assert run_pipeline(state) == "failure"
+    assert calls == ["a", "b"]
+    assert [s[:2] for s in state["stages"]] == [
+        ("a", "success"),
+        ("b", "failure"),
+        ("c", "skipped"),
+    ]
+
+    # Exceptions turn into an error status
+    def crash(state):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr("ci_server.BUILD_PIPELINE", [("a", crash)])
+    state = new_build_state({})
+    assert run_pipeline(state) == "error"
+    assert "a stage failed: boom\n" in state["log"].tail()
+
+
+def test_metrics_endpoint(client, temp_db):
+    accepted = WEBHOOK_DELIVERIES.value(event="push", result="accepted")
+    headers = {"X-GitHub-Event": "push", "Content-Type": "application/json"}
+    assert (
+        client.post("/webhook", data=json.dumps(PUSH), headers=headers).status_code
+        == 202
+    )
+    client.post("/webhook", data="{}", headers={"X-GitHub-Event": "issues"})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.data.decode()
+    assert (
+        f'ci_webhook_deliveries_total{{event="push",result="accepted"}} {accepted + 1}'
+        in text
+    )
+    assert 'ci_webhook_deliveries_total{event="other",result="rejected"}' in text
+    assert 'ci_queue_depth{state="queued"} 0' in text
+    assert 'ci_db_query_duration_seconds_count{statement="INSERT"}' in text
+
+
+@patch("ci_server.prepare_environment")
+@patch("ci_server.clone_repo")
+@patch("ci_server.update_github_status")
+def test_process_request_limit_exceeded(
+    mock_update_status, mock_clone_repo, mock_prepare_env, temp_db
+):
+    mock_clone_repo.return_value = (True, "/repo/path")
+    mock_prepare_env.side_effect = sandbox.LimitExceeded("oom", ["pip"])
+    payload = {
+        "repository": {
+            "clone_url": "https://github.com/example/repo.git",
+            "owner": {"login": "example"},
+            "name": "repo",
+        },
+        "after": "abcd1234",
+    }
+
+    assert process_request(payload) == 200
+    mock_update_status.assert_called_with(
+        "https://api.github.com/repos/example/repo/statuses/abcd1234",
+        "error",
+        GITHUB_TOKEN,
+        description="Build ran out of memory",
+    )
+    build = get_builds(connect())[0]
+    assert build[3] == "oom"
+    stages = get_build_stages(connect(), build[0])
+    assert [s[:2] for s in stages][:5] == [
+        ("checkout", "success"),
+        ("matrix", "success"),
+        ("result_cache", "success"),
+        ("env", "oom"),
+        ("compile", "skipped"),
+    ]
+
+
+def test_run_pipeline_stage_timeout(monkeypatch):
+    def slow(state):
+        sandbox.run(["sleep", "30"])
+        return "success"
+
+    monkeypatch.setattr("ci_server.BUILD_PIPELINE", [("a", slow), ("b", None)])
+    monkeypatch.setitem(STAGE_TIMEOUTS, "a", 0.5)
+    state = new_build_state({})
+    start = time.monotonic()
+    assert run_pipeline(state) == "timed_out"
+    assert time.monotonic() - start < 10
+    assert [s[:2] for s in state["stages"]] == [("a", "timed_out"), ("b", "skipped")]
+    assert "a stage stopped: " in state["log"].tail()
+
+
+def git_repo(path, message):
+    os.makedirs(path)
+    with open(os.path.join(path, "app.py"), "w") as f:
+        f.write("x = 1\n")
+    identity = ["-c", "user.name=ci", "-c", "user.email=ci@example.com"]
+    subprocess.run(["git", "init", "-q"], cwd=path, check=True)
+    subprocess.run(["git", "add", "app.py"], cwd=path, check=True)
+    subprocess.run(
+        ["git", *identity, "commit", "-q", "-m", message], cwd=path, check=True
     )
+    return str(path)
 
-    assert status_code == mock_response.status_code
+
+@patch("ci_server.prepare_environment")
+@patch("ci_server.clone_repo")
+@patch("ci_server.check_syntax")
+@patch("ci_server.run_tests")
+@patch("ci_server.update_github_status")
+def test_process_request_reuses_results(
+    mock_update_status,
+    mock_run_tests,
+    mock_check_syntax,
+    mock_clone_repo,
+    mock_prepare_env,
+    tmp_path,
+):
+    mock_prepare_env.return_value = ("python", True)
+    mock_check_syntax.return_value = ([], {"files": 1, "cached": 0, "shards": 1})
+
+    def run_tests(path, python, log, **kwargs):
+        log.write("1 passed\n")
+        return True, ""
+
+    mock_run_tests.side_effect = run_tests
+    mock_clone_repo.return_value = (True, git_repo(tmp_path / "first", "first"))
+    assert process_request(PUSH) == 200
+    first = get_builds(connect())[-1][0]
+
+    # Another commit with the same content, e.g. a merge, reuses the result
+    mock_clone_repo.return_value = (True, git_repo(tmp_path / "merge", "merge"))
+    assert process_request(dict(PUSH, after="ef567890")) == 200
+    assert mock_run_tests.call_count == 1
+    mock_update_status.assert_called_with(
+        "https://api.github.com/repos/example/repo/statuses/ef567890",
+        "success",
+        GITHUB_TOKEN,
+        description=f"CI test results of build {first}",
+    )
+    build = get_builds(connect())[-1]
+    assert build[3] == "success"
+    assert build[7] == first
+    assert [s[:2] for s in get_build_stages(connect(), build[0])][2:4] == [
+        ("result_cache", "success"),
+        ("env", "skipped"),
+    ]
+    log = b"".join(log_store.iter_log(connect(), build[0])).decode()
+    assert f"by build {first}, reusing its result: success" in log
+    assert log.endswith(b"".join(log_store.iter_log(connect(), first)).decode())
+
+    # Failures of the environment are not reused
+    mock_clone_repo.return_value = (True, git_repo(tmp_path / "other", "other"))
+    with open(os.path.join(tmp_path, "other", "requirements.txt"), "w") as f:
+        f.write("missing-package\n")
+    mock_prepare_env.side_effect = subprocess.CalledProcessError(1, "pip")
+    assert process_request(PUSH) == 200
+    mock_prepare_env.side_effect = None
+    assert process_request(PUSH) == 200
+    assert mock_run_tests.call_count == 2
+
+    # Neither are test failures, the tests run again on a rebuild
+    mock_run_tests.side_effect = None
+    mock_run_tests.return_value = (False, "")
+    failing = git_repo(tmp_path / "failing", "failing")
+    with open(os.path.join(failing, "app.py"), "w") as f:
+        f.write("x = 2\n")
+    subprocess.run(["git", "add", "app.py"], cwd=failing, check=True)
+    subprocess.run(
+        ["git", "-c", "user.name=ci", "-c", "user.email=ci@example.com"]
+        + ["commit", "-q", "-m", "x = 2"],
+        cwd=failing,
+        check=True,
+    )
+    mock_clone_repo.return_value = (True, failing)
+    assert process_request(PUSH) == 200
+    assert process_request(PUSH) == 200
+    assert mock_run_tests.call_count == 4
+    assert get_builds(connect())[-1][7] is None
+
+
+def test_is_reusable_without_stages():
+    state = new_build_state(PUSH)
+    state["result_key"] = ("tree", "env")
+    assert not is_reusable(state, "failure")
+    state["stages"] = [("compile", "failure", None, 0.0, None, None, None)]
+    assert is_reusable(state, "failure")
+    assert is_reusable(state, "success")
+
+
+FLAKY_TESTS = """
+import os
+
+def test_flaky():
+    # Fails on the first run in a checkout
+    if not os.path.exists("ran"):
+        open("ran", "w").close()
+        assert False, "first run"
+"""
+
+
+def test_retry_flaky_tests(tmp_path, monkeypatch):
+    monkeypatch.setattr("ci_server.FLAKY_RETRIES", 1)
+    (tmp_path / "test_flaky.py").write_text(FLAKY_TESTS)
+    state = new_build_state(PUSH)
+    state.update(repo_path=str(tmp_path), python=sys.executable)
+
+    # Unknown failures are not retried
+    state["flaky_tests"] = []
+    assert stage_test(state) == "failure"
+    assert [r[1] for r in state["test_results"]] == ["failed"]
+    assert "first run" in state["test_results"][0][3]
+
+    # A known flaky test runs again and its runs are both recorded
+    os.remove(tmp_path / "ran")
+    state["flaky_tests"] = ["test_flaky.py::test_flaky"]
+    assert stage_test(state) == "success"
+    assert [r[:2] for r in state["test_results"]] == [
+        ("test_flaky.py::test_flaky", "failed"),
+        ("test_flaky.py::test_flaky", "passed"),
+    ]
+    assert "Retrying 1 known flaky test(s)" in state["log"].tail()
+
+    # Other failures in the same build fail it without a retry
+    os.remove(tmp_path / "ran")
+    (tmp_path / "test_broken.py").write_text("def test_broken():\n    assert False\n")
+    assert stage_test(state) == "failure"
+    assert len(state["test_results"]) == 2
+
+
+def test_flaky_tests_views(client, temp_db):
+    conn = connect()
+    for outcome in ("passed", "failed"):
+        build_id = insert_build(
+            conn, "abcd1234", "2025-01-01 00:00:00", "failure", "", "example/repo"
+        )
+        insert_test_results(
+            conn,
+            build_id,
+            [
+                ("tests/test_a.py::test_flaky", outcome, 0.1, "assert 0 == 1"),
+                ("tests/test_a.py::test_broken", "failed", 0.1, "assert broken"),
+            ],
+        )
+
+    response = client.get(f"/build/{build_id}")
+    assert b"tests/test_a.py::test_flaky" in response.data
+    assert b"failed (known flaky)" in response.data
+    assert b"assert broken" in response.data
+
+    response = client.get("/tests/flaky?repo=example/repo")
+    assert response.get_json()["tests"] == [
+        {"test_id": "tests/test_a.py::test_flaky", "trees": 1, "last_build_id": 2}
+    ]
+    assert client.get("/tests/flaky").status_code == 400
+
+    response = client.get(
+        "/tests/history",
+        query_string={"repo": "example/repo", "test": "tests/test_a.py::test_flaky"},
+    )
+    runs = response.get_json()["runs"]
+    assert [(run["build_id"], run["outcome"]) for run in runs] == [
+        (2, "failed"),
+        (1, "passed"),
+    ]
+
+
+MATRIX = (
+    """
+[matrix]
+python = ["%d.%d"]
+env = [{MODE = "a"}, {MODE = "b"}]
+"""
+    % sys.version_info[:2]
+)
+
+
+@patch("ci_server.prepare_environment")
+@patch("ci_server.clone_repo")
+@patch("ci_server.check_syntax")
+@patch("ci_server.run_tests")
+@patch("ci_server.update_github_status")
+def test_process_request_build_matrix(
+    mock_update_status,
+    mock_run_tests,
+    mock_check_syntax,
+    mock_clone_repo,
+    mock_prepare_env,
+    client,
+    tmp_path,
+):
+    mock_prepare_env.return_value = (sys.executable, True)
+    mock_check_syntax.return_value = ([], {"files": 1, "cached": 0, "shards": 1})
+    # Cell a passes and cell b fails
+    mock_run_tests.side_effect = lambda *args, env, **kwargs: (env["MODE"] == "a", "")
+    checkouts = []
+
+    def clone(*args):
+        path = git_repo(tmp_path / f"checkout-{len(checkouts)}", "matrix")
+        with open(os.path.join(path, ".ci.toml"), "w") as f:
+            f.write(MATRIX)
+        checkouts.append(path)
+        return True, path
+
+    mock_clone_repo.side_effect = clone
+    push = dict(PUSH, ref="refs/heads/main")
+    url = "https://api.github.com/repos/example/repo/statuses/abcd1234"
+    python = "py%d.%d" % sys.version_info[:2]
+    contexts = [f"CI/Test ({python}, MODE=a)", f"CI/Test ({python}, MODE=b)"]
+
+    # The push fans out into one queued build per cell
+    assert process_request(push) == 200
+    parent = get_builds(connect())[0]
+    assert parent[3] == "matrix"
+    cells = get_matrix_cells(connect(), parent[0])
+    assert [cell[1:] for cell in cells] == [
+        (f"{python}, MODE=a", "queued"),
+        (f"{python}, MODE=b", "queued"),
+    ]
+    for context in contexts:
+        mock_update_status.assert_any_call(
+            url, "pending", GITHUB_TOKEN, context=context
+        )
+    mock_run_tests.assert_not_called()
+    assert b"Build Matrix" in client.get(f"/build/{parent[0]}").data
+
+    # Each cell builds with its own variables and reports under its own context
+    assert scheduler.run_next()
+    assert get_build(connect(), parent[0])[3] == "matrix"
+    assert scheduler.run_next()
+    assert not scheduler.run_next()
+    assert [kwargs["env"] for _, kwargs in mock_run_tests.call_args_list] == [
+        {"MODE": "a"},
+        {"MODE": "b"},
+    ]
+    mock_update_status.assert_any_call(
+        url, "success", GITHUB_TOKEN, context=contexts[0]
+    )
+    mock_update_status.assert_any_call(
+        url, "failure", GITHUB_TOKEN, context=contexts[1]
+    )
+    # The last cell sets the combined status
+    mock_update_status.assert_called_with(
+        url, "failure", GITHUB_TOKEN, description="1 of 2 matrix cells passed"
+    )
+    assert get_build(connect(), parent[0])[3] == "failure"
+    cell = get_build(connect(), cells[1][0])
+    assert cell[3] == "failure"
+    assert cell[9:] == (parent[0], f"{python}, MODE=b")
+    log = b"".join(log_store.iter_log(connect(), cell[0])).decode()
+    assert f"Matrix cell {python}, MODE=b with {sys.executable}" in log
+
+    # The cells of a newer push supersede the queued cells of the matrix
+    assert process_request(push) == 200
+    assert process_request(dict(push, after="ef567890")) == 200
+    builds = get_builds(connect())
+    old, new = [b for b in builds if b[3] == "superseded" and b[9] is None], [
+        b for b in builds if b[3] == "matrix"
+    ]
+    assert len(old) == 1 and len(new) == 1
+    assert [cell[2] for cell in get_matrix_cells(connect(), old[0][0])] == [
+        "superseded",
+        "superseded",
+    ]
+    # The pending combined status of the superseded matrix is resolved
+    mock_update_status.assert_any_call(
+        url,
+        "error",
+        GITHUB_TOKEN,
+        description=f"Skipped, superseded by ef56789 (build #{new[0][0]})",
+        target_url="https://github.com/example/repo/commit/ef567890",
+    )
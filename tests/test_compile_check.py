@@ -0,0 +1,83 @@
+import sys
+import os
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import compile_check
+from db import *
+from compile_check import *
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    # Use a temporary file as the database for the compile cache.
+    monkeypatch.setattr("db.DATABASE", str(tmp_path / "test_compile_check.db"))
+    initialise_db()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    path = tmp_path / "repo"
+    (path / "pkg").mkdir(parents=True)
+    (path / "pkg" / "ok.py").write_text("print('hello')\n")
+    (path / "pkg" / "bad.py").write_text("x = 1\nprint('hello'\n")
+    # Third party code and virtual environments are skipped
+    (path / ".venv" / "lib").mkdir(parents=True)
+    (path / ".venv" / "lib" / "broken.py").write_text("def (\n")
+    (path / "env" / "lib").mkdir(parents=True)
+    (path / "env" / "pyvenv.cfg").write_text("home = /usr/bin\n")
+    (path / "env" / "lib" / "broken.py").write_text("def (\n")
+    (path / ".git").mkdir()
+    (path / ".git" / "hook.py").write_text("def (\n")
+    return str(path)
+
+
+def test_find_python_files(repo):
+    files = [os.path.relpath(f, repo) for f in find_python_files(repo)]
+    assert files == [os.path.join("pkg", "bad.py"), os.path.join("pkg", "ok.py")]
+
+
+def test_check_syntax_reports_errors(repo, temp_db):
+    errors, stats = check_syntax(repo, sys.executable)
+    assert stats == {"files": 2, "cached": 0, "shards": 1}
+    assert len(errors) == 1
+    assert errors[0]["file"] == os.path.join("pkg", "bad.py")
+    assert errors[0]["type"] == "SyntaxError"
+    assert errors[0]["line"] is not None
+    assert format_errors(errors).startswith(os.path.join("pkg", "bad.py") + ":")
+
+
+def test_check_syntax_caches_compiled_files(repo, temp_db):
+    check_syntax(repo, sys.executable)
+
+    # Only the file that failed is compiled again
+    errors, stats = check_syntax(repo, sys.executable)
+    assert stats["cached"] == 1
+    assert len(errors) == 1
+
+    # Fixing it makes every file a cache hit on the next run
+    with open(os.path.join(repo, "pkg", "bad.py"), "w") as f:
+        f.write("x = 1\n")
+    errors, stats = check_syntax(repo, sys.executable)
+    assert errors == []
+    errors, stats = check_syntax(repo, sys.executable)
+    assert stats == {"files": 2, "cached": 2, "shards": 0}
+
+
+def test_check_syntax_shards_files(tmp_path, temp_db, monkeypatch):
+    monkeypatch.setattr(compile_check, "MIN_SHARD_SIZE", 2)
+    for i in range(7):
+        (tmp_path / f"module_{i}.py").write_text(f"x = {i}\n")
+    (tmp_path / "module_bad.py").write_text("x = (\n")
+
+    errors, stats = check_syntax(str(tmp_path), sys.executable, workers=3)
+    assert stats["shards"] == 3
+    assert [error["file"] for error in errors] == ["module_bad.py"]
+
+
+def test_check_syntax_without_database(repo, tmp_path, monkeypatch):
+    # A missing cache table only disables the cache
+    monkeypatch.setattr("db.DATABASE", str(tmp_path / "missing" / "ci_server.db"))
+    errors, stats = check_syntax(repo, sys.executable)
+    assert len(errors) == 1
+    assert stats["cached"] == 0
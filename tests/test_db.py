@@ -86,7 +86,277 @@ def test_close_db(app_context):
     # Confirm that 'db' is no longer in the Flask global `g`.
     assert "db" not in g
 
-    # If we ask for the connection again, a new one should be created.
+    # Closing returned the connection to the pool, the next request reuses it.
     new_db_conn = get_db()
-    assert new_db_conn is not None
-    assert new_db_conn != db_conn
+    assert new_db_conn is db_conn
+    assert new_db_conn.execute("SELECT 1").fetchone() == (1,)
+
+
+def test_cache_events(app_context):
+    db_conn = get_db()
+    build_id = insert_build(db_conn, "abc123", "2023-10-10", "success", "")
+    insert_cache_event(db_conn, build_id, "env", True)
+    insert_cache_event(db_conn, build_id, "git", False)
+    other = insert_build(db_conn, "def456", "2023-10-10", "success", "")
+    insert_cache_event(db_conn, other, "env", False)
+
+    assert get_cache_events(db_conn, build_id) == [("env", 1), ("git", 0)]
+    assert get_cache_hit_rates(db_conn) == [("env", 1, 2), ("git", 0, 1)]
+
+
+def test_build_stages(app_context):
+    db_conn = get_db()
+    build_id = insert_build(
+        db_conn, "abc123", "2023-10-10", "failure", "", "example/repo"
+    )
+    insert_build_stage(
+        db_conn, build_id, "checkout", "success", 100.0, 1.5, 0.2, 8192, 4096
+    )
+    insert_build_stage(db_conn, build_id, "env", "failure", 101.5, 3.0)
+    insert_build_stage(db_conn, build_id, "compile", "skipped", None, 0.0)
+
+    assert get_build_stages(db_conn, build_id) == [
+        ("checkout", "success", 100.0, 1.5, 0.2, 8192, 4096),
+        ("env", "failure", 101.5, 3.0, None, None, None),
+        ("compile", "skipped", None, 0.0, None, None, None),
+    ]
+
+    # Skipped stages and other repositories are left out of the aggregates
+    other = insert_build(db_conn, "def456", "2023-10-10", "success", "", "other/repo")
+    insert_build_stage(db_conn, other, "checkout", "success", 100.0, 9.0)
+    assert sorted(get_stage_usage(db_conn, "example/repo")) == [
+        ("checkout", 1.5, 0.2, 8192, 4096),
+        ("env", 3.0, None, None, None),
+    ]
+
+
+def test_test_results_and_file_durations(app_context):
+    db_conn = get_db()
+    for duration in (1.0, 3.0):
+        build_id = insert_build(
+            db_conn, "abc123", "2023-10-10", "success", "", repo="example/repo"
+        )
+        insert_test_results(
+            db_conn,
+            build_id,
+            [
+                ("tests/test_a.py::test_x", "passed", duration, None),
+                ("tests/test_a.py::test_y", "passed", 1.0, None),
+                ("tests/test_b.py::test_z", "failed", 0.5, "assert 1 == 2"),
+            ],
+        )
+    other = insert_build(
+        db_conn, "def456", "2023-10-10", "success", "", repo="other/repo"
+    )
+    insert_test_results(
+        db_conn, other, [("tests/test_a.py::test_x", "passed", 100.0, None)]
+    )
+
+    assert get_test_results(db_conn, build_id)[0] == (
+        "tests/test_a.py::test_x",
+        "passed",
+        3.0,
+        None,
+    )
+    assert get_test_file_durations(db_conn, "example/repo") == {
+        "tests/test_a.py": 3.0,
+        "tests/test_b.py": 0.5,
+    }
+
+
+def test_test_history_and_flaky_tests(app_context):
+    db_conn = get_db()
+
+    def build(commit, outcomes, tree=None, repo="example/repo", cell=None):
+        build_id = insert_build(
+            db_conn,
+            commit,
+            "2023-10-10",
+            "success",
+            "",
+            repo=repo,
+            tree_hash=tree,
+            matrix_cell=cell,
+        )
+        insert_test_results(
+            db_conn,
+            build_id,
+            [(test_id, outcome, 0.1, None) for test_id, outcome in outcomes],
+        )
+        return build_id
+
+    # Flips on the same commit, on the same tree of two commits and on a retry
+    build("a", [("t::flaky", "passed"), ("t::broken", "failed")])
+    build("a", [("t::flaky", "failed"), ("t::broken", "failed")])
+    build("b", [("t::flaky", "failed"), ("t::fixed", "failed")], tree="tree1")
+    build("c", [("t::flaky", "passed"), ("t::fixed", "failed")], tree="tree1")
+    last = build("d", [("t::retried", "error"), ("t::retried", "passed")])
+    # A test fixed by a change of the tree is not flaky
+    build("e", [("t::fixed", "passed")], tree="tree2")
+    build("a", [("t::other", "passed")], repo="other/repo")
+    build("a", [("t::other", "failed")], repo="other/repo")
+    # A test that fails on one cell of a build matrix and passes on another is not flaky
+    build("f", [("t::py312", "failed")], tree="tree3", cell="py3.12")
+    build("f", [("t::py312", "passed")], tree="tree3", cell="py3.11")
+
+    assert get_flaky_tests(db_conn, "example/repo") == [
+        ("t::flaky", 2, 4),
+        ("t::retried", 1, last),
+    ]
+    # Only the last builds of the repo are considered
+    assert get_flaky_tests(db_conn, "example/repo", window=5) == [
+        ("t::retried", 1, last)
+    ]
+
+    history = get_test_history(db_conn, "example/repo", "t::flaky", limit=3)
+    assert [(row[0], row[1], row[3]) for row in history] == [
+        (4, "c", "passed"),
+        (3, "b", "failed"),
+        (2, "a", "failed"),
+    ]
+
+
+def test_test_impact_index(app_context):
+    db_conn = get_db()
+    assert get_test_impact_index(db_conn, "example/repo") is None
+
+    mapping = {"src/a.py": {"tests/test_a.py", "tests/test_b.py"}}
+    replace_test_impact_index(db_conn, "example/repo", "abc123", "hash", mapping)
+    assert get_test_impact_index(db_conn, "example/repo") == ("abc123", "hash", mapping)
+
+    # A new full run replaces the whole index of the repository
+    mapping = {"src/b.py": {"tests/test_b.py"}}
+    replace_test_impact_index(db_conn, "example/repo", "def456", "hash", mapping)
+    assert get_test_impact_index(db_conn, "example/repo") == ("def456", "hash", mapping)
+
+
+def test_update_and_abort_running_builds(app_context):
+    db_conn = get_db()
+    build_id = insert_build(db_conn, "abc123", "2023-10-10", "running", "")
+    other = insert_build(db_conn, "def456", "2023-10-10", "running", "")
+
+    update_build(db_conn, build_id, "success", "1 passed", "partial", tree_hash="t1")
+    assert get_build(db_conn, build_id)[3:] == (
+        "success",
+        "1 passed",
+        None,
+        "partial",
+        None,
+        "t1",
+        None,
+        None,
+    )
+
+    # Builds still running when the server restarts can never finish
+    assert abort_running_builds(db_conn) == 1
+    assert get_build(db_conn, other)[3] == "error"
+
+
+def test_build_results(app_context):
+    db_conn = get_db()
+    assert get_build_result(db_conn, "example/repo", "tree", "env") is None
+
+    insert_build_result(db_conn, "example/repo", "tree", "env", 1, "failure")
+    insert_build_result(db_conn, "example/repo", "tree", "env", 2, "success")
+    assert get_build_result(db_conn, "example/repo", "tree", "env") == (2, "success")
+    assert get_build_result(db_conn, "example/repo", "tree", "other") is None
+    assert get_build_result(db_conn, "example/fork", "tree", "env") is None
+
+    build_id = insert_build(db_conn, "abc123", "2023-10-10", "running", "")
+    update_build(db_conn, build_id, "success", "", cached_from=2)
+    assert get_build(db_conn, build_id)[7] == 2
+
+
+def test_list_builds(app_context):
+    db_conn = get_db()
+    for i in range(5):
+        insert_build(
+            db_conn,
+            f"abc{i}",
+            f"2023-10-1{i} 12:00:00",
+            "success" if i % 2 else "failure",
+            "x" * 1000,
+        )
+
+    # Summary columns only, newest first, continuing after the last id of a page
+    page = list_builds(db_conn, limit=2)
+    assert [row[0] for row in page] == [5, 4]
+    assert page[0] == (
+        5,
+        "abc4",
+        "2023-10-14 12:00:00",
+        "failure",
+        None,
+        "full",
+        None,
+        None,
+    )
+    assert [row[0] for row in list_builds(db_conn, 2, before_id=4)] == [3, 2]
+
+    assert [row[0] for row in list_builds(db_conn, status="success")] == [4, 2]
+    assert [row[0] for row in list_builds(db_conn, commit_prefix="abc3")] == [4]
+    dates = list_builds(db_conn, date_from="2023-10-11", date_to="2023-10-13")
+    assert [row[0] for row in dates] == [4, 3, 2]
+
+
+def test_list_builds_uses_indexes(app_context):
+    db_conn = get_db()
+    plan = db_conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM builds WHERE commit_identifier GLOB 'ab*'"
+    ).fetchall()
+    assert "idx_builds_commit" in str(plan)
+
+
+def test_connections_use_wal(app_context):
+    conn = connect()
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert conn.execute("PRAGMA busy_timeout").fetchone() == (DB_BUSY_TIMEOUT_MS,)
+    conn.close()
+
+
+def test_connection_pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "pool.db"), size=1)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+
+    # An unfinished transaction is rolled back when the connection is returned
+    first.execute("CREATE TABLE t (x INTEGER)")
+    first.commit()
+    first.execute("INSERT INTO t VALUES (1)")
+    first.close()
+    first.close()  # Returning a connection twice has no effect
+    assert pool.acquire() is first
+    assert first.execute("SELECT COUNT(*) FROM t").fetchone() == (0,)
+
+    # Connections beyond the pool size are closed
+    first.close()
+    second.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        second.execute("SELECT 1")
+    pool.close()
+
+
+def test_database_writer(app_context):
+    def failing(conn):
+        insert_build(conn, "bad", "2023-10-10", "success", "")
+        raise sqlite3.IntegrityError("rejected")
+
+    writer = get_writer()
+    futures = [
+        writer.submit(insert_build, "abc123", "2023-10-10", "success", ""),
+        writer.submit(failing),
+        writer.submit(insert_build, "def456", "2023-10-10", "success", ""),
+    ]
+    assert futures[0].result() == 1
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result()
+
+    # The failing write is undone without affecting the others in its batch
+    assert writer.write(get_builds)[-1][1] == "def456"
+    assert [row[1] for row in get_builds(get_db())] == ["abc123", "def456"]
+
+    # Every write of the batches is counted, the failing one included
+    stats = writer.stats()
+    assert stats["writes"] == 4
+    assert 0 <= stats["avg_latency"] <= stats["p95_latency"] <= stats["max_latency"]
@@ -0,0 +1,72 @@
+import sys
+import os
+import hashlib
+import hmac
+import time
+from contextlib import closing
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from db import *
+from deliveries import *
+
+
+@pytest.fixture(autouse=True)
+def temp_db(tmp_path, monkeypatch):
+    monkeypatch.setattr("db.DATABASE", str(tmp_path / "test_deliveries.db"))
+    initialise_db()
+
+
+def test_verify_signature():
+    body = b'{"after": "abcd1234"}'
+    signature = "sha256=" + hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+    assert verify_signature(body, signature, "secret")
+    assert not verify_signature(body, signature, "other")
+    assert not verify_signature(body + b" ", signature, "secret")
+    assert not verify_signature(body, None, "secret")
+    assert not verify_signature(body, signature[len("sha256=") :], "secret")
+
+
+def test_processor_handles_deliveries_in_order():
+    conn = connect()
+    assert insert_delivery(conn, "a", "push", b"1", 1.0)
+    assert insert_delivery(conn, "b", "push", b"2", 2.0)
+    assert not insert_delivery(conn, "a", "push", b"1", 3.0)
+
+    handled = []
+
+    def handler(event, body):
+        handled.append(body)
+        if body == b"2":
+            raise ValueError("broken payload")
+        return "queued", 7
+
+    processor = DeliveryProcessor(handler)
+    assert processor.run_pending() == 2
+    assert handled == [b"1", b"2"]
+    # Processed deliveries drop their body but keep their id for deduplication
+    assert get_delivery(conn, "a")[2:] == (None, 1.0, "queued", 7)
+    assert get_delivery(conn, "b")[4] == "error"
+    assert processor.run_pending() == 0
+
+    assert prune_deliveries(conn, 1.5) == 1
+    assert get_delivery(conn, "a") is None
+    conn.close()
+
+
+def test_processor_thread():
+    processor = DeliveryProcessor(lambda event, body: ("queued", None))
+    processor.start()
+    try:
+        with closing(connect()) as conn:
+            insert_delivery(conn, "a", "push", b"{}", time.time())
+        processor.notify()
+        for _ in range(100):
+            with closing(connect()) as conn:
+                if get_delivery(conn, "a")[4] == "queued":
+                    break
+            time.sleep(0.05)
+        with closing(connect()) as conn:
+            assert get_delivery(conn, "a")[4] == "queued"
+    finally:
+        processor.stop(5)
@@ -0,0 +1,138 @@
+import sys
+import os
+import subprocess
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import env_cache
+import sandbox
+from env_cache import *
+
+
+@pytest.fixture
+def fake_builds(tmp_path, monkeypatch):
+    """Use a temporary cache and record environment builds instead of running pip."""
+    monkeypatch.setattr(env_cache, "ENV_CACHE_DIR", str(tmp_path / "cache"))
+    builds = []
+
+    def create(repo_path, env_dir, python, extra_packages=()):
+        builds.append(repo_path)
+        os.makedirs(os.path.join(env_dir, "lib"))
+        with open(os.path.join(env_dir, "lib", "package.py"), "w") as f:
+            f.write("x = 1\n")
+
+    monkeypatch.setattr(env_cache, "_create_environment", create)
+    return builds
+
+
+def make_repo(tmp_path, name, requirements=None):
+    path = tmp_path / name
+    path.mkdir()
+    if requirements is not None:
+        (path / "requirements.txt").write_text(requirements)
+    return str(path)
+
+
+def test_environment_key(tmp_path):
+    a = make_repo(tmp_path, "a", "flask\n")
+    b = make_repo(tmp_path, "b", "flask\n")
+    c = make_repo(tmp_path, "c", "flask==3.1.0\n")
+    assert environment_key(a) == environment_key(b)
+    assert environment_key(a) != environment_key(c)
+    assert environment_key(a) != environment_key(a, extra_packages=("coverage",))
+
+    # Included requirement files are part of the key
+    (tmp_path / "b" / "requirements.txt").write_text("-r base.txt\n")
+    (tmp_path / "b" / "base.txt").write_text("flask\n")
+    key = environment_key(b)
+    (tmp_path / "b" / "base.txt").write_text("requests\n")
+    assert environment_key(b) != key
+
+
+def test_prepare_environment_reuses_cache(tmp_path, fake_builds):
+    a = make_repo(tmp_path, "a", "flask\n")
+    b = make_repo(tmp_path, "b", "flask\n")
+
+    python, hit = prepare_environment(a)
+    assert not hit
+    assert python == venv_python(os.path.join(a, ".venv"))
+
+    _, hit = prepare_environment(b)
+    assert hit
+    assert fake_builds == [a]
+    assert os.path.exists(os.path.join(b, ".venv", "lib", "package.py"))
+
+    # Calling it again for the same checkout keeps its environment
+    _, hit = prepare_environment(b)
+    assert hit
+    assert fake_builds == [a]
+
+
+def test_editable_requirements_are_not_cached(tmp_path, fake_builds):
+    a = make_repo(tmp_path, "a", "-e .\n")
+    _, hit = prepare_environment(a)
+    assert not hit
+    assert not os.path.exists(env_cache.ENV_CACHE_DIR)
+
+
+@pytest.mark.parametrize(
+    "requirement",
+    [
+        ".",
+        "./pkg",
+        "/opt/wheels/pkg-1.0-py3-none-any.whl",
+        "pkg @ file:///opt/pkg",
+        "git+https://github.com/example/pkg.git@main",
+    ],
+)
+def test_local_and_url_requirements_are_not_cached(tmp_path, fake_builds, requirement):
+    a = make_repo(tmp_path, "a", f"flask\n{requirement}\n")
+    _, hit = prepare_environment(a)
+    assert not hit
+    assert not os.path.exists(env_cache.ENV_CACHE_DIR)
+
+
+def test_index_options_are_cached(tmp_path, fake_builds):
+    a = make_repo(tmp_path, "a", "--index-url https://pypi.example.com/simple\nflask\n")
+    prepare_environment(a)
+    assert os.path.exists(env_cache.ENV_CACHE_DIR)
+
+
+def test_failed_build_is_not_cached(tmp_path, fake_builds, monkeypatch):
+    def fail(repo_path, env_dir, python, extra_packages=()):
+        os.makedirs(env_dir)
+        raise subprocess.CalledProcessError(1, "pip")
+
+    monkeypatch.setattr(env_cache, "_create_environment", fail)
+    a = make_repo(tmp_path, "a", "not-a-package\n")
+    with pytest.raises(subprocess.CalledProcessError):
+        prepare_environment(a)
+    assert os.listdir(env_cache.ENV_CACHE_DIR) == [environment_key(a) + ".lock"]
+
+
+def test_environment_is_created_with_the_build_limits(tmp_path, monkeypatch):
+    monkeypatch.setattr(env_cache, "ENV_CACHE_DIR", str(tmp_path / "cache"))
+    commands = []
+
+    def run(command, **kwargs):
+        # ensurepip runs in a limited process, not in the server
+        commands.append(command)
+        raise sandbox.LimitExceeded("timed_out", command)
+
+    monkeypatch.setattr(sandbox, "run", run)
+    with pytest.raises(sandbox.LimitExceeded):
+        prepare_environment(make_repo(tmp_path, "a"))
+    assert commands == [[sys.executable, "-m", "venv", commands[0][-1]]]
+    assert not os.path.exists(commands[0][-1])
+
+
+def test_evict_environments(tmp_path, fake_builds):
+    a = make_repo(tmp_path, "a", "flask\n")
+    prepare_environment(a)
+    assert evict_environments(max_bytes=0) > 0
+
+    # The checkout keeps its own links to the environment
+    assert os.path.exists(os.path.join(a, ".venv", "lib", "package.py"))
+    b = make_repo(tmp_path, "b", "flask\n")
+    _, hit = prepare_environment(b)
+    assert not hit
@@ -0,0 +1,134 @@
+import sys
+import os
+import subprocess
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import git_cache
+import resource_usage
+import sandbox
+from git_cache import *
+
+
+def git(*args, cwd):
+    result = subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    )
+    return result.stdout.strip()
+
+
+def commit(repo, name, content):
+    with open(os.path.join(repo, name), "w") as f:
+        f.write(content)
+    git("add", name, cwd=repo)
+    git(
+        "-c",
+        "user.name=ci",
+        "-c",
+        "user.email=ci@example.com",
+        "commit",
+        "-q",
+        "-m",
+        name,
+        cwd=repo,
+    )
+    return git("rev-parse", "HEAD", cwd=repo)
+
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch):
+    """A local repository standing in for GitHub, and an empty git cache."""
+    monkeypatch.setattr(git_cache, "GIT_CACHE_DIR", str(tmp_path / "cache"))
+    repo = tmp_path / "upstream"
+    repo.mkdir()
+    git("init", "-q", "-b", "main", cwd=repo)
+    return str(repo)
+
+
+def test_checkout_commit(upstream, tmp_path):
+    first = commit(upstream, "a.py", "print(1)\n")
+    checkout = str(tmp_path / "checkout-1")
+
+    mirror = checkout_commit(upstream, first, checkout)
+    assert mirror == mirror_path(upstream)
+    assert os.path.exists(os.path.join(mirror, "HEAD"))
+    assert git("rev-parse", "HEAD", cwd=checkout) == first
+    assert os.path.exists(os.path.join(checkout, "a.py"))
+
+    # A new commit is fetched incrementally into the same mirror
+    second = commit(upstream, "b.py", "print(2)\n")
+    checkout2 = str(tmp_path / "checkout-2")
+    checkout_commit(upstream, second, checkout2)
+    assert git("rev-parse", "HEAD", cwd=checkout2) == second
+    assert os.listdir(git_cache.GIT_CACHE_DIR).count(os.path.basename(mirror)) == 1
+
+    remove_checkout(upstream, checkout)
+    remove_checkout(upstream, checkout2)
+    assert not os.path.exists(checkout)
+    assert not os.path.exists(os.path.join(mirror, "worktrees", "checkout-1"))
+
+
+def test_known_commit_is_not_fetched(upstream, tmp_path, monkeypatch):
+    sha = commit(upstream, "a.py", "print(1)\n")
+    update_mirror(upstream, sha)
+
+    calls = []
+    real_run = sandbox.run
+
+    def run(command, *args, **kwargs):
+        calls.append(command)
+        return real_run(command, *args, **kwargs)
+
+    monkeypatch.setattr(git_cache.sandbox, "run", run)
+    update_mirror(upstream, sha)
+    assert not any("fetch" in command for command in calls)
+
+
+def test_evict_mirrors(upstream, tmp_path):
+    sha = commit(upstream, "a.py", "x" * 10000)
+    checkout = str(tmp_path / "checkout")
+    mirror = checkout_commit(upstream, sha, checkout)
+
+    # Mirrors with checkouts are kept
+    assert evict_mirrors(max_bytes=0) == 0
+    assert os.path.exists(mirror)
+
+    remove_checkout(upstream, checkout)
+    assert evict_mirrors(max_bytes=0) > 0
+    assert not os.path.exists(mirror)
+
+
+def test_downloaded_objects_are_counted(upstream, tmp_path):
+    sha = commit(upstream, "a.py", "x = 1\n" * 1000)
+    with resource_usage.measure() as usage:
+        update_mirror(upstream, sha)
+    assert usage["downloaded"] > 0
+
+    # A known commit downloads nothing
+    with resource_usage.measure() as usage:
+        update_mirror(upstream, sha)
+    assert usage["downloaded"] == 0
+
+
+def test_tree_hash(upstream, tmp_path):
+    first = commit(upstream, "a.py", "print(1)\n")
+    commit(upstream, "a.py", "print(2)\n")
+    git(
+        "-c",
+        "user.name=ci",
+        "-c",
+        "user.email=ci@example.com",
+        "revert",
+        "--no-edit",
+        "HEAD",
+        cwd=upstream,
+    )
+    reverted = git("rev-parse", "HEAD", cwd=upstream)
+
+    # The revert restores the content of the first commit
+    checkout = str(tmp_path / "checkout-1")
+    checkout2 = str(tmp_path / "checkout-2")
+    checkout_commit(upstream, first, checkout)
+    checkout_commit(upstream, reverted, checkout2)
+    assert tree_hash(checkout) == tree_hash(checkout2)
+    assert tree_hash(checkout) == git("rev-parse", "HEAD^{tree}", cwd=upstream)
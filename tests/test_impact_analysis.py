@@ -0,0 +1,166 @@
+import sys
+import os
+import subprocess
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from impact_analysis import *
+
+INDEX = (
+    "abc123",
+    "hash",
+    {
+        "src/a.py": {"tests/test_a.py"},
+        "src/b.py": {"tests/test_a.py", "tests/test_b.py"},
+        "tests/test_a.py": {"tests/test_a.py"},
+    },
+)
+
+
+def git(*args, cwd):
+    result = subprocess.run(
+        ["git", "-c", "user.name=ci", "-c", "user.email=ci@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip()
+
+
+def test_select_tests():
+    assert select_tests(INDEX, ["src/a.py"], "hash") == ["tests/test_a.py"]
+    assert select_tests(INDEX, ["src/b.py", "README.md"], "hash") == [
+        "tests/test_a.py",
+        "tests/test_b.py",
+    ]
+    assert select_tests(INDEX, ["tests/test_new.py"], "hash") == ["tests/test_new.py"]
+    assert select_tests(INDEX, ["docs/index.rst"], "hash") == []
+    # Changed test files run even when the index does not know them
+    assert select_tests(
+        INDEX, ["tests/helpers_test.py", "tests/test_a.py"], "hash"
+    ) == [
+        "tests/helpers_test.py",
+        "tests/test_a.py",
+    ]
+
+
+def test_select_tests_falls_back_to_full_run():
+    # No index, unknown diff or a different configuration
+    assert select_tests(None, ["src/a.py"], "hash") is None
+    assert select_tests(INDEX, None, "hash") is None
+    assert select_tests(INDEX, ["src/a.py"], "other") is None
+    # Configuration files and files the index does not know about
+    assert select_tests(INDEX, ["src/a.py", "requirements.txt"], "hash") is None
+    assert select_tests(INDEX, ["tests/conftest.py"], "hash") is None
+    assert select_tests(INDEX, ["src/new.py"], "hash") is None
+
+
+def test_config_hash(tmp_path):
+    empty = config_hash(str(tmp_path))
+    (tmp_path / "requirements.txt").write_text("flask\n")
+    assert config_hash(str(tmp_path)) != empty
+    (tmp_path / "main.py").write_text("print()\n")
+    assert config_hash(str(tmp_path)) == config_hash(str(tmp_path))
+
+
+def test_changed_files(tmp_path):
+    repo = str(tmp_path)
+    git("init", "-q", cwd=repo)
+    (tmp_path / "a.py").write_text("a = 1\n")
+    git("add", "a.py", cwd=repo)
+    git("commit", "-q", "-m", "a", cwd=repo)
+    before = git("rev-parse", "HEAD", cwd=repo)
+    (tmp_path / "b.py").write_text("b = 1\n")
+    git("add", "b.py", cwd=repo)
+    git("commit", "-q", "-m", "b", cwd=repo)
+    after = git("rev-parse", "HEAD", cwd=repo)
+
+    assert changed_files(repo, before, after) == ["b.py"]
+    # New branches and unknown commits have no usable diff
+    assert changed_files(repo, "0" * 40, after) is None
+    assert changed_files(repo, "f" * 40, after) is None
+
+
+def commit(repo, files, message):
+    for name, text in files.items():
+        path = os.path.join(repo, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+    git("add", "-A", cwd=repo)
+    git("commit", "-q", "-m", message, cwd=repo)
+    return git("rev-parse", "HEAD", cwd=repo)
+
+
+def test_tests_added_since_the_full_run_are_selected(tmp_path):
+    repo = str(tmp_path)
+    git("init", "-q", cwd=repo)
+    indexed = commit(repo, {"src/a.py": "a = 1\n", "tests/test_a.py": ""}, "a")
+    index = (indexed, "hash", {"src/a.py": {"tests/test_a.py"}})
+    # A partial run added a test the index has never seen
+    before = commit(repo, {"tests/test_new.py": "from src import a\n"}, "new")
+    after = commit(repo, {"src/a.py": "a = 2\n"}, "change a")
+
+    assert select_tests(index, changed_files(repo, before, after), "hash") == [
+        "tests/test_a.py"
+    ]
+    assert index_is_current(repo, indexed, after)
+    assert select_tests(index, changed_files(repo, indexed, after), "hash") == [
+        "tests/test_a.py",
+        "tests/test_new.py",
+    ]
+
+
+def test_index_is_current(tmp_path):
+    repo = str(tmp_path)
+    git("init", "-q", cwd=repo)
+    indexed = commit(repo, {"a.py": "a = 1\n"}, "a")
+    head = commit(repo, {"a.py": "a = 2\n"}, "a2")
+    head = commit(repo, {"a.py": "a = 3\n"}, "a3")
+    assert index_is_current(repo, indexed, head)
+    assert not index_is_current(repo, indexed, head, max_commits=1)
+    # After a force-push the indexed commit is not an ancestor
+    git("checkout", "-q", "--orphan", "other", cwd=repo)
+    rewritten = commit(repo, {"a.py": "a = 4\n"}, "rewritten")
+    assert not index_is_current(repo, indexed, rewritten)
+    assert not index_is_current(repo, "f" * 40, head)
+
+
+def test_map_contexts(tmp_path):
+    report = {
+        "files": {
+            str(tmp_path / "src" / "a.py"): {
+                "contexts": {
+                    "1": [""],
+                    "2": ["tests.test_a.test_one", "test_b.TestGroup.test_two"],
+                }
+            },
+            "src/b.py": {"contexts": {"1": [""]}},
+        }
+    }
+    mapping = map_contexts(
+        report, str(tmp_path), {"tests/test_a.py", "tests/test_b.py"}
+    )
+    assert mapping == {"src/a.py": {"tests/test_a.py", "tests/test_b.py"}}
+
+
+def test_collect_coverage(tmp_path):
+    pytest.importorskip("coverage")
+    (tmp_path / "lib.py").write_text("def one():\n    return 1\n")
+    (tmp_path / "test_lib.py").write_text(
+        "from lib import one\n\ndef test_one():\n    assert one() == 1\n"
+    )
+    (tmp_path / "test_other.py").write_text("def test_other():\n    pass\n")
+    rcfile = write_coverage_config(str(tmp_path))
+    subprocess.run(
+        [sys.executable, "-m", "coverage", "run", f"--rcfile={rcfile}", "-m", "pytest"],
+        cwd=tmp_path,
+        check=True,
+        capture_output=True,
+    )
+
+    mapping = collect_coverage(
+        str(tmp_path), sys.executable, rcfile, {"test_lib.py", "test_other.py"}
+    )
+    assert mapping["lib.py"] == {"test_lib.py"}
@@ -0,0 +1,94 @@
+import sys
+import os
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import build_log
+import db
+import log_store
+from build_log import BuildLog
+from db import initialise_db, connect, insert_build, get_build
+from log_store import *
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DATABASE", str(tmp_path / "ci.db"))
+    monkeypatch.setattr(build_log, "LOG_DIR", str(tmp_path / "logs"))
+    monkeypatch.setattr(build_log, "LOG_CHUNK_BYTES", 8)
+    monkeypatch.setattr(log_store, "LOG_STORE_DIR", str(tmp_path / "store"))
+    initialise_db().close()
+    connection = connect()
+    yield connection
+    connection.close()
+
+
+def write_log(build_id, lines):
+    log = BuildLog(build_id)
+    for line in lines:
+        log.write(line)
+    log.close()
+
+
+def blobs():
+    return [name for _, _, names in os.walk(log_store.LOG_STORE_DIR) for name in names]
+
+
+def test_blobs_are_content_addressed(conn):
+    digest = put_blob(b"hello\n")
+    assert put_blob(b"hello\n") == digest
+    assert len(blobs()) == 1
+    assert read_blob(digest) == b"hello\n"
+    with pytest.raises(FileNotFoundError):
+        read_blob("0" * 64)
+
+
+def test_archive_log_and_range_reads(conn):
+    build_id = insert_build(conn, "abc123", "2023-10-10 00:00:00", "running", "")
+    write_log(build_id, ["line one\n", "line two\n", "line one\n"])
+
+    assert archive_log(conn, build_id) == 27
+    assert not os.path.exists(build_log.log_path(build_id))
+    # The first and the last chunk have the same content and share a blob
+    assert len(blobs()) == 2
+    assert log_size(conn, build_id) == 27
+    assert b"".join(iter_log(conn, build_id)) == b"line one\nline two\nline one\n"
+    assert read_range(conn, build_id, 5, 10) == b"one\nline t"
+    assert read_range(conn, build_id, 100, 10) == b""
+    assert log_size(conn, 999) is None
+
+
+def test_append_log_shares_blobs(conn):
+    source = insert_build(conn, "abc123", "2023-10-10 00:00:00", "success", "")
+    write_log(source, ["line one\n", "line two\n"])
+    archive_log(conn, source)
+    build_id = insert_build(conn, "def456", "2023-10-11 00:00:00", "running", "")
+    write_log(build_id, ["reused\n"])
+    archive_log(conn, build_id)
+    stored = len(blobs())
+
+    assert append_log(conn, build_id, source) == 25
+    assert b"".join(iter_log(conn, build_id)) == b"reused\nline one\nline two\n"
+    assert read_range(conn, build_id, 5, 6) == b"d\nline"
+    assert len(blobs()) == stored
+
+
+def test_prune_logs_keeps_builds(conn, monkeypatch):
+    old = insert_build(conn, "abc123", "2000-01-01 00:00:00", "success", "output")
+    new = insert_build(conn, "def456", "2999-01-01 00:00:00", "running", "")
+    write_log(old, ["old log\n"])
+    write_log(new, ["new log\n"])
+    archive_log(conn, old)
+    archive_log(conn, new)
+
+    # Blobs younger than the grace period survive even without a reference
+    monkeypatch.setattr(log_store, "BLOB_GRACE_SECONDS", 0)
+    assert prune_logs(conn, retention_days=30) == 1
+    assert get_build(conn, old)[3:5] == ("success", "")
+    assert log_size(conn, old) is None
+    assert b"".join(iter_log(conn, new)) == b"new log\n"
+    assert len(blobs()) == 1
+
+    # Zero days keeps every log
+    assert prune_logs(conn, retention_days=0) == 0
+    assert log_size(conn, new) == 8
@@ -0,0 +1,71 @@
+import sys
+import os
+import threading
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import metrics
+from metrics import *
+
+
+def test_counter_sums_threads():
+    counter = Counter("test_requests", "Requests", ("method",))
+    threads = [
+        threading.Thread(target=lambda: [counter.inc(method="GET") for _ in range(100)])
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc(2, method='P"OST')
+
+    assert counter.value(method="GET") == 400
+    text = counter.render()
+    assert "# TYPE test_requests counter" in text
+    assert 'test_requests_total{method="GET"} 400' in text
+    assert 'test_requests_total{method="P\\"OST"} 2' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_latency_seconds", "Latency", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 5):
+        histogram.observe(value)
+
+    lines = histogram.render().splitlines()
+    assert lines[2:] == [
+        'test_latency_seconds_bucket{le="0.1"} 1',
+        'test_latency_seconds_bucket{le="1"} 3',
+        'test_latency_seconds_bucket{le="+Inf"} 4',
+        "test_latency_seconds_sum 6.25",
+        "test_latency_seconds_count 4",
+    ]
+
+
+def test_exited_threads_do_not_keep_shards():
+    counter = Counter("test_short_lived", "Requests")
+    histogram = Histogram("test_short_lived_seconds", "Latency", buckets=(1,))
+
+    def record():
+        counter.inc()
+        histogram.observe(0.5)
+
+    for _ in range(500):
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+    # A new thread folds the shards of the exited ones into the base
+    assert len(counter._shards) <= 1
+    assert counter.value() == 500
+    assert len(counter._shards) == 0
+    assert "test_short_lived_seconds_count 500" in histogram.render()
+    assert len(histogram._shards) == 0
+
+
+def test_render_skips_failing_gauges(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    Gauge("test_depth", "Depth", lambda: {("queued",): 3}, ("state",))
+    Gauge("test_broken", "Broken", lambda: 1 / 0)
+
+    text = render()
+    assert 'test_depth{state="queued"} 3' in text
+    assert "test_broken" not in text
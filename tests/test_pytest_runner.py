@@ -0,0 +1,93 @@
+import sys
+import os
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from pytest_runner import *
+from build_log import BuildLog
+
+PASSING = """
+def test_one():
+    assert True
+
+class TestGroup:
+    def test_two(self):
+        assert True
+"""
+
+FAILING = """
+import pytest
+
+def test_fails():
+    assert False
+
+@pytest.mark.skip
+def test_skipped():
+    pass
+"""
+
+
+@pytest.fixture
+def repo(tmp_path):
+    (tmp_path / "tests").mkdir()
+    (tmp_path / "tests" / "__init__.py").write_text("")
+    (tmp_path / "tests" / "test_pass.py").write_text(PASSING)
+    (tmp_path / "tests" / "test_more.py").write_text(PASSING)
+    (tmp_path / "tests" / "test_fail.py").write_text(FAILING)
+    return str(tmp_path)
+
+
+def test_plan_shards_balances_by_duration():
+    durations = {"a.py": 10.0, "b.py": 6.0, "c.py": 5.0, "d.py": 1.0}
+    plan = plan_shards(["a.py", "b.py", "c.py", "d.py"], 2, durations)
+    assert plan == [["a.py", "d.py"], ["b.py", "c.py"]]
+
+    # Unknown files count as DEFAULT_FILE_DURATION and empty shards are dropped
+    assert plan_shards(["x.py"], 4) == [["x.py"]]
+
+
+def test_collect_test_files(repo):
+    files = collect_test_files(repo, sys.executable)
+    assert sorted(files) == [
+        "tests/test_fail.py",
+        "tests/test_more.py",
+        "tests/test_pass.py",
+    ]
+
+
+def test_run_pytest_sharded(repo):
+    passed, output = run_pytest(repo, sys.executable, shards=2)
+    assert not passed
+    assert "== shard 1/2 ==" in output
+    assert "== shard 2/2 ==" in output
+
+    results = {r[0]: r[1] for r in read_junit(os.path.join(repo, JUNIT_REPORT))}
+    assert results == {
+        "tests/test_pass.py::test_one": "passed",
+        "tests/test_pass.py::TestGroup::test_two": "passed",
+        "tests/test_more.py::test_one": "passed",
+        "tests/test_more.py::TestGroup::test_two": "passed",
+        "tests/test_fail.py::test_fails": "failed",
+        "tests/test_fail.py::test_skipped": "skipped",
+    }
+    messages = {r[0]: r[3] for r in read_junit(os.path.join(repo, JUNIT_REPORT))}
+    assert messages["tests/test_pass.py::test_one"] is None
+    assert "assert False" in messages["tests/test_fail.py::test_fails"]
+
+
+def test_run_pytest_single_process(repo):
+    os.remove(os.path.join(repo, "tests", "test_fail.py"))
+    passed, output = run_pytest(repo, sys.executable, shards=1)
+    assert passed
+    assert "== shard" not in output
+    assert len(read_junit(os.path.join(repo, JUNIT_REPORT))) == 4
+
+
+def test_run_pytest_streams_into_log(repo):
+    log = BuildLog()
+    passed, output = run_pytest(repo, sys.executable, shards=2, log=log)
+    assert not passed
+    assert output == ""
+    # Every line is written to the log as it is produced, tagged with its shard
+    lines = log.tail().splitlines()
+    assert lines and all(line.startswith(("[1/2] ", "[2/2] ")) for line in lines)
@@ -0,0 +1,64 @@
+import sys
+import os
+import subprocess
+import threading
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from resource_usage import *
+
+# Allocates about 50 MiB and burns some CPU
+CHILD = "data = bytearray(50 * 1024 * 1024); sum(i * i for i in range(300000))"
+
+
+def test_run_measures_the_child():
+    with measure() as usage:
+        result = run([sys.executable, "-c", "print('hi')"], capture_output=True)
+        run([sys.executable, "-c", CHILD], check=True)
+    assert result.stdout == b"hi\n"
+    assert usage["cpu_time"] > 0
+    assert usage["max_rss"] > 50 * 1024
+
+    with pytest.raises(subprocess.CalledProcessError):
+        run([sys.executable, "-c", "import sys; sys.exit(3)"], check=True)
+
+
+def test_threads_are_measured_separately():
+    # Children of another thread do not count towards this thread's record
+    other = {}
+
+    def build():
+        with measure() as usage:
+            run([sys.executable, "-c", CHILD])
+        other.update(usage)
+
+    thread = threading.Thread(target=build)
+    with measure() as usage:
+        thread.start()
+        thread.join()
+        add_downloaded(100)
+    assert other["max_rss"] > 50 * 1024
+    assert usage["max_rss"] == 0
+    assert usage["downloaded"] == 100
+
+    # Worker threads can add to the record of the thread they work for
+    with measure() as usage:
+
+        def work():
+            with attach(usage):
+                run([sys.executable, "-c", CHILD])
+
+        worker = threading.Thread(target=work)
+        worker.start()
+        worker.join()
+    assert usage["max_rss"] > 50 * 1024
+
+
+def test_stage_percentiles():
+    rows = [("test", float(i), 1.0, 100, None) for i in range(1, 11)]
+    rows.append(("env", 2.0, None, None, 0))
+    stats = stage_percentiles(rows)
+    assert stats["test"]["duration"] == (5.0, 10.0)
+    assert stats["test"]["downloaded"] == (None, None)
+    assert stats["env"]["downloaded"] == (0, 0)
+    assert percentile([], 50) is None
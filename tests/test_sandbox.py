@@ -0,0 +1,115 @@
+import sys
+import os
+import subprocess
+import threading
+import time
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import build_log
+import sandbox
+from sandbox import *
+
+# Allocates memory one MiB at a time until it fails
+GROW = "chunks = []\nwhile True: chunks.append(b'x' * (1024 * 1024))"
+
+posix_only = pytest.mark.skipif(os.name != "posix", reason="needs process groups")
+
+
+def running(pid):
+    # Killed orphans may stay zombies until init reaps them
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_without_limits_nothing_changes():
+    result = run([sys.executable, "-c", "print('hi')"], capture_output=True)
+    assert result.stdout == b"hi\n"
+    with pytest.raises(subprocess.CalledProcessError):
+        run([sys.executable, "-c", "import sys; sys.exit(3)"], check=True)
+
+
+@posix_only
+def test_timeout_kills_the_process_group(tmp_path):
+    pid_file = tmp_path / "pid"
+    script = f"sleep 30 & echo $! > {pid_file}; wait"
+    start = time.monotonic()
+    with limit(timeout=0.5):
+        with pytest.raises(LimitExceeded) as raised:
+            run(["sh", "-c", script], capture_output=True)
+    # The background sleep held the output pipe, run only returned because it was killed
+    assert time.monotonic() - start < 10
+    assert raised.value.status == "timed_out"
+    assert not running(int(pid_file.read_text()))
+
+    # The deadline is shared, later commands of the block fail right away
+    with limit(timeout=0.2):
+        time.sleep(0.3)
+        with pytest.raises(LimitExceeded):
+            run(["true"])
+
+
+@posix_only
+def test_cancel_kills_the_process_group():
+    cancelled = threading.Event()
+    threading.Timer(0.3, cancelled.set).start()
+    start = time.monotonic()
+    with limit(cancelled=cancelled):
+        with pytest.raises(LimitExceeded) as raised:
+            run(["sh", "-c", "sleep 30 & wait"], capture_output=True)
+        assert raised.value.status == "superseded"
+        assert time.monotonic() - start < 10
+        # Nothing else starts in a cancelled build
+        with pytest.raises(LimitExceeded):
+            run(["true"])
+
+
+@posix_only
+def test_streamed_commands_are_limited():
+    log = []
+
+    class Log:
+        def write(self, text):
+            log.append(text)
+
+    with limit(timeout=0.5):
+        with pytest.raises(LimitExceeded):
+            build_log.stream_process(["sh", "-c", "echo started; sleep 30"], ".", Log())
+    assert log == ["started\n"]
+
+
+@pytest.mark.skipif(not sandbox.resource, reason="needs rlimits")
+def test_cpu_and_memory_limits():
+    with limit(cpu_seconds=1):
+        with pytest.raises(LimitExceeded) as raised:
+            run([sys.executable, "-c", "while True: pass"])
+    assert raised.value.status == "timed_out"
+
+    with limit(memory_mb=200):
+        with pytest.raises(LimitExceeded) as raised:
+            run([sys.executable, "-c", GROW], capture_output=True)
+        # Failing far below the limit is an ordinary failure
+        result = run([sys.executable, "-c", "import sys; sys.exit(1)"])
+    assert raised.value.status == "oom"
+    assert result.returncode == 1
+
+
+def test_worker_threads_share_the_limits():
+    seen = []
+
+    with limit(timeout=60) as limits:
+
+        def work():
+            with attach(limits):
+                seen.append(Popen([sys.executable, "-c", "pass"]))
+                seen[-1].wait()
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    assert seen[0].limits is limits
+    assert seen[0].limit_exceeded is None
+    assert current() is None
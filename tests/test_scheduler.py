@@ -0,0 +1,354 @@
+import sys
+import os
+import threading
+import time
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from db import *
+from scheduler import BuildScheduler, QueueFullError, coalesce_key, job_priority
+
+
+@pytest.fixture
+def temp_db(tmp_path, monkeypatch):
+    # Use a temporary file as the database.
+    monkeypatch.setattr("db.DATABASE", str(tmp_path / "test_scheduler.db"))
+    initialise_db()
+
+
+def test_submit_and_run_next(temp_db):
+    handled = []
+    scheduler = BuildScheduler(
+        lambda payload, cancelled: handled.append(payload) or 200
+    )
+
+    job_id = scheduler.submit({"after": "abc123"})
+    assert scheduler.stats()["queued"] == 1
+
+    assert scheduler.run_next()
+    assert handled == [{"after": "abc123"}]
+    job = get_job(connect(), job_id)
+    assert job[2] == "done"
+    assert job[6] == 1
+
+    # Nothing left to run
+    assert not scheduler.run_next()
+
+
+def test_failed_job(temp_db):
+    def handler(payload, cancelled):
+        raise RuntimeError("boom")
+
+    scheduler = BuildScheduler(handler)
+    job_id = scheduler.submit({"after": "abc123"})
+    assert scheduler.run_next()
+    assert get_job(connect(), job_id)[2] == "failed"
+
+
+def test_backpressure(temp_db):
+    scheduler = BuildScheduler(lambda payload, cancelled: 200, max_queue_depth=2)
+    scheduler.submit({"after": "1"})
+    scheduler.submit({"after": "2"})
+    with pytest.raises(QueueFullError):
+        scheduler.submit({"after": "3"})
+
+    # Draining the queue makes room again
+    scheduler.run_next()
+    scheduler.submit({"after": "3"})
+
+
+def test_restart_requeues_interrupted_jobs(temp_db):
+    scheduler = BuildScheduler(lambda payload, cancelled: 200, workers=0)
+    job_id = scheduler.submit({"after": "abc123"})
+
+    # Simulate the server dying while the job was running
+    claim_next_job(connect(), time.time())
+    assert get_job(connect(), job_id)[2] == "running"
+
+    assert scheduler.start() == 1
+    assert get_job(connect(), job_id)[2] == "queued"
+    scheduler.stop()
+
+
+def test_worker_pool_is_bounded(temp_db):
+    running = []
+    peak = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def handler(payload, cancelled):
+        with lock:
+            running.append(payload)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(payload)
+        if payload["after"] == "5":
+            done.set()
+        return 200
+
+    scheduler = BuildScheduler(handler, workers=2, poll_interval=0.01)
+    for i in range(6):
+        scheduler.submit({"after": str(i)})
+    scheduler.start()
+    assert done.wait(5)
+    scheduler.stop(timeout=5)
+
+    assert max(peak) <= 2
+    stats = scheduler.stats()
+    assert stats["queued"] == 0
+    assert stats["avg_wait"] > 0
+
+
+def push(sha, ref="refs/heads/main"):
+    return {
+        "ref": ref,
+        "after": sha,
+        "repository": {"owner": {"login": "example"}, "name": "repo"},
+    }
+
+
+def test_coalesce_key():
+    assert coalesce_key(push("a")) == "example/repo:refs/heads/main"
+    assert coalesce_key({"after": "a"}) is None
+    cell = dict(push("a"), matrix={"name": "py3.12"})
+    assert coalesce_key(cell) == "example/repo:refs/heads/main [py3.12]"
+
+
+def test_newer_push_supersedes_queued_jobs(temp_db):
+    handled = []
+    superseded = []
+    scheduler = BuildScheduler(
+        lambda payload, cancelled: handled.append(payload["after"]) or 200,
+        on_superseded=lambda old, new: superseded.append((old["after"], new["after"])),
+    )
+
+    first = scheduler.submit(push("1"))
+    second = scheduler.submit(push("2"))
+    other_branch = scheduler.submit(push("x", ref="refs/heads/feature"))
+    third = scheduler.submit(push("3"))
+
+    assert superseded == [("1", "2"), ("2", "3")]
+    assert get_job(connect(), first)[2] == "superseded"
+    assert get_job(connect(), first)[8] == second
+    assert get_job(connect(), second)[8] == third
+
+    while scheduler.run_next():
+        pass
+    assert handled == ["x", "3"]
+    assert get_job(connect(), other_branch)[2] == "done"
+
+
+def test_coalescing_disabled(temp_db):
+    handled = []
+    scheduler = BuildScheduler(
+        lambda payload, cancelled: handled.append(payload["after"]) or 200,
+        coalesce=False,
+    )
+    scheduler.submit(push("1"))
+    scheduler.submit(push("2"))
+    while scheduler.run_next():
+        pass
+    assert handled == ["1", "2"]
+
+
+def test_superseding_push_bypasses_full_queue(temp_db):
+    scheduler = BuildScheduler(lambda payload, cancelled: 200, max_queue_depth=1)
+    scheduler.submit(push("1"))
+    scheduler.submit(push("2"))
+    with pytest.raises(QueueFullError):
+        scheduler.submit(push("x", ref="refs/heads/feature"))
+
+
+def test_abort_running_superseded_job(temp_db):
+    started = threading.Event()
+    superseded = []
+
+    def handler(payload, cancelled):
+        if payload["after"] == "1":
+            started.set()
+            assert cancelled.wait(5)
+            return 409
+        return 200
+
+    scheduler = BuildScheduler(
+        handler,
+        abort_superseded=True,
+        on_superseded=lambda old, new: superseded.append((old["after"], new["after"])),
+    )
+    first = scheduler.submit(push("1"))
+    worker = threading.Thread(target=scheduler.run_next)
+    worker.start()
+    assert started.wait(5)
+
+    second = scheduler.submit(push("2"))
+    worker.join(5)
+
+    assert superseded == [("1", "2")]
+    job = get_job(connect(), first)
+    assert job[2] == "superseded"
+    assert job[8] == second
+
+
+def test_lease_renew_and_complete(temp_db):
+    scheduler = BuildScheduler(lambda payload, cancelled: 200, lease_seconds=60)
+    assert scheduler.lease("agent-1") is None
+
+    job_id = scheduler.submit(push("1"))
+    job = scheduler.lease("agent-1")
+    assert job["job_id"] == job_id
+    assert job["payload"] == push("1")
+    assert job["lease_seconds"] == 60
+    assert get_job(connect(), job_id)[9] == "agent-1"
+    # Leased jobs are not run by the workers
+    assert not scheduler.run_next()
+
+    assert scheduler.renew(job_id, job["lease_token"])
+    assert not scheduler.renew(job_id, "stolen")
+    assert not scheduler.complete(job_id, "stolen", "done")
+    assert scheduler.complete(job_id, job["lease_token"], "done")
+    assert get_job(connect(), job_id)[2] == "done"
+    # A finished job can not be renewed
+    assert not scheduler.renew(job_id, job["lease_token"])
+
+
+def test_expired_lease_is_queued_again(temp_db):
+    expired = []
+    scheduler = BuildScheduler(
+        lambda payload, cancelled: 200,
+        lease_seconds=0.1,
+        on_lease_expired=lambda job_id, build_id: expired.append((job_id, build_id)),
+    )
+    job_id = scheduler.submit(push("1"))
+    job = scheduler.lease("agent-1")
+    set_job_build(connect(), job_id, 7)
+    assert scheduler.expire_leases() == []
+
+    time.sleep(0.2)
+    assert scheduler.expire_leases() == [(job_id, 7)]
+    assert expired == [(job_id, 7)]
+    assert get_job(connect(), job_id)[2] == "queued"
+    # The dead agent can not report it any more, another agent builds it
+    assert not scheduler.renew(job_id, job["lease_token"])
+    assert not scheduler.complete(job_id, job["lease_token"], "done")
+    assert scheduler.lease("agent-2")["job_id"] == job_id
+
+
+def test_abort_leased_superseded_job(temp_db):
+    superseded = []
+    scheduler = BuildScheduler(
+        lambda payload, cancelled: 200,
+        abort_superseded=True,
+        on_superseded=lambda old, new: superseded.append((old["after"], new["after"])),
+    )
+    first = scheduler.submit(push("1"))
+    job = scheduler.lease("agent-1")
+    assert not scheduler.is_cancelled(first)
+
+    second = scheduler.submit(push("2"))
+    assert superseded == [("1", "2")]
+    assert scheduler.is_cancelled(first)
+
+    # The agent reports the aborted build once its heartbeat told it to stop
+    assert scheduler.complete(first, job["lease_token"], "done")
+    job = get_job(connect(), first)
+    assert job[2] == "superseded"
+    assert job[8] == second
+    assert not scheduler.is_cancelled(first)
+
+
+def repo_push(repo, sha, ref="refs/heads/feature"):
+    payload = push(sha, ref)
+    payload["repository"] = {
+        "owner": {"login": "example"},
+        "name": repo,
+        "default_branch": "main",
+    }
+    return payload
+
+
+def test_job_priority():
+    assert job_priority(repo_push("a", "1", "refs/heads/main")) == 0
+    assert job_priority(repo_push("a", "1", "refs/tags/v1.0")) == 0
+    assert job_priority(repo_push("a", "1", "refs/heads/release/2.x")) == 0
+    assert job_priority(repo_push("a", "1", "refs/heads/feature")) == 1
+    assert job_priority(repo_push("a", "1", "refs/heads/release/2.x"), []) == 1
+    assert job_priority({"after": "1"}) == 1
+
+
+def claim_order(scheduler):
+    order = []
+    while True:
+        job = scheduler.lease("agent")
+        if job is None:
+            return order
+        order.append(job["payload"]["after"])
+        scheduler.complete(job["job_id"], job["lease_token"], "done")
+
+
+def test_priority_classes_run_first(temp_db):
+    scheduler = BuildScheduler(lambda payload, cancelled: 200, coalesce=False)
+    scheduler.submit(repo_push("a", "feature"))
+    scheduler.submit(repo_push("a", "main", "refs/heads/main"))
+    scheduler.submit(repo_push("a", "tag", "refs/tags/v1"))
+    assert claim_order(scheduler) == ["main", "tag", "feature"]
+
+    decisions = (
+        connect()
+        .execute(
+            "SELECT repo, priority, effective_priority, queued FROM schedule_decisions"
+        )
+        .fetchall()
+    )
+    assert decisions == [
+        ("example/a", 0, 0, 3),
+        ("example/a", 0, 0, 2),
+        ("example/a", 1, 1, 1),
+    ]
+    stats = scheduler.stats()
+    assert stats["priorities"]["high"]["jobs"] == 2
+    assert stats["priorities"]["normal"]["jobs"] == 1
+
+
+def test_aging_prevents_starvation(temp_db):
+    scheduler = BuildScheduler(
+        lambda payload, cancelled: 200, coalesce=False, aging_seconds=0.2
+    )
+    scheduler.submit(repo_push("a", "old"))
+    time.sleep(0.3)
+    scheduler.submit(repo_push("a", "main", "refs/heads/main"))
+    # The old feature push waited long enough to count as high priority
+    assert claim_order(scheduler) == ["old", "main"]
+
+
+def test_fair_share_between_repos(temp_db):
+    scheduler = BuildScheduler(lambda payload, cancelled: 200, coalesce=False)
+    for i in range(3):
+        scheduler.submit(repo_push("noisy", f"noisy{i}"))
+    scheduler.submit(repo_push("quiet", "quiet0"))
+    scheduler.submit(repo_push("quiet", "quiet1"))
+    # Repos take turns by the jobs they started recently
+    assert claim_order(scheduler) == ["noisy0", "quiet0", "noisy1", "quiet1", "noisy2"]
+
+
+def test_concurrency_cap_per_repo(temp_db):
+    scheduler = BuildScheduler(
+        lambda payload, cancelled: 200, coalesce=False, max_running_per_repo=1
+    )
+    scheduler.submit(repo_push("a", "a0"))
+    scheduler.submit(repo_push("a", "a1"))
+    scheduler.submit(repo_push("b", "b0"))
+
+    first = scheduler.lease("agent-1")
+    assert first["payload"]["after"] == "a0"
+    assert scheduler.lease("agent-2")["payload"]["after"] == "b0"
+    # a1 is held back while a0 runs
+    assert scheduler.lease("agent-3") is None
+    scheduler.complete(first["job_id"], first["lease_token"], "done")
+    assert scheduler.lease("agent-3")["payload"]["after"] == "a1"
+    held_back = (
+        connect()
+        .execute("SELECT held_back FROM schedule_decisions ORDER BY id")
+        .fetchall()
+    )
+    assert held_back == [(0,), (1,), (0,)]
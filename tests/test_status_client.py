@@ -0,0 +1,143 @@
+import sys
+import os
+import json
+import threading
+import time
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from status_client import *
+
+
+class StubGithub(ThreadingHTTPServer):
+    """Local stand-in for the statuses API, answers with the queued responses."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.requests = []
+        self.responses = []
+        self.default_response = (201, {})
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/statuses/"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(
+            (self.path, self.headers["Authorization"], json.loads(body), time.time())
+        )
+        status, headers = (
+            self.server.responses.pop(0)
+            if self.server.responses
+            else self.server.default_response
+        )
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def github():
+    server = StubGithub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def status(state):
+    return {"state": state, "description": "CI test results", "context": "CI/Test"}
+
+
+def test_sends_status_in_background(github):
+    reporter = StatusReporter(coalesce_seconds=0)
+    reporter.submit(github.url + "abc", status("success"), "token")
+    assert reporter.flush(5)
+
+    path, auth, payload, _ = github.requests[0]
+    assert (path, auth, payload) == ("/statuses/abc", "token token", status("success"))
+
+
+def test_coalesces_updates_for_the_same_commit(github):
+    reporter = StatusReporter(coalesce_seconds=0.5)
+    reporter.submit(github.url + "abc", status("pending"), "token")
+    reporter.submit(github.url + "def", status("pending"), "token")
+    reporter.submit(github.url + "abc", status("success"), "token")
+    assert reporter.flush(5)
+
+    sent = sorted((path, payload["state"]) for path, _, payload, _ in github.requests)
+    assert sent == [("/statuses/abc", "success"), ("/statuses/def", "pending")]
+
+
+def test_contexts_of_a_commit_are_sent_separately(github):
+    reporter = StatusReporter(coalesce_seconds=0.5)
+    for context in ("CI/Test (py3.11)", "CI/Test (py3.12)", "CI/Test"):
+        reporter.submit(
+            github.url + "abc", dict(status("pending"), context=context), "token"
+        )
+    reporter.submit(
+        github.url + "abc", dict(status("failure"), context="CI/Test (py3.12)"), "token"
+    )
+    assert reporter.pending() == 3
+    assert reporter.flush(5)
+
+    sent = sorted(
+        (payload["context"], payload["state"]) for _, _, payload, _ in github.requests
+    )
+    assert sent == [
+        ("CI/Test", "pending"),
+        ("CI/Test (py3.11)", "pending"),
+        ("CI/Test (py3.12)", "failure"),
+    ]
+
+
+def test_retries_server_errors_with_backoff(github, monkeypatch):
+    # Without jitter the delays double, 0.1s and 0.2s
+    monkeypatch.setattr("status_client.random.uniform", lambda low, high: high)
+    github.responses = [(502, {}), (503, {})]
+    reporter = StatusReporter(coalesce_seconds=0, backoff=0.05)
+    reporter.submit(github.url + "abc", status("success"), "token")
+    assert reporter.flush(5)
+
+    times = [request[3] for request in github.requests]
+    assert len(times) == 3
+    assert times[2] - times[1] >= times[1] - times[0] > 0
+
+
+def test_gives_up_and_drops_rejected_updates(github):
+    github.default_response = (500, {})
+    reporter = StatusReporter(coalesce_seconds=0, backoff=0.01, max_attempts=2)
+    reporter.submit(github.url + "abc", status("success"), "token")
+    assert reporter.flush(5)
+    assert len(github.requests) == 2
+
+    # Client errors are not retried
+    github.requests.clear()
+    github.default_response = (422, {})
+    reporter.submit(github.url + "abc", status("success"), "token")
+    assert reporter.flush(5)
+    assert len(github.requests) == 1
+
+
+def test_waits_for_rate_limit_reset(github):
+    reset = time.time() + 1
+    github.responses = [
+        (403, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset)})
+    ]
+    reporter = StatusReporter(coalesce_seconds=0)
+    reporter.submit(github.url + "abc", status("success"), "token")
+    assert reporter.flush(5)
+
+    assert len(github.requests) == 2
+    assert github.requests[1][3] >= reset
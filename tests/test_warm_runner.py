@@ -0,0 +1,135 @@
+import sys
+import os
+import venv
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+import env_cache
+import pytest_runner
+import resource_usage
+import sandbox
+from warm_runner import *
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+
+TESTS = """
+import os
+import pytest
+
+def test_pid():
+    print("session pid", os.getpid())
+
+def test_isolated():
+    # Set by the earlier session, which ran in another fork of the same interpreter
+    assert not hasattr(pytest, "leaked")
+    pytest.leaked = True
+"""
+
+
+@pytest.fixture
+def checkout(tmp_path, monkeypatch):
+    # A checkout whose environment came from the cache, the cached environment
+    # sees the packages of this interpreter, pytest included
+    monkeypatch.setattr("env_cache.ENV_CACHE_DIR", str(tmp_path / "env-cache"))
+    cached = tmp_path / "env-cache" / "key"
+    venv.create(cached, system_site_packages=True)
+    (cached / "ci-env-complete").touch()
+    repo = tmp_path / "repo"
+    (repo / ".venv").mkdir(parents=True)
+    (repo / ".venv" / "ci-env-key").write_text("key")
+    (repo / "test_sample.py").write_text(TESTS)
+    return str(repo), env_cache.venv_python(str(repo / ".venv"))
+
+
+def test_sessions_are_isolated_and_recycled(checkout):
+    repo, python = checkout
+    pool = WarmPool(size=1, max_runs=2)
+    try:
+        outputs = []
+        for _ in range(3):
+            returncode, output = pool.run(python, repo, ["-s", "-q"])
+            assert returncode == 0, output
+            outputs.append(output)
+        assert "2 passed" in outputs[0]
+        pids = {
+            line.split()[-1]
+            for o in outputs
+            for line in o.splitlines()
+            if "session pid" in line
+        }
+        assert len(pids) == 3
+        # The interpreter that ran two sessions was replaced
+        interpreter = pool.acquire(python)
+        assert interpreter.runs <= 1
+        pool.release(interpreter)
+        assert env_cache._is_pinned(interpreter.environment)
+    finally:
+        pool.close()
+    assert not env_cache._is_pinned(interpreter.environment)
+
+
+def test_failures_and_usage(checkout):
+    repo, python = checkout
+    with open(os.path.join(repo, "test_fail.py"), "w") as f:
+        f.write("def test_fail():\n    assert 1 == 2\n")
+    pool = WarmPool()
+    try:
+        lines = []
+
+        class Log:
+            def write(self, text):
+                lines.append(text)
+
+        with resource_usage.measure() as usage:
+            returncode, output = pool.run(
+                python, repo, ["test_fail.py"], Log(), "[1/1] "
+            )
+        assert returncode == 1
+        assert output == ""
+        assert any(line.startswith("[1/1] ") and "1 failed" in line for line in lines)
+        assert usage["cpu_time"] > 0
+        assert usage["max_rss"] > 0
+    finally:
+        pool.close()
+
+
+def test_sessions_are_limited(checkout):
+    repo, python = checkout
+    with open(os.path.join(repo, "test_slow.py"), "w") as f:
+        f.write("import time\n\ndef test_slow():\n    time.sleep(30)\n")
+    pool = WarmPool()
+    try:
+        with sandbox.limit(timeout=1):
+            with pytest.raises(sandbox.LimitExceeded) as raised:
+                pool.run(python, repo, ["test_slow.py"])
+        assert raised.value.status == "timed_out"
+        # The interpreter survives the killed session
+        assert pool.run(python, repo, ["test_sample.py"])[0] == 0
+    finally:
+        pool.close()
+
+
+def test_uncached_environments_run_cold(tmp_path, monkeypatch):
+    monkeypatch.setattr("env_cache.ENV_CACHE_DIR", str(tmp_path / "env-cache"))
+    assert WarmPool().run(sys.executable, str(tmp_path), ["-q"]) is None
+
+
+def test_run_pytest_uses_the_warm_runner(checkout, monkeypatch):
+    repo, python = checkout
+    with open(os.path.join(repo, "test_other.py"), "w") as f:
+        f.write("def test_other():\n    pass\n")
+    pool = WarmPool()
+    monkeypatch.setattr("warm_runner.WARM_RUNNER", True)
+    monkeypatch.setattr("warm_runner.pool", pool)
+    try:
+        warm = WARM_SESSIONS.value(mode="warm")
+        passed, _ = pytest_runner.run_pytest(repo, python, shards=2)
+        assert passed
+        # The collection and both shards
+        assert WARM_SESSIONS.value(mode="warm") == warm + 3
+        results = pytest_runner.read_junit(
+            os.path.join(repo, pytest_runner.JUNIT_REPORT)
+        )
+        assert [result[1] for result in results] == ["passed"] * 3
+    finally:
+        pool.close()
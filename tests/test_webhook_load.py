@@ -0,0 +1,67 @@
+import sys
+import os
+import json
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "../benchmarks"))
+)
+from webhook_load import *
+from deliveries import verify_signature
+
+
+def test_summarise():
+    stats = summarise([0.3, 0.1, 0.2, 0.4])
+    assert stats["count"] == 4
+    assert stats["p50"] == 0.3
+    assert stats["max"] == stats["p99"] == 0.4
+    assert abs(stats["mean"] - 0.25) < 1e-9
+    assert summarise([])["p95"] is None
+
+
+def test_payloads_are_signed_for_the_server():
+    payloads = synthetic_payloads("git://localhost/repo.git", ["a", "b", "c"], 2)
+    assert [p["ref"] for p in payloads] == [
+        "refs/heads/bench-0",
+        "refs/heads/bench-1",
+        "refs/heads/bench-0",
+    ]
+    assert payloads[1]["before"] == "a"
+
+    body = json.dumps(payloads[0]).encode()
+    assert verify_signature(body, sign(body, WEBHOOK_SECRET), WEBHOOK_SECRET)
+
+
+def test_recorded_payloads_are_retargeted(tmp_path):
+    recorded = tmp_path / "payloads.jsonl"
+    recorded.write_text(
+        "\n".join(
+            json.dumps({"after": sha, "repository": {"clone_url": "https://x"}})
+            for sha in ("1", "2")
+        )
+    )
+    payloads = load_payloads(str(recorded))
+    retarget(payloads, "git://localhost/fixture.git", ["a", "b"])
+    assert [(p["after"], p["repository"]["clone_url"]) for p in payloads] == [
+        ("a", "git://localhost/fixture.git"),
+        ("b", "git://localhost/fixture.git"),
+    ]
+
+
+def test_format_report_compares_with_baseline():
+    def report(p95, commit):
+        stats = summarise([p95])
+        return {
+            "version": REPORT_VERSION,
+            "commit": commit,
+            "metrics": {"ack_latency": stats},
+            "db_writes": {},
+            "acks": {"202": 1},
+            "builds": {"success": 1},
+            "throughput": 1.0,
+            "elapsed": 1.0,
+        }
+
+    table = format_report(report(0.015, "new"), report(0.010, "old"))
+    assert "p95 old" in table.splitlines()[0]
+    assert "+50%" in table
@@ -0,0 +1,80 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+from workspace import *
+
+
+def fill(path, size):
+    with open(os.path.join(path, "data"), "wb") as f:
+        f.write(b"x" * size)
+
+
+def test_released_workspaces_are_deleted_in_background(tmp_path):
+    manager = WorkspaceManager(str(tmp_path / "ws"))
+    first = manager.allocate("repo-abc")
+    second = manager.allocate("repo-abc")
+    assert first != second
+    assert os.path.basename(first).startswith("repo-abc-")
+    assert manager.active() == 2
+
+    fill(first, 1000)
+    reclaimed = RECLAIMED_BYTES.value(reason="finished")
+    manager.release(first)
+    assert manager.flush(5)
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert manager.active() == 1
+    assert RECLAIMED_BYTES.value(reason="finished") == reclaimed + 1000
+
+
+def test_quota_evicts_kept_workspaces(tmp_path):
+    manager = WorkspaceManager(str(tmp_path / "ws"), max_bytes=1500)
+    running = manager.allocate("running")
+    fill(running, 1000)
+    kept = manager.allocate("kept")
+    fill(kept, 1000)
+
+    # The kept workspace goes over the quota, the running one is never evicted
+    manager.release(kept, keep=True)
+    assert manager.flush(5)
+    assert not os.path.exists(kept)
+    assert os.path.exists(running)
+    assert not any(name.endswith(".lock") for name in os.listdir(manager._own))
+
+    manager = WorkspaceManager(str(tmp_path / "ws"), max_bytes=10000)
+    kept = manager.allocate("kept")
+    manager.release(kept, keep=True)
+    assert manager.flush(5)
+    assert os.path.exists(kept)
+
+
+def test_sweep_deletes_stale_workspaces(tmp_path):
+    os.makedirs(tmp_path / "ws" / "left-behind")
+    # Another process sharing the root, e.g. a build agent on the same host
+    other = WorkspaceManager(str(tmp_path / "ws"))
+    other_active = other.allocate("repo")
+    manager = WorkspaceManager(str(tmp_path / "ws"))
+    active = manager.allocate("repo")
+    manager.sweep()
+    assert manager.flush(5)
+    assert not os.path.exists(tmp_path / "ws" / "left-behind")
+    assert os.path.exists(active)
+    assert os.path.exists(other_active)
+
+    # Once the other process exited its lock is free and its workspaces go
+    other._own_lock.close()
+    manager.sweep()
+    assert manager.flush(5)
+    assert not os.path.exists(other._own)
+    assert not os.path.exists(other._own + ".lock")
+    assert os.path.exists(active)
+
+
+def test_release_ignores_other_paths(tmp_path):
+    other = tmp_path / "other"
+    other.mkdir()
+    manager = WorkspaceManager(str(tmp_path / "ws"))
+    manager.release(str(other))
+    assert manager.flush(5)
+    assert other.exists()